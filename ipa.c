@@ -25,6 +25,15 @@
  *
  */
 #include "ipa.h"
+#include <time.h>
+#include <ctype.h>
+#include <errno.h>
+#if defined(_WIN32)
+#include <windows.h>
+#else
+#include <signal.h>
+#include <sys/time.h>
+#endif
 static const char *PYDDD_IPA_VERSION = "0.1.2";
 
 #if defined(TEST_IPA)
@@ -32,38 +41,277 @@ static const char *PYDDD_IPA_VERSION = "0.1.2";
 #endif
 
 static char* find_name_in_list(const char *name, const char *namelist);
-static void pyddd_ipa_set_volatile_breakpoint(const int enabled,
-                                              const long thread_id,
-                                              PyFrameObject *f_frame,
-                                              PyObject* co_filename,
-                                              const int lineno);
+static struct pyddd_ipa_t_catch_patterns*
+pyddd_ipa_compile_catch_patterns(const char *namelist);
+static void
+pyddd_ipa_free_catch_patterns(struct pyddd_ipa_t_catch_patterns *patterns);
+static int
+pyddd_ipa_match_catch_patterns(const struct pyddd_ipa_t_catch_patterns
+                               *patterns,
+                               const char *name);
+static void pyddd_ipa_release_object(PyObject *o);
+static void pyddd_ipa_release_pending_objects(void);
+static struct pyddd_ipa_t_code_entry*
+pyddd_ipa_lookup_code(PyCodeObject *code);
+static void pyddd_ipa_update_code_lines(struct pyddd_ipa_t_code_entry *entry,
+                                        const unsigned int hash);
+static unsigned int pyddd_ipa_hash_filename(const char *filename);
+static PyObject* pyddd_ipa_bind_filename(PyObject *co_filename,
+                                         const char *filename,
+                                         const unsigned int hash);
+static void pyddd_ipa_link_breakpoint(const int rindex);
+static char* pyddd_ipa_copy_string(char *old, const char *s);
+static void pyddd_ipa_unlink_breakpoint(const int rindex);
+static struct pyddd_ipa_t_volatile_breakpoint*
+pyddd_ipa_find_volatile_breakpoint(const long thread_id);
+static int pyddd_ipa_set_volatile_breakpoint(const int enabled,
+                                             const long thread_id,
+                                             PyFrameObject *f_frame,
+                                             PyObject* co_filename,
+                                             const int lineno);
+static void pyddd_ipa_clear_volatile_breakpoint(const long thread_id);
+static PyThreadState* pyddd_ipa_this_thread_state(void);
+static int pyddd_ipa_fnmatch(const char *pattern, const char *s);
+static int pyddd_ipa_check_module(PyCodeObject *code);
+static int pyddd_ipa_check_filename(const char *filename);
+static struct pyddd_ipa_t_module* pyddd_ipa_add_module(PyCodeObject *code);
+static int pyddd_ipa_collect_symbols(struct pyddd_ipa_t_module *module,
+                                     int *capacity,
+                                     PyCodeObject *code,
+                                     const char *prefix);
+static long long pyddd_ipa_profile_clock(void);
+static long long pyddd_ipa_realtime_clock(void);
+static struct pyddd_ipa_t_profile_thread*
+pyddd_ipa_find_profile_thread(const long thread_id, const int create);
+static int pyddd_ipa_profile_lookup(PyCodeObject *code);
+static void pyddd_ipa_sample_threads(PyInterpreterState *interp);
+static int pyddd_ipa_parse_condition(const char *s,
+                                     char *name,
+                                     long *value);
+static void pyddd_ipa_write_log(struct pyddd_ipa_t_breakpoint *bp,
+                                PyFrameObject *frame,
+                                long thread_id,
+                                long long now);
+static int pyddd_ipa_eval_simple_condition(struct pyddd_ipa_t_breakpoint *bp,
+                                           PyFrameObject *frame);
+static int pyddd_ipa_snapshot_variable(char **ps,
+                                       const char kind,
+                                       PyObject *key,
+                                       PyObject *value,
+                                       const int maxsize);
 
-static pthread_mutex_t mutex_hit_count = PTHREAD_MUTEX_INITIALIZER;
 static pthread_mutex_t mutex_object_entry = PTHREAD_MUTEX_INITIALIZER;
 
-struct pyddd_ipa_t_volatile_breakpoint pyddd_ipa_volatile_breakpoint={0};
+struct pyddd_ipa_t_volatile_breakpoint
+pyddd_ipa_volatile_breakpoint_table[PYDDD_IPA_MAX_THREAD]={{0}};
+/* Number of enabled volatile breakpoints in all threads */
+volatile int pyddd_ipa_volatile_breakpoint_armed=0;
 struct pyddd_ipa_t_breakpoint
 pyddd_ipa_breakpoint_table[PYDDD_IPA_MAX_BREAKPOINT]={0};
 
+struct pyddd_ipa_t_breakpoint_stats
+pyddd_ipa_breakpoint_stats={PYDDD_IPA_STATS_MAGIC,
+                            PYDDD_IPA_STATS_VERSION,
+                            1};
+
 int pyddd_ipa_breakpoint_top=PYDDD_IPA_BREAKPOINT_PAGE;
 /* Only increased to avoid crash in multi-threads */
 int pyddd_ipa_breakpoint_counter=0;
 
+/*
+ * Breakpoint index, each bucket is a chain of breakpoints which
+ * filename and lineno have same hash value. Element is 1 + rindex of
+ * the first breakpoint in the chain, 0 means empty bucket.
+ *
+ * The hash of filename is saved in the code entry, so the trace
+ * function gets the bucket without reading the filename. The
+ * breakpoints in the same line of the other files are seldom in the
+ * same bucket.
+ */
+int pyddd_ipa_breakpoint_index[PYDDD_IPA_BREAKPOINT_HASH_SIZE]={0};
+
+/* Increased when any breakpoint is inserted, updated or removed */
+volatile unsigned int pyddd_ipa_breakpoint_generation=1;
+
+/*
+ * Filename index, each bucket is a chain of breakpoints which
+ * filename have same hash value, linked by field file_next. The code
+ * entry is built from the breakpoints in its file only, instead of
+ * walking through the whole breakpoint table.
+ */
+int pyddd_ipa_file_index[PYDDD_IPA_FILE_HASH_SIZE]={0};
+
+/*
+ * Code cache, the ways of set n are entries from n * WAYS. The way
+ * replaced in each set is chosen round robin.
+ */
+struct pyddd_ipa_t_code_entry
+pyddd_ipa_code_cache[PYDDD_IPA_CODE_CACHE_SIZE]={{0}};
+static unsigned char pyddd_ipa_code_victim[PYDDD_IPA_CODE_CACHE_SETS]={0};
+
+/*
+ * If it's not 0, line events of the code without any breakpoint are
+ * returned as soon as possible. Clear it only for benchmark.
+ */
+int pyddd_ipa_code_filter=1;
+
+/*
+ * If it's not 0, simple conditions "name OP integer" are evaluated
+ * natively, the others are still evaluated by python.
+ */
+int pyddd_ipa_simple_condition=1;
+
+/*
+ * If it's not 0, the trace function is installed in all the threads
+ * only when any breakpoint, catchpoint, volatile breakpoint or module
+ * autoload is armed. Otherwise it's installed once by init.gdb.
+ */
+int pyddd_ipa_auto_trace=1;
+/* 1 if the trace function is installed by pyddd_ipa_update_tracing */
+int pyddd_ipa_tracing=0;
+static PyInterpreterState *pyddd_ipa_interp=NULL;
+/* Head of thread states when pyddd_ipa_update_tracing is called */
+static PyThreadState *pyddd_ipa_thread_head=NULL;
+
+/*
+ * The new thread state is always inserted at the head, so the head
+ * is changed once any thread is created after
+ * pyddd_ipa_update_tracing. Then install the trampolines in it.
+ */
+#define PYDDD_IPA_CHECK_NEW_THREADS(tstate)                             \
+  do {                                                                  \
+    if (pyddd_ipa_thread_head                                           \
+        && (tstate)->interp->tstate_head != pyddd_ipa_thread_head)      \
+      pyddd_ipa_update_tracing();                                       \
+  } while (0)
+
+/* Messages of logpoints */
+struct pyddd_ipa_t_log pyddd_ipa_log={0, 0, 0, PYDDD_IPA_LOG_SIZE};
+
+#define PYDDD_IPA_CODE_HAS_LINE(entry, lineno)                          \
+  ((entry)->count                                                       \
+   && (lineno) >= (entry)->firstlineno                                  \
+   && (lineno) <= (entry)->lastlineno                                   \
+   && ((lineno) - (entry)->firstlineno >= PYDDD_IPA_CODE_LINE_BITS      \
+       || ((entry)->lines[((lineno) - (entry)->firstlineno) / 32]       \
+           & (1U << (((lineno) - (entry)->firstlineno) % 32)))))
+
+/*
+ * Python objects which are released by GDB, for example, compiled
+ * condition of breakpoint. GDB may call function in any thread
+ * without GIL, so these objects are actually released in the trace
+ * function later.
+ *
+ * Only GDB increases head, and only trace function increases tail.
+ */
+PyObject *pyddd_ipa_release_queue[PYDDD_IPA_RELEASE_QUEUE_SIZE]={0};
+volatile unsigned int pyddd_ipa_release_head=0;
+volatile unsigned int pyddd_ipa_release_tail=0;
+
+/*
+ * Symbols of the executed modules. Only the trace function adds
+ * module, GDB reads them when it need resolve pending breakpoints.
+ */
+struct pyddd_ipa_t_module pyddd_ipa_module_table[PYDDD_IPA_MAX_MODULE]={{0}};
+int pyddd_ipa_module_counter=0;
+
+/* Collect symbols of module if it's not 0, set by GDB */
+int pyddd_ipa_module_autoload=0;
+
+/*
+ * Filters of py-symbol-file, each one is a fnmatch pattern prefixed
+ * with '+' for include or '-' for exclude. Only the modules passed
+ * the filters are collected. NULL means no filter.
+ */
+char **pyddd_ipa_module_filters=NULL;
+
+/*
+ * Filenames of the pending breakpoints in GDB. The trace function
+ * stops at pyddd_ipa_module_addr only when one of them is executed.
+ */
+char **pyddd_ipa_pending_files=NULL;
+
+/* Retired lists are freed in the next load, same as catch patterns */
+static char **retired_module_filters=NULL;
+static char **retired_pending_files=NULL;
+
+/* The module just added when stop at pyddd_ipa_module_addr */
+struct pyddd_ipa_t_module *pyddd_ipa_current_module=NULL;
+
+/*
+ * GDB writes data into this buffer by one memory write, then calls
+ * function of python-ipa to handle them together.
+ */
+char pyddd_ipa_data_buffer[PYDDD_IPA_DATA_BUFFER_SIZE]
+__attribute__ ((aligned (8)))={0};
+
 /* Set when any internal python breakpoint is hit */
 int pyddd_ipa_hit_flag=0;
 
-char * pyddd_ipa_python_catch_exceptions=NULL;
-char * pyddd_ipa_python_catch_functions=NULL;
+struct pyddd_ipa_t_trace_counters pyddd_ipa_trace_counters={{0}};
+
+/*
+ * Profile table and its index, element of index is 1 + index of the
+ * entry, 0 means empty. Only the profile function changes them.
+ */
+struct pyddd_ipa_t_profile pyddd_ipa_profile={0};
+int pyddd_ipa_profile_index[PYDDD_IPA_PROFILE_HASH_SIZE]={0};
+static PyCodeObject *pyddd_ipa_profile_codes[PYDDD_IPA_PROFILE_SIZE]={0};
+static struct pyddd_ipa_t_profile_thread
+pyddd_ipa_profile_threads[PYDDD_IPA_MAX_THREAD]={{0}};
+
+/*
+ * Sampled stacks and its index, element of index is 1 + index of the
+ * stack, 0 means empty. The names of frames are in the profile table.
+ */
+struct pyddd_ipa_t_sample pyddd_ipa_sample={0};
+static int pyddd_ipa_sample_index[PYDDD_IPA_SAMPLE_HASH_SIZE]={0};
+#if !defined(_WIN32)
+static volatile sig_atomic_t pyddd_ipa_sample_pending=0;
+static int pyddd_ipa_sample_running=0;
+static struct sigaction pyddd_ipa_sample_oldaction;
+#endif
+
+#define PYDDD_IPA_LINENO(frame)                                         \
+  (pyddd_ipa_trace_counters.lineno_lookups ++,                          \
+   (*FPyFrame_GetLineNumber)(frame))
+#define PYDDD_IPA_FILENAME(co_filename)                                 \
+  (pyddd_ipa_trace_counters.filename_lookups ++,                        \
+   (*FPyString_AsString)(co_filename))
+
+/*
+ * Compiled patterns of py-catch, NULL means no catchpoint. The
+ * patterns replaced by the last load are retired, they're freed in
+ * the next load, because some thread may still use them.
+ */
+struct pyddd_ipa_t_catch_patterns *pyddd_ipa_catch_exceptions=NULL;
+struct pyddd_ipa_t_catch_patterns *pyddd_ipa_catch_functions=NULL;
+static struct pyddd_ipa_t_catch_patterns *retired_catch_exceptions=NULL;
+static struct pyddd_ipa_t_catch_patterns *retired_catch_functions=NULL;
+
+/* Increased when the patterns of py-catch call are changed */
+volatile unsigned int pyddd_ipa_catch_generation=1;
+
+/*
+ * Strings of breakpoints replaced or removed since the last load are
+ * retired, same as the patterns of py-catch, they're freed in the
+ * next load.
+ */
+static char **retired_breakpoint_strings=NULL;
+static int retired_breakpoint_strings_count=0;
+static int retired_breakpoint_strings_size=0;
 
 /* Use function pointer, so python-ipa.dll need not bind to special
    python version */
 char* (*FPyString_AsString)(PyObject *o)=NULL;
 int (*FPyFrame_GetLineNumber)(PyFrameObject *frame)=NULL;
 void (*FPy_DecRef)(PyObject *)=NULL;
+void (*FPy_IncRef)(PyObject *)=NULL;
 int (*FPyObject_IsTrue)(PyObject *)=NULL;
 Py_ssize_t (*FPyString_Size)(PyObject *string)=NULL;
 void (*FPyEval_SetTrace)(Py_tracefunc func, PyObject *arg)=NULL;
 PyThreadState* (*FPyThreadState_Get)(void)=NULL;
+PyThreadState* (*FPyGILState_GetThisThreadState)(void)=NULL;
 PyObject* (*FPyObject_Str)(PyObject *o)=NULL;
 PyObject* (*FPyObject_Repr)(PyObject *o)=NULL;
 PyObject* (*FPyTuple_GetItem)(PyObject *p, Py_ssize_t pos)=NULL;
@@ -86,6 +334,13 @@ PyObject* (*FPyIter_Next)(PyObject *o)=NULL;
 void (*FPyErr_Clear)(void)=NULL;
 void (*FPyErr_PrintEx)(int set_sys_last_vars)=NULL;
 PyObject* (*FPyErr_Occurred)(void)=NULL;
+PyThreadState* (*FPyInterpreterState_ThreadHead)
+     (PyInterpreterState *interp)=NULL;
+PyThreadState* (*FPyThreadState_Next)(PyThreadState *tstate)=NULL;
+int (*FPy_AddPendingCall)(int (*func)(void *), void *arg)=NULL;
+long (*FPyLong_AsLongAndOverflow)(PyObject *o, int *overflow)=NULL;
+void (*FPyFrame_FastToLocals)(PyFrameObject *frame)=NULL;
+PyObject* (*FPyModule_GetDict)(PyObject *module)=NULL;
 PyObject* (*FPy_CompileStringFlags)(const char *str,
                                     const char *filename,
                                     int start,
@@ -100,6 +355,12 @@ pyddd_ipa_version(void)
   return PYDDD_IPA_VERSION;
 }
 
+void
+pyddd_ipa_reset_trace_counters(void)
+{
+  memset(&pyddd_ipa_trace_counters, 0, sizeof(pyddd_ipa_trace_counters));
+}
+
 /* Rename varialbe in breakpoint context to avoid name conflict */
 #define frame pyddd_ipa_current_frame
 #define thread pyddd_ipa_current_thread
@@ -116,18 +377,41 @@ pyddd_ipa_trace_trampoline(PyObject *self,
                            PyObject *arg)
 {
   register long thread = frame->f_tstate->thread_id;
-  register int _lineno = (*FPyFrame_GetLineNumber)(frame);
+  register int _lineno;
   PyObject *co_filename = frame->f_code->co_filename;
-  register char *_filename = (*FPyString_AsString)(co_filename);
+  /* Only set before stop and only read by GDB, volatile so that it's
+     not optimized out */
+  char * volatile _filename __attribute__ ((unused));
+
+  pyddd_ipa_trace_counters.events[what & (PYDDD_IPA_TRACE_EVENTS - 1)] ++;
+  if (pyddd_ipa_release_tail != pyddd_ipa_release_head)
+    pyddd_ipa_release_pending_objects();
+  PYDDD_IPA_CHECK_NEW_THREADS(frame->f_tstate);
 
   /* py-catch call:
-     Search name within pyddd_ipa_python_catch_functions.
+     Match name with pyddd_ipa_catch_functions, the result is cached
+     in the code entry until the patterns are changed.
      */
   if (what == PyTrace_CALL) {
-    char *name=(*FPyString_AsString)(frame->f_code->co_name);
-    if (pyddd_ipa_python_catch_functions \
-        && find_name_in_list(name, pyddd_ipa_python_catch_functions)) {
-      pyddd_ipa_volatile_breakpoint.enabled = 0;
+    register unsigned int generation = pyddd_ipa_catch_generation;
+    register struct pyddd_ipa_t_catch_patterns *patterns;
+    register struct pyddd_ipa_t_code_entry *entry;
+    char *name;
+
+    patterns = pyddd_ipa_catch_functions;
+    if (!patterns)
+      return 0;
+    entry = pyddd_ipa_lookup_code(frame->f_code);
+    if (entry->catch_generation != generation) {
+      name = (*FPyString_AsString)(frame->f_code->co_name);
+      entry->catch_call = pyddd_ipa_match_catch_patterns(patterns, name);
+      entry->catch_generation = generation;
+    }
+    if (entry->catch_call) {
+      name = (*FPyString_AsString)(frame->f_code->co_name);
+      _lineno = PYDDD_IPA_LINENO(frame);
+      _filename = PYDDD_IPA_FILENAME(co_filename);
+      pyddd_ipa_clear_volatile_breakpoint(thread);
       asm("pyddd_ipa_catch_call_addr:");
       pyddd_ipa_hit_flag ++;
     };
@@ -135,15 +419,16 @@ pyddd_ipa_trace_trampoline(PyObject *self,
   }
 
   /* py-catch exception:
-     Search exception name within pyddd_ipa_python_catch_exceptions.
+     Match exception name with pyddd_ipa_catch_exceptions.
      */
   else if (what == PyTrace_EXCEPTION) {
     char *excname=(char*)((PyTypeObject*)
                           ((*FPyTuple_GetItem)(arg, 0)))->tp_name;
-    if (pyddd_ipa_python_catch_exceptions
-        && find_name_in_list(excname,
-                             pyddd_ipa_python_catch_exceptions)) {
-      pyddd_ipa_volatile_breakpoint.enabled = 0;
+    if (pyddd_ipa_match_catch_patterns(pyddd_ipa_catch_exceptions,
+                                       excname)) {
+      _lineno = PYDDD_IPA_LINENO(frame);
+      _filename = PYDDD_IPA_FILENAME(co_filename);
+      pyddd_ipa_clear_volatile_breakpoint(thread);
       asm("pyddd_ipa_catch_exception_addr:");
       pyddd_ipa_hit_flag ++;
     };
@@ -151,13 +436,31 @@ pyddd_ipa_trace_trampoline(PyObject *self,
   }
 
   if (what == PyTrace_LINE) {
+    register struct pyddd_ipa_t_code_entry *entry=NULL;
+    register struct pyddd_ipa_t_breakpoint *bp;
+    register struct pyddd_ipa_t_breakpoint_stat *st;
+    register int rindex;
+    register int k;
+    unsigned int stopped = 0;   /* Generation when stopped */
+
+    /* Return as soon as possible if there is no any breakpoint in
+       this code, and no volatile breakpoint. */
+    if (pyddd_ipa_code_filter) {
+      entry = pyddd_ipa_lookup_code(frame->f_code);
+      if (!entry->count && !pyddd_ipa_volatile_breakpoint_armed)
+        return 0;
+    }
+    /* f_lineno is always valid in line event, the filename is only
+       got when it stops. */
+    _lineno = frame->f_lineno;
+    pyddd_ipa_trace_counters.line_candidates ++;
 
-    /* Check volatile breakpoint */
-    {
+    /* Check volatile breakpoint of this thread */
+    if (pyddd_ipa_volatile_breakpoint_armed) {
       register struct pyddd_ipa_t_volatile_breakpoint *vp;
-      vp = &pyddd_ipa_volatile_breakpoint;
-      if (vp->enabled
-          && vp->thread_id == thread
+      vp = pyddd_ipa_find_volatile_breakpoint(thread);
+      if (vp
+          && vp->enabled
           && (!vp->lineno
               || (vp->lineno>0 && vp->lineno == _lineno)
               || (vp->lineno<0 && -vp->lineno<_lineno))
@@ -165,74 +468,83 @@ pyddd_ipa_trace_trampoline(PyObject *self,
           && (!vp->co_filename || vp->co_filename == co_filename)) {
         vp->enabled --;
         if (!vp->enabled) {
+          __sync_sub_and_fetch(&pyddd_ipa_volatile_breakpoint_armed, 1);
+          _filename = PYDDD_IPA_FILENAME(co_filename);
           asm("pyddd_ipa_volatile_breakpoint_addr:");
           pyddd_ipa_hit_flag ++;
+          if (pyddd_ipa_auto_trace)
+            pyddd_ipa_update_tracing();
           return 0;
         }
       }
     }
 
     /* Check normal breakpoints which at filename:lineno exactly. */
-    if (_filename) {
-      register struct pyddd_ipa_t_breakpoint *bp;
-      int filename_size=0;
-      int rindex;
-
-      bp = pyddd_ipa_breakpoint_table;
-      for (rindex = 0;
-           rindex < pyddd_ipa_breakpoint_counter;
-           rindex++, bp++) {
-
-        /* Ignore deleted bpnum, disabled bpnum, not lineno, not
-           thread */
-        if (!bp->bpnum
-            || !bp->enabled
-            || (bp->thread_id && bp->thread_id != thread)
-            || _lineno != bp->lineno) {
-          if (bp->enabled < 0) ++(bp->enabled);
-          continue;
-        }
-        if (bp->enabled < 0) ++(bp->enabled);
-
-        /* Good preformace, but need more complex mechanism */
-        if (bp->co_filename && bp->co_filename != co_filename)
-          continue;
-
-        /* First compare the filename size so that we can quickly
-           exclude most of files. */
-        if (!filename_size)
-          filename_size = strlen(_filename);
-        if (filename_size != bp->filename_size
-            || strcmp(bp->filename, _filename))
+    if (entry && !PYDDD_IPA_CODE_HAS_LINE(entry, _lineno))
+      return 0;
+
+    /* Only walk through the breakpoints in the same bucket, the hash
+       of filename is got from the code entry */
+    if (!entry)
+      entry = pyddd_ipa_lookup_code(frame->f_code);
+    for (rindex = pyddd_ipa_breakpoint_index \
+           [PYDDD_IPA_BREAKPOINT_HASH(entry->file_hash, _lineno)];
+         rindex;
+         rindex = bp->next) {
+      bp = pyddd_ipa_breakpoint_table + rindex - 1;
+      st = pyddd_ipa_breakpoint_stats.stats + rindex - 1;
+
+      /* Ignore deleted bpnum, disabled bpnum, not lineno, not
+         thread. Only stop once, but the tracepoints after it are
+         still counted. */
+      if (!bp->bpnum
+          || !st->enabled
+          || (stopped && !bp->tracepoint)
+          || (bp->thread_id && bp->thread_id != thread)
+          || _lineno != bp->lineno)
+        continue;
+
+      /* Filename object of this code is resolved only once, after
+         that compare filename object only. */
+      if (!entry->bound || bp->co_filename != entry->bound)
+        continue;
+
+      /* Take ignore_count into account, hit_count is total hits,
+         it's never reset in the trace function. Generation only
+         need be changed, so it's not increased atomically. */
+      k = __sync_add_and_fetch(&st->hit_count, 1);
+      pyddd_ipa_breakpoint_stats.generation ++;
+      if (k % (bp->ignore_count ? bp->ignore_count : 1))
+        continue;
+
+      /* Eval breakpoint condition, simple condition is evaluated
+         natively, fallback to python if it can't be done. */
+      if (bp->condition) {
+        PyObject *result;
+        k = -1;
+        if (bp->cond_op && pyddd_ipa_simple_condition)
+          k = pyddd_ipa_eval_simple_condition(bp, frame);
+        if (!k)
           continue;
 
-        pthread_mutex_lock (&mutex_hit_count);
-        bp->hit_count ++;
-        /* Take ignore_count into account */
-        if (bp->ignore_count) {
-          if (bp->hit_count == bp->ignore_count)
-            bp->hit_count = 0;
-          else {
-            pthread_mutex_unlock (&mutex_hit_count);
-            continue;
-          }
-        }
-        pthread_mutex_unlock (&mutex_hit_count);
-
-        /* Eval breakpoint condition */
-        if (bp->condition) {
-          PyObject *exprobj;
-          PyObject *result;
-
-          /* Use empty filename to avoid obj added to object entry table */
-          exprobj = (*FPy_CompileStringFlags)(bp->condition,
-                                              "",
-                                              Py_eval_input,
-                                              NULL
-                                              );
-          if (!exprobj) {
-            (*FPyErr_Clear)();
-            continue;
+        if (k < 0) {
+          /* Compile condition only once, it's released when this
+             breakpoint is updated or removed. */
+          if (!bp->co_condition) {
+            if (bp->condition_error)
+              continue;
+            /* Use empty filename to avoid obj added to object entry
+               table */
+            bp->co_condition = (*FPy_CompileStringFlags)(bp->condition,
+                                                         "",
+                                                         Py_eval_input,
+                                                         NULL
+                                                         );
+            if (!bp->co_condition) {
+              (*FPyErr_Clear)();
+              bp->condition_error = 1;
+              continue;
+            }
           }
 
           /* Clear flag use_tracing in current PyThreadState to avoid
@@ -240,12 +552,16 @@ pyddd_ipa_trace_trampoline(PyObject *self,
              includes some call of c function, and there is some
              breakpoint hit, I don't know what will happen.
           */
+          /* Local variables of function are only in the fast locals,
+             same as the simple condition reads them */
+          if ((frame->f_code->co_flags & CO_OPTIMIZED)
+              && FPyFrame_FastToLocals)
+            (*FPyFrame_FastToLocals)(frame);
           frame->f_tstate->use_tracing = 0;
-          result = (*FPyEval_EvalCode)((PyCodeObject*)exprobj,
+          result = (*FPyEval_EvalCode)((PyCodeObject*)bp->co_condition,
                                        frame->f_globals,
                                        frame->f_locals);
           frame->f_tstate->use_tracing = 1;
-          (*FPy_DecRef)(exprobj);
 
           if (result == NULL) {
             (*FPyErr_Clear)();
@@ -258,90 +574,1644 @@ pyddd_ipa_trace_trampoline(PyObject *self,
           }
           (*FPy_DecRef)(result);
         }
+      }
+
+      /* Tracepoint only counts the hit, it never stops */
+      if (bp->tracepoint) {
+        __sync_add_and_fetch(&st->trace_count, 1);
+        if (bp->tracepoint >= PYDDD_IPA_TRACEPOINT_TIME) {
+          st->last_time = pyddd_ipa_realtime_clock();
+          if (!st->first_time)
+            st->first_time = st->last_time;
+        }
+        if (bp->tracepoint == PYDDD_IPA_TRACEPOINT_LOG)
+          pyddd_ipa_write_log(bp, frame, thread, st->last_time);
+        continue;
+      }
 
-        /* Here is c breakpoint in GDB */
-        pyddd_ipa_volatile_breakpoint.enabled = 0;
-        asm("pyddd_ipa_breakpoint_addr:");
-        pyddd_ipa_hit_flag ++;
+      /* Enable once or count times */
+      while ((k = st->enabled) < 0
+             && !__sync_bool_compare_and_swap(&st->enabled, k, k + 1));
+      if (k < 0)
+        pyddd_ipa_breakpoint_stats.generation ++;
+
+      /* Here is c breakpoint in GDB */
+      pyddd_ipa_clear_volatile_breakpoint(thread);
+      _filename = PYDDD_IPA_FILENAME(co_filename);
+      stopped = pyddd_ipa_breakpoint_generation;
+      asm("pyddd_ipa_breakpoint_addr:");
+      pyddd_ipa_hit_flag ++;
+      /* The chain may be changed in GDB */
+      if (stopped != pyddd_ipa_breakpoint_generation)
         break;
+    }
+
+    /* Nothing may be armed after enabled once breakpoint or volatile
+       breakpoint is stopped */
+    if (stopped && pyddd_ipa_auto_trace)
+      pyddd_ipa_update_tracing();
+  }
+  return 0;
+}
+
+/*
+ * Collect symbols when module is executed, the module code always
+ * uses globals as locals. Stop only if some pending breakpoint may be
+ * resolved in this module. It's never inlined, because the label
+ * must be unique.
+ */
+static void __attribute__ ((noinline))
+pyddd_ipa_autoload_module(PyFrameObject *frame)
+{
+  register int interest;
+
+  if (!(frame->f_code->co_flags & CO_NEWLOCALS)
+      && frame->f_locals == frame->f_globals
+      && (interest = pyddd_ipa_check_module(frame->f_code)) != 0) {
+    pyddd_ipa_current_module = pyddd_ipa_add_module(frame->f_code);
+    if (pyddd_ipa_current_module && interest > 1) {
+      asm("pyddd_ipa_module_addr:");
+      pyddd_ipa_hit_flag ++;
+    }
+  }
+}
+
+/*
+ * Profile function for module autoload, installed by
+ * pyddd_ipa_update_tracing. The profile function gets no line event,
+ * so the script runs at full speed when nothing else is armed.
+ */
+int
+pyddd_ipa_module_trampoline(PyObject *self,
+                            PyFrameObject *frame,
+                            int what,
+                            PyObject *arg)
+{
+  PYDDD_IPA_CHECK_NEW_THREADS(frame->f_tstate);
+  if (what == PyTrace_CALL && pyddd_ipa_module_autoload)
+    pyddd_ipa_autoload_module(frame);
+  return 0;
+}
+
+/*
+ * Profile function, installed by pyddd_ipa_profile_start. It only
+ * records calls and returns of python functions, the time between
+ * them is added to the entry of code object. The time of callees is
+ * subtracted from self time by the call stack of each thread.
+ */
+int
+pyddd_ipa_profile_trampoline(PyObject *self,
+                             PyFrameObject *frame,
+                             int what,
+                             PyObject *arg)
+{
+  register struct pyddd_ipa_t_profile_thread *pt;
+  register struct pyddd_ipa_t_profile_frame *pf;
+  register struct pyddd_ipa_t_profile_entry *pe;
+  long long now;
+  long long elapsed;
+
+  if (what != PyTrace_CALL && what != PyTrace_RETURN)
+    return 0;
+  /* It replaces pyddd_ipa_module_trampoline while profiling */
+  if (what == PyTrace_CALL && pyddd_ipa_module_autoload)
+    pyddd_ipa_autoload_module(frame);
+  pt = pyddd_ipa_find_profile_thread(frame->f_tstate->thread_id,
+                                     what == PyTrace_CALL);
+  if (!pt) {
+    if (what == PyTrace_CALL)
+      pyddd_ipa_profile.dropped ++;
+    return 0;
+  }
+  now = pyddd_ipa_profile_clock();
+
+  if (what == PyTrace_CALL) {
+    if (pt->depth < PYDDD_IPA_PROFILE_DEPTH) {
+      pf = pt->frames + pt->depth;
+      pf->index = pyddd_ipa_profile_lookup(frame->f_code);
+      pf->start = now;
+      pf->children = 0;
+      if (pf->index < 0)
+        pyddd_ipa_profile.dropped ++;
+      else {
+        pe = pyddd_ipa_profile.entries + pf->index;
+        pe->call_count ++;
+        pe->recursion ++;
+      }
+    }
+    else
+      pyddd_ipa_profile.dropped ++;
+    pt->depth ++;
+  }
+
+  /* The functions called before profile started have no call event */
+  else if (pt->depth > 0) {
+    pt->depth --;
+    if (pt->depth < PYDDD_IPA_PROFILE_DEPTH) {
+      pf = pt->frames + pt->depth;
+      elapsed = now - pf->start;
+      if (pf->index >= 0) {
+        pe = pyddd_ipa_profile.entries + pf->index;
+        /* Only the outermost call of recursion adds total time */
+        if (!--pe->recursion)
+          pe->total_time += elapsed;
+        pe->self_time += elapsed - pf->children;
       }
+      if (pt->depth > 0)
+        pt->frames[pt->depth - 1].children += elapsed;
+    }
+    /* Free this entry for the other threads */
+    if (!pt->depth)
+      pt->thread_id = 0;
+  }
+  return 0;
+}
+
+#undef frame
+#undef thread
+#undef _filename
+#undef _lineno
+#undef bp
+#undef name
+#undef excname
+
+/*
+ * Monotonic time in nanoseconds. There is no clock_gettime in mingw32,
+ * so QueryPerformanceCounter is used in Windows.
+ */
+static long long
+pyddd_ipa_profile_clock(void)
+{
+#if defined(_WIN32)
+  static LARGE_INTEGER frequency;
+  LARGE_INTEGER counter;
+  if (!frequency.QuadPart)
+    QueryPerformanceFrequency(&frequency);
+  QueryPerformanceCounter(&counter);
+  return (long long)(counter.QuadPart / frequency.QuadPart) * 1000000000LL
+    + (long long)(counter.QuadPart % frequency.QuadPart) * 1000000000LL
+    / frequency.QuadPart;
+#else
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (long long)ts.tv_sec * 1000000000LL + ts.tv_nsec;
+#endif
+}
+
+/*
+ * Realtime in nanoseconds since the Epoch. In Windows FILETIME is in
+ * 100 nanoseconds since 1601-01-01.
+ */
+static long long
+pyddd_ipa_realtime_clock(void)
+{
+#if defined(_WIN32)
+  FILETIME ft;
+  ULARGE_INTEGER t;
+  GetSystemTimeAsFileTime(&ft);
+  t.LowPart = ft.dwLowDateTime;
+  t.HighPart = ft.dwHighDateTime;
+  return (long long)(t.QuadPart - 116444736000000000ULL) * 100LL;
+#else
+  struct timespec ts;
+  clock_gettime(CLOCK_REALTIME, &ts);
+  return (long long)ts.tv_sec * 1000000000LL + ts.tv_nsec;
+#endif
+}
+
+/*
+ * Return call stack of thread, create one if create is not 0. Return
+ * NULL if not found or there is no free entry.
+ */
+static struct pyddd_ipa_t_profile_thread *
+pyddd_ipa_find_profile_thread(const long thread_id, const int create)
+{
+  register struct pyddd_ipa_t_profile_thread *pt;
+  struct pyddd_ipa_t_profile_thread *free_entry=NULL;
+  register int i, n;
+
+  /* Entries are freed when the stack is empty, so always walk the
+     whole table if it's not in the hash slot */
+  i = PYDDD_IPA_THREAD_HASH(thread_id);
+  for (n = PYDDD_IPA_MAX_THREAD; n; n--) {
+    pt = pyddd_ipa_profile_threads + i;
+    if (pt->thread_id == thread_id)
+      return pt;
+    if (!pt->thread_id && !free_entry)
+      free_entry = pt;
+    i = (i + 1) & (PYDDD_IPA_MAX_THREAD - 1);
+  }
+  if (free_entry && create) {
+    free_entry->thread_id = thread_id;
+    free_entry->depth = 0;
+    return free_entry;
+  }
+  return NULL;
+}
+
+/*
+ * Return index of profile entry of code, add one if not found. The
+ * entry holds a reference of code, so the address isn't reused by
+ * the other code object. Return -1 if the table is full.
+ */
+static int
+pyddd_ipa_profile_lookup(PyCodeObject *code)
+{
+  register struct pyddd_ipa_t_profile_entry *pe;
+  register int i, k;
+  const char *s;
+  int n;
+
+  for (i = PYDDD_IPA_PROFILE_HASH(code);
+       (k = pyddd_ipa_profile_index[i]) != 0;
+       i = (i + 1) & (PYDDD_IPA_PROFILE_HASH_SIZE - 1))
+    if (pyddd_ipa_profile_codes[k - 1] == code)
+      return k - 1;
+
+  k = pyddd_ipa_profile.count;
+  if (k >= PYDDD_IPA_PROFILE_SIZE)
+    return -1;
+  pe = pyddd_ipa_profile.entries + k;
+  memset(pe, 0, sizeof(*pe));
+  pe->firstlineno = code->co_firstlineno;
+  s = (*FPyString_AsString)(code->co_name);
+  if (s)
+    strncpy(pe->name, s, PYDDD_IPA_PROFILE_NAME_SIZE - 1);
+  else
+    (*FPyErr_Clear)();
+  s = (*FPyString_AsString)(code->co_filename);
+  if (s) {
+    n = strlen(s);
+    if (n >= PYDDD_IPA_PROFILE_FILENAME_SIZE)
+      s += n - PYDDD_IPA_PROFILE_FILENAME_SIZE + 1;
+    strcpy(pe->filename, s);
+  }
+  else
+    (*FPyErr_Clear)();
+
+  (*FPy_IncRef)((PyObject*)code);
+  pyddd_ipa_profile_codes[k] = code;
+  __sync_synchronize();
+  pyddd_ipa_profile_index[i] = k + 1;
+  pyddd_ipa_profile.count = k + 1;
+  return k;
+}
+
+/*
+ * Set or clear profile function in all the thread states, it's same
+ * as PyEval_SetProfile, but PyEval_SetProfile only changes the
+ * current thread. Return -1 if there is no python thread state. The
+ * profile function installed by the script itself, for example
+ * cProfile, is never replaced, so nothing is set and -2 is returned
+ * if any thread has one.
+ */
+static int
+pyddd_ipa_set_profile(Py_tracefunc func)
+{
+  PyThreadState *tstate=pyddd_ipa_this_thread_state();
+  register PyThreadState *p;
+
+  if (!tstate
+      || !FPyInterpreterState_ThreadHead
+      || !FPyThreadState_Next)
+    return -1;
+  if (func)
+    for (p = (*FPyInterpreterState_ThreadHead)(tstate->interp);
+         p;
+         p = (*FPyThreadState_Next)(p))
+      if (p->c_profilefunc
+          && p->c_profilefunc != pyddd_ipa_profile_trampoline
+          && p->c_profilefunc != pyddd_ipa_module_trampoline)
+        return -2;
+  for (p = (*FPyInterpreterState_ThreadHead)(tstate->interp);
+       p;
+       p = (*FPyThreadState_Next)(p)) {
+    if (func) {
+      p->c_profilefunc = func;
+      p->use_tracing = 1;
+    }
+    else if (p->c_profilefunc == pyddd_ipa_profile_trampoline) {
+      p->c_profilefunc = pyddd_ipa_module_autoload
+        ? pyddd_ipa_module_trampoline
+        : NULL;
+      p->use_tracing = p->c_tracefunc || p->c_profilefunc;
+    }
+  }
+  return 0;
+}
+
+/* Return 1 if anything requires the trace function */
+static int
+pyddd_ipa_tracing_armed(void)
+{
+  register int rindex;
+
+  if (pyddd_ipa_volatile_breakpoint_armed > 0
+      || pyddd_ipa_catch_functions
+      || pyddd_ipa_catch_exceptions)
+    return 1;
+  for (rindex = 0; rindex < pyddd_ipa_breakpoint_counter; rindex++)
+    if (pyddd_ipa_breakpoint_table[rindex].bpnum
+        && pyddd_ipa_breakpoint_stats.stats[rindex].enabled)
+      return 1;
+  return 0;
+}
+
+/*
+ * Install or remove the trace function in all the thread states by
+ * the armed state, or always if pyddd_ipa_auto_trace is 0. Return 1
+ * if it's installed, 0 if removed, -1 if there is no python thread
+ * state. It's called when breakpoints, catchpoints or volatile
+ * breakpoints are changed, and after the trace function stops. GDB
+ * calls it after module autoload is changed. Module autoload only
+ * needs call events, so it's served by the profile function
+ * pyddd_ipa_module_trampoline instead.
+ *
+ * The fields of thread state are changed directly, because
+ * PyEval_SetTrace only changes the current thread. The counter of
+ * tracing in the interpreter is kept by the first PyEval_SetTrace in
+ * init.gdb, so line events are still checked. The trace function
+ * and profile function installed by the script itself are never
+ * touched. The head of thread states is saved, so both trampolines
+ * call it again once any thread is created.
+ */
+int
+pyddd_ipa_update_tracing(void)
+{
+  PyThreadState *tstate=NULL;
+  register PyThreadState *p;
+  register int armed = !pyddd_ipa_auto_trace || pyddd_ipa_tracing_armed();
+  register int autoload = pyddd_ipa_module_autoload;
+
+  if (FPyGILState_GetThisThreadState)
+    tstate = (*FPyGILState_GetThisThreadState)();
+  if (tstate)
+    pyddd_ipa_interp = tstate->interp;
+  if (!pyddd_ipa_interp
+      || !FPyInterpreterState_ThreadHead
+      || !FPyThreadState_Next)
+    return -1;
+
+  pyddd_ipa_thread_head = (*FPyInterpreterState_ThreadHead)(pyddd_ipa_interp);
+  for (p = pyddd_ipa_thread_head; p; p = (*FPyThreadState_Next)(p)) {
+    if (armed && !p->c_tracefunc) {
+      p->c_tracefunc = pyddd_ipa_trace_trampoline;
+      p->c_traceobj = NULL;
+    }
+    else if (!armed && p->c_tracefunc == pyddd_ipa_trace_trampoline)
+      p->c_tracefunc = NULL;
+    if (autoload && !p->c_profilefunc) {
+      p->c_profilefunc = pyddd_ipa_module_trampoline;
+      p->c_profileobj = NULL;
+    }
+    else if (!autoload && p->c_profilefunc == pyddd_ipa_module_trampoline)
+      p->c_profilefunc = NULL;
+    p->use_tracing = p->c_tracefunc || p->c_profilefunc;
+  }
+  pyddd_ipa_tracing = armed;
+  return armed;
+}
+
+/*
+ * Write filenames of the modules in sys.modules to the data buffer,
+ * each one ends with '\0', "*.pyc" and "*.pyo" are written as "*.py".
+ * The modules without python source, and the ones ignored by module
+ * filters are skipped. It stops when the buffer is full. Return size
+ * of data in the buffer.
+ */
+static int
+pyddd_ipa_list_modules(PyObject *modules)
+{
+  register char *s = pyddd_ipa_data_buffer;
+  char *end = pyddd_ipa_data_buffer + PYDDD_IPA_DATA_BUFFER_SIZE;
+  PyObject *key, *value, *dict;
+  Py_ssize_t pos = 0;
+  const char *filename;
+  size_t n;
+
+  while ((*FPyDict_Next)(modules, &pos, &key, &value)) {
+    /* None is put in sys.modules by failed relative import */
+    dict = (*FPyModule_GetDict)(value);
+    if (dict)
+      value = (*FPyDict_GetItemString)(dict, "__file__");
+    filename = dict && value ? (*FPyString_AsString)(value) : NULL;
+    if (!filename) {
+      (*FPyErr_Clear)();
+      continue;
+    }
+
+    n = strlen(filename);
+    if (n > 4 && (!strcmp(filename + n - 4, ".pyc")
+                  || !strcmp(filename + n - 4, ".pyo")))
+      n --;
+    if (n < 3 || strncmp(filename + n - 3, ".py", 3))
+      continue;
+    if (s + n + 1 > end)
+      break;
+    memcpy(s, filename, n);
+    s[n] = '\0';
+    if (pyddd_ipa_check_filename(s))
+      s += n + 1;
+  }
+  return s - pyddd_ipa_data_buffer;
+}
+
+/* Set by pyddd_ipa_attach, cleared when the pending call runs */
+int pyddd_ipa_attach_pending=0;
+/* Size of filenames written by the pending call in the data buffer */
+int pyddd_ipa_attach_size=0;
+
+/*
+ * Pending call scheduled by pyddd_ipa_attach. It runs in the main
+ * thread with GIL held, so PyEval_SetTrace is safe here. Then GDB
+ * stops at pyddd_ipa_attach_addr to read filenames of the imported
+ * modules, and loads their symbols by one pass, because the imported
+ * modules will never be executed again.
+ */
+static int
+pyddd_ipa_attach_callback(void *arg)
+{
+  PyThreadState *tstate=(*FPyThreadState_Get)();
+
+  pyddd_ipa_attach_pending = 0;
+  /* The trampoline may be installed by pyddd_ipa_update_tracing
+     before, clear it so that PyEval_SetTrace raises the counter of
+     tracing. The other trace function has raised it already. */
+  if (tstate->c_tracefunc == pyddd_ipa_trace_trampoline)
+    tstate->c_tracefunc = NULL;
+  if (!tstate->c_tracefunc)
+    (*FPyEval_SetTrace)(pyddd_ipa_trace_trampoline, NULL);
+  pyddd_ipa_update_tracing();
+
+  pyddd_ipa_attach_size = pyddd_ipa_list_modules(tstate->interp->modules);
+  asm("pyddd_ipa_attach_addr:");
+  return 0;
+}
+
+/*
+ * Called by GDB after python-ipa is loaded into a running python
+ * process. The process may be stopped anywhere, even GIL isn't held
+ * by any thread, so it only schedules a pending call, the rest of
+ * work is done when python executes the next bytecode in the main
+ * thread. Return 0 if success, -1 if failed.
+ */
+int
+pyddd_ipa_attach(void)
+{
+  if (!FPy_AddPendingCall || !FPyModule_GetDict)
+    return -1;
+  if (pyddd_ipa_attach_pending)
+    return 0;
+  pyddd_ipa_attach_pending = 1;
+  if ((*FPy_AddPendingCall)(pyddd_ipa_attach_callback, NULL)) {
+    pyddd_ipa_attach_pending = 0;
+    return -1;
+  }
+  return 0;
+}
+
+/*
+ * Start and stop profile in all the threads, return 0 if success, -1
+ * if there is no python thread state, -2 if the script has installed
+ * its own profile function. The call stacks and the active calls of
+ * all the entries are cleared when profile starts, because the
+ * functions in the stacks have no return event after profile stops.
+ * The profile data is kept until reset.
+ */
+int
+pyddd_ipa_profile_start(void)
+{
+  register int i;
+  memset(pyddd_ipa_profile_threads, 0, sizeof(pyddd_ipa_profile_threads));
+  for (i = 0; i < pyddd_ipa_profile.count; i++)
+    pyddd_ipa_profile.entries[i].recursion = 0;
+  return pyddd_ipa_set_profile(pyddd_ipa_profile_trampoline);
+}
+
+int
+pyddd_ipa_profile_stop(void)
+{
+  return pyddd_ipa_set_profile(NULL);
+}
+
+/*
+ * Add one python stack to the sample table, the outermost frame is
+ * the first one in frames. Return index of the stack, -1 if the table
+ * is full.
+ */
+static int
+pyddd_ipa_sample_add_stack(const int *frames, const int depth)
+{
+  register struct pyddd_ipa_t_sample_stack *ps;
+  register unsigned int hash=0;
+  register int i, k;
+
+  for (i = 0; i < depth; i++)
+    hash = hash * 31 + frames[i];
+  for (i = hash & (PYDDD_IPA_SAMPLE_HASH_SIZE - 1);
+       (k = pyddd_ipa_sample_index[i]) != 0;
+       i = (i + 1) & (PYDDD_IPA_SAMPLE_HASH_SIZE - 1)) {
+    ps = pyddd_ipa_sample.stacks + k - 1;
+    if (ps->depth == depth
+        && !memcmp(ps->frames, frames, depth * sizeof(int))) {
+      ps->count ++;
+      return k - 1;
+    }
+  }
+
+  k = pyddd_ipa_sample.count;
+  if (k >= PYDDD_IPA_SAMPLE_SIZE)
+    return -1;
+  ps = pyddd_ipa_sample.stacks + k;
+  ps->count = 1;
+  ps->depth = depth;
+  memcpy(ps->frames, frames, depth * sizeof(int));
+  pyddd_ipa_sample_index[i] = k + 1;
+  pyddd_ipa_sample.count = k + 1;
+  return k;
+}
+
+/*
+ * Walk the frames of thread as pyddd_ipa_frame_backtrace does, and
+ * count the stack in the sample table.
+ */
+static void
+pyddd_ipa_sample_frames(PyFrameObject *frame)
+{
+  int frames[PYDDD_IPA_SAMPLE_DEPTH];
+  register int depth = PYDDD_IPA_SAMPLE_DEPTH;
+  register int k;
+
+  /* Fill from the end, so the outermost frame is the first one */
+  for (; frame && depth; frame = frame->f_back) {
+    k = pyddd_ipa_profile_lookup(frame->f_code);
+    if (k < 0) {
+      pyddd_ipa_sample.dropped ++;
+      return;
     }
+    frames[--depth] = k;
   }
+  if (pyddd_ipa_sample_add_stack(frames + depth,
+                                 PYDDD_IPA_SAMPLE_DEPTH - depth) < 0)
+    pyddd_ipa_sample.dropped ++;
+}
+
+/* Take one sample of the python stacks of all the threads */
+static void
+pyddd_ipa_sample_threads(PyInterpreterState *interp)
+{
+  register PyThreadState *p;
+
+  for (p = (*FPyInterpreterState_ThreadHead)(interp);
+       p;
+       p = (*FPyThreadState_Next)(p))
+    if (p->frame)
+      pyddd_ipa_sample_frames(p->frame);
+  pyddd_ipa_sample.samples ++;
+}
+
+/*
+ * Take one sample when GDB stops the inferior, for example, by an
+ * interrupt. All the threads are stopped, so the frames are stable
+ * even if the main thread is blocked without GIL, in this case the
+ * pending call never runs. Return 0 if success, -1 if there is no
+ * python thread state.
+ */
+int
+pyddd_ipa_sample_take(void)
+{
+  PyThreadState *tstate=NULL;
+
+  if (FPyGILState_GetThisThreadState)
+    tstate = (*FPyGILState_GetThisThreadState)();
+  if (tstate)
+    pyddd_ipa_interp = tstate->interp;
+  if (!pyddd_ipa_interp
+      || !FPyInterpreterState_ThreadHead
+      || !FPyThreadState_Next)
+    return -1;
+  pyddd_ipa_sample_threads(pyddd_ipa_interp);
+  return 0;
+}
+
+#if defined(_WIN32)
+
+/* There is no SIGPROF in Windows, only pyddd_ipa_sample_take works */
+int
+pyddd_ipa_sample_start(int rate)
+{
+  return -1;
+}
+
+int
+pyddd_ipa_sample_stop(void)
+{
   return 0;
 }
 
-int
-pyddd_ipa_profile_trampoline(PyObject *self,
-                             PyFrameObject *frame,
-                             int what,
-                             PyObject *arg)
+#else
+
+/*
+ * Pending call scheduled by the timer signal. It runs in the main
+ * thread between two bytecodes with GIL held, so the frames of all
+ * the threads are stable, and the code objects could be referenced.
+ */
+static int
+pyddd_ipa_sample_callback(void *arg)
+{
+  pyddd_ipa_sample_pending = 0;
+  if (pyddd_ipa_sample_running)
+    pyddd_ipa_sample_threads((*FPyThreadState_Get)()->interp);
+  return 0;
+}
+
+/*
+ * Handler of SIGPROF, nothing but Py_AddPendingCall is safe here. At
+ * most one pending call is scheduled, the signals which arrive before
+ * it runs are only counted.
+ */
+static void
+pyddd_ipa_sample_handler(int signum)
+{
+  int saved_errno = errno;
+  pyddd_ipa_sample.signals ++;
+  if (!pyddd_ipa_sample_pending) {
+    pyddd_ipa_sample_pending = 1;
+    if ((*FPy_AddPendingCall)(pyddd_ipa_sample_callback, NULL))
+      pyddd_ipa_sample_pending = 0;
+  }
+  errno = saved_errno;
+}
+
+/*
+ * Start sampling the python stacks of all the threads rate times per
+ * second of cpu time, by ITIMER_PROF. Return 0 if success, -1 if
+ * failed. The sampled stacks are kept until reset.
+ */
+int
+pyddd_ipa_sample_start(int rate)
+{
+  struct sigaction action;
+  struct itimerval timer;
+
+  if (rate <= 0 || rate > 1000000
+      || !FPy_AddPendingCall
+      || !FPyInterpreterState_ThreadHead
+      || !FPyThreadState_Next)
+    return -1;
+  if (pyddd_ipa_sample_running)
+    pyddd_ipa_sample_stop();
+
+  memset(&action, 0, sizeof(action));
+  action.sa_handler = pyddd_ipa_sample_handler;
+  action.sa_flags = SA_RESTART;
+  sigemptyset(&action.sa_mask);
+  if (sigaction(SIGPROF, &action, &pyddd_ipa_sample_oldaction))
+    return -1;
+
+  pyddd_ipa_sample_pending = 0;
+  pyddd_ipa_sample_running = 1;
+  /* tv_usec must be less than 1000000 */
+  timer.it_interval.tv_sec = 1 / rate;
+  timer.it_interval.tv_usec = (1000000 / rate) % 1000000;
+  timer.it_value = timer.it_interval;
+  if (setitimer(ITIMER_PROF, &timer, NULL)) {
+    pyddd_ipa_sample_running = 0;
+    sigaction(SIGPROF, &pyddd_ipa_sample_oldaction, NULL);
+    return -1;
+  }
+  return 0;
+}
+
+int
+pyddd_ipa_sample_stop(void)
+{
+  struct itimerval timer;
+
+  if (!pyddd_ipa_sample_running)
+    return 0;
+  memset(&timer, 0, sizeof(timer));
+  setitimer(ITIMER_PROF, &timer, NULL);
+  sigaction(SIGPROF, &pyddd_ipa_sample_oldaction, NULL);
+  pyddd_ipa_sample_running = 0;
+  return 0;
+}
+
+#endif  /* _WIN32 */
+
+/* Clear all the sampled stacks */
+void
+pyddd_ipa_sample_reset(void)
+{
+  memset(pyddd_ipa_sample_index, 0, sizeof(pyddd_ipa_sample_index));
+  pyddd_ipa_sample.count = 0;
+  pyddd_ipa_sample.dropped = 0;
+  pyddd_ipa_sample.signals = 0;
+  pyddd_ipa_sample.samples = 0;
+}
+
+/*
+ * Clear counters and time of all the entries. The entries are kept,
+ * but the call stacks are cleared as profile starts, the functions in
+ * them are not counted when they return.
+ */
+void
+pyddd_ipa_profile_reset(void)
+{
+  register int i;
+  memset(pyddd_ipa_profile_threads, 0, sizeof(pyddd_ipa_profile_threads));
+  for (i = 0; i < pyddd_ipa_profile.count; i++) {
+    pyddd_ipa_profile.entries[i].call_count = 0;
+    pyddd_ipa_profile.entries[i].total_time = 0;
+    pyddd_ipa_profile.entries[i].self_time = 0;
+    pyddd_ipa_profile.entries[i].recursion = 0;
+  }
+  pyddd_ipa_profile.dropped = 0;
+}
+
+
+/*
+ * Format of namelist:
+ *
+ *  - Separating name pattern by one whitespace.
+ *  - '?' stands for one any character in name pattern
+ *  - Name patterns start with '*' match any same prefix.
+ *    Espcially, name pattern "*" matches any name.
+ *  - Name patterns end with '*' match any same suffix.
+ *
+ */
+static char *
+find_name_in_list(const char *name, const char *namelist)
+{
+  register char *s=(char*)name;
+  register char *p=(char*)namelist;
+  if (s && *s && p && *p)
+    while (*p) {
+      while (*s && (*p == *s || *p == '?'))
+        p++, s++;
+      /* name end */
+      if (!*s) {
+        if (!*p || *p == '*' || *p == ' ')
+          return (char*)name;
+      }
+      /* asterisk match */
+      else if (*p == '*') {
+        p++;
+        /* suffix match */
+        if (*p == 0 || *p == ' ')
+          return (char*)name;
+        /* prefix match */
+        if (*s) {
+          register char *t=p;
+          int i=0;
+          int j=strlen(s);
+          while (*t && *t != ' ' && (++i))
+            t++;
+          if (i <= j) {
+            s += j;
+            do {
+              t--, s--;
+            } while (*t==*s && i--);
+            if (!i)
+              return (char*)name;
+          }
+        }
+      }
+      /* next pattern */
+      s = (char*)name;
+      if ((p=strchr(p, ' ')) == NULL)
+        break;
+      p++;
+    }
+  return NULL;
+}
+
+static unsigned int
+pyddd_ipa_hash_name(const char *s)
+{
+  register unsigned int h = 5381;
+  while (*s)
+    h = h * 33 + (unsigned char)*s++;
+  return h;
+}
+
+/* Add n chars of s to trie, from the end of s if reversed */
+static void
+pyddd_ipa_trie_insert(struct pyddd_ipa_t_trie_node *trie,
+                      int *size,
+                      const char *s,
+                      const int n,
+                      const int reversed)
+{
+  register int node = 0;
+  register int child;
+  register int i;
+  register char c;
+
+  for (i = 0; i < n; i++) {
+    c = reversed ? s[n - 1 - i] : s[i];
+    for (child = trie[node].child; child; child = trie[child].sibling)
+      if (trie[child].ch == c)
+        break;
+    if (!child) {
+      child = (*size)++;
+      trie[child].ch = c;
+      trie[child].sibling = trie[node].child;
+      trie[node].child = child;
+    }
+    node = child;
+  }
+  trie[node].terminal = 1;
+}
+
+/* Return 1 if any pattern in trie is prefix (suffix if reversed) of s */
+static int
+pyddd_ipa_trie_match(const struct pyddd_ipa_t_trie_node *trie,
+                     const char *s,
+                     const int n,
+                     const int reversed)
+{
+  register int node = 0;
+  register int i;
+  register char c;
+
+  for (i = 0; i < n && trie[node].child; i++) {
+    c = reversed ? s[n - 1 - i] : s[i];
+    for (node = trie[node].child; node; node = trie[node].sibling)
+      if (trie[node].ch == c)
+        break;
+    if (!node)
+      return 0;
+    if (trie[node].terminal)
+      return 1;
+  }
+  return 0;
+}
+
+/*
+ * Compile namelist in the format of find_name_in_list. Names without
+ * wildcard are put into hash table, "name*" and "*name" are put into
+ * tries, so the time of matching doesn't depend on the number of
+ * patterns. The others like "f?o" and "f*o" are still matched by
+ * find_name_in_list.
+ *
+ * Return NULL if out of memory.
+ */
+static struct pyddd_ipa_t_catch_patterns *
+pyddd_ipa_compile_catch_patterns(const char *namelist)
+{
+  struct pyddd_ipa_t_catch_patterns *patterns;
+  register char *s;
+  register char *t;
+  register unsigned int h;
+  int size = strlen(namelist);
+  int nprefix = 1;
+  int nsuffix = 1;
+  int n;
+
+  patterns = calloc(1, sizeof(struct pyddd_ipa_t_catch_patterns));
+  if (!patterns)
+    return NULL;
+
+  /* At most size / 2 + 1 names, keep the hash table half empty */
+  for (h = 4; h < size + 2; h <<= 1)
+    ;
+  patterns->exact_mask = h - 1;
+  patterns->exact = calloc(h, sizeof(char*));
+  patterns->prefix = calloc(size + 1, sizeof(struct pyddd_ipa_t_trie_node));
+  patterns->suffix = calloc(size + 1, sizeof(struct pyddd_ipa_t_trie_node));
+  patterns->others = calloc(size + 1, 1);
+  patterns->buffer = strdup(namelist);
+  if (!patterns->exact
+      || !patterns->prefix
+      || !patterns->suffix
+      || !patterns->others
+      || !patterns->buffer) {
+    pyddd_ipa_free_catch_patterns(patterns);
+    return NULL;
+  }
+
+  for (s = patterns->buffer; s; s = t) {
+    if ((t = strchr(s, ' ')) != NULL)
+      *t++ = 0;
+    n = strlen(s);
+    if (!n)
+      continue;
+
+    if (n == 1 && *s == '*')
+      patterns->any = 1;
+
+    else if (!strpbrk(s, "*?")) {
+      for (h = pyddd_ipa_hash_name(s) & patterns->exact_mask;
+           patterns->exact[h] && strcmp(patterns->exact[h], s);
+           h = (h + 1) & patterns->exact_mask)
+        ;
+      patterns->exact[h] = s;
+    }
+
+    else if (!strchr(s, '?') && strchr(s, '*') == s + n - 1)
+      pyddd_ipa_trie_insert(patterns->prefix, &nprefix, s, n - 1, 0);
+
+    else if (!strchr(s, '?') && strrchr(s, '*') == s)
+      pyddd_ipa_trie_insert(patterns->suffix, &nsuffix, s + 1, n - 1, 1);
+
+    else {
+      if (*patterns->others)
+        strcat(patterns->others, " ");
+      strcat(patterns->others, s);
+    }
+  }
+
+  if (!*patterns->others) {
+    free(patterns->others);
+    patterns->others = NULL;
+  }
+  return patterns;
+}
+
+static void
+pyddd_ipa_free_catch_patterns(struct pyddd_ipa_t_catch_patterns *patterns)
+{
+  if (patterns) {
+    free(patterns->exact);
+    free(patterns->prefix);
+    free(patterns->suffix);
+    free(patterns->others);
+    free(patterns->buffer);
+    free(patterns);
+  }
+}
+
+/* Return 1 if name matches any of the compiled patterns */
+static int
+pyddd_ipa_match_catch_patterns(const struct pyddd_ipa_t_catch_patterns
+                               *patterns,
+                               const char *name)
+{
+  register unsigned int h;
+  int n;
+
+  if (!patterns || !name || !*name)
+    return 0;
+  if (patterns->any)
+    return 1;
+
+  for (h = pyddd_ipa_hash_name(name) & patterns->exact_mask;
+       patterns->exact[h];
+       h = (h + 1) & patterns->exact_mask)
+    if (!strcmp(patterns->exact[h], name))
+      return 1;
+
+  n = strlen(name);
+  if (pyddd_ipa_trie_match(patterns->prefix, name, n, 0)
+      || pyddd_ipa_trie_match(patterns->suffix, name, n, 1))
+    return 1;
+
+  return patterns->others && find_name_in_list(name, patterns->others);
+}
+
+/*
+ * Replace current patterns with the compiled namelist. The retired
+ * patterns of last load are freed here.
+ */
+static int
+pyddd_ipa_load_catch_patterns(struct pyddd_ipa_t_catch_patterns **current,
+                              struct pyddd_ipa_t_catch_patterns **retired,
+                              const char *namelist)
+{
+  struct pyddd_ipa_t_catch_patterns *patterns=NULL;
+
+  if (namelist && *namelist) {
+    patterns = pyddd_ipa_compile_catch_patterns(namelist);
+    if (!patterns)
+      return -1;
+  }
+  pyddd_ipa_free_catch_patterns(*retired);
+  *retired = *current;
+  __sync_synchronize();
+  *current = patterns;
+  __sync_synchronize();
+  pyddd_ipa_catch_generation ++;
+  if (pyddd_ipa_auto_trace)
+    pyddd_ipa_update_tracing();
+  return 0;
+}
+
+/*
+ * Load patterns of py-catch call and py-catch exception, namelist is
+ * in the format of find_name_in_list. Return 0 if success, -1 if out
+ * of memory.
+ */
+int
+pyddd_ipa_load_catch_functions(const char *namelist)
+{
+  return pyddd_ipa_load_catch_patterns(&pyddd_ipa_catch_functions,
+                                       &retired_catch_functions,
+                                       namelist);
+}
+
+int
+pyddd_ipa_load_catch_exceptions(const char *namelist)
+{
+  return pyddd_ipa_load_catch_patterns(&pyddd_ipa_catch_exceptions,
+                                       &retired_catch_exceptions,
+                                       namelist);
+}
+
+/*
+ * Add symbols of all the code objects in co_consts of code, and their
+ * co_consts recursively. The symbol name is qualified name like
+ * __qualname__ of python3, for example, "Foo.run" for method and
+ * "outer.<locals>.inner" for nested function. Names start with '<',
+ * for example, "<lambda>" and "<genexpr>", are ignored. Return -1 if
+ * out of memory.
+ */
+static int
+pyddd_ipa_collect_symbols(struct pyddd_ipa_t_module *module,
+                          int *capacity,
+                          PyCodeObject *code,
+                          const char *prefix)
+{
+  register PyObject *o;
+  register PyCodeObject *co;
+  const char *name;
+  char qualname[PYDDD_IPA_MAX_QUALNAME];
+  char *p;
+  int i, n, k, m;
+
+  n = PyTuple_GET_SIZE(code->co_consts);
+  for (i = 0; i < n; i++) {
+    o = PyTuple_GET_ITEM(code->co_consts, i);
+    /* Don't use PyCode_Check, it refers to PyCode_Type */
+    if (Py_TYPE(o) != Py_TYPE(code))
+      continue;
+    co = (PyCodeObject*)o;
+    name = (*FPyString_AsString)(co->co_name);
+    if (!name) {
+      (*FPyErr_Clear)();
+      continue;
+    }
+    /* Too long, ignore the whole subtree */
+    k = snprintf(qualname, sizeof(qualname), "%s%s", prefix, name);
+    if (k < 0 || k >= (int)sizeof(qualname))
+      continue;
+    if (*name != '<') {
+      /* Enough for name, lineno and two '\0' */
+      if (module->size + k + 16 > *capacity) {
+        p = realloc(module->symbols, *capacity * 2 + k + 16);
+        if (!p)
+          return -1;
+        module->symbols = p;
+        *capacity = *capacity * 2 + k + 16;
+      }
+      p = module->symbols + module->size;
+      strcpy(p, qualname);
+      p += k + 1;
+      p += sprintf(p, "%d", co->co_firstlineno) + 1;
+      module->size = p - module->symbols;
+    }
+    /* Only function code is optimized, class body isn't */
+    m = snprintf(qualname + k, sizeof(qualname) - k, "%s",
+                 (co->co_flags & CO_OPTIMIZED) ? ".<locals>." : ".");
+    if (m < 0 || k + m >= (int)sizeof(qualname))
+      continue;
+    if (pyddd_ipa_collect_symbols(module, capacity, co, qualname))
+      return -1;
+  }
+  return 0;
+}
+
+/*
+ * Match "[...]" at p with c, set *next to the char after ']'. Return
+ * 1 if matched, -1 if not matched, 0 if there is no closing ']', in
+ * this case '[' is a normal char as fnmatch does.
+ */
+static int
+pyddd_ipa_match_class(const char *p, const char c, const char **next)
+{
+  register int matched = 0;
+  int negate = 0;
+
+  p++;
+  if (*p == '!') {
+    negate = 1;
+    p++;
+  }
+  /* The first ']' is a normal char */
+  if (*p == ']') {
+    matched = c == ']';
+    p++;
+  }
+  for (; *p && *p != ']'; p++) {
+    if (p[1] == '-' && p[2] && p[2] != ']') {
+      matched |= p[0] <= c && c <= p[2];
+      p += 2;
+    }
+    else
+      matched |= *p == c;
+  }
+  if (!*p)
+    return 0;
+  *next = p + 1;
+  return matched != negate ? 1 : -1;
+}
+
+/*
+ * Same as fnmatch.fnmatchcase of Python: '*' matches everything,
+ * '?' matches any single char, "[seq]" matches any char in seq and
+ * "[!seq]" matches any char not in seq. Return 1 if s matches pattern.
+ */
+static int
+pyddd_ipa_fnmatch(const char *pattern, const char *s)
+{
+  register const char *p = pattern;
+  const char *star = NULL;
+  const char *backtrack = NULL;
+  const char *next = NULL;
+  int k;
+
+  while (*s) {
+    if (*p == '*') {
+      star = ++p;
+      backtrack = s;
+      continue;
+    }
+    k = *p == '[' ? pyddd_ipa_match_class(p, *s, &next) : 0;
+    if (k > 0) {
+      p = next;
+      s++;
+      continue;
+    }
+    if (!k && *p && (*p == '?' || *p == *s)) {
+      p++;
+      s++;
+      continue;
+    }
+    /* Let the last '*' match one more char */
+    if (!star)
+      return 0;
+    p = star;
+    s = ++backtrack;
+  }
+  while (*p == '*')
+    p++;
+  return !*p;
+}
+
+/*
+ * Split lines into a NULL terminated list, empty lines are ignored.
+ * The list and the strings are in one block. Return NULL if out of
+ * memory.
+ */
+static char **
+pyddd_ipa_split_lines(const char *lines)
+{
+  register char *s;
+  register char *t;
+  char **list;
+  int n = 2;
+  int i = 0;
+
+  for (s = (char*)lines; (s = strchr(s, '\n')) != NULL; s++)
+    n++;
+  list = malloc(n * sizeof(char*) + strlen(lines) + 1);
+  if (!list)
+    return NULL;
+
+  s = strcpy((char*)(list + n), lines);
+  for (; s; s = t) {
+    if ((t = strchr(s, '\n')) != NULL)
+      *t++ = 0;
+    if (*s)
+      list[i++] = s;
+  }
+  list[i] = NULL;
+  return list;
+}
+
+/* Replace current list with lines, the retired list is freed here */
+static int
+pyddd_ipa_load_lines(char ***current, char ***retired, const char *lines)
+{
+  char **list = NULL;
+
+  if (lines && *lines) {
+    list = pyddd_ipa_split_lines(lines);
+    if (!list)
+      return -1;
+  }
+  free(*retired);
+  *retired = *current;
+  __sync_synchronize();
+  *current = list;
+  __sync_synchronize();
+  return 0;
+}
+
+/*
+ * Load filters of py-symbol-file, one pattern per line, and filenames
+ * of the pending breakpoints, one filename per line. Return 0 if
+ * success, -1 if out of memory.
+ */
+int
+pyddd_ipa_load_module_filters(const char *filters)
+{
+  return pyddd_ipa_load_lines(&pyddd_ipa_module_filters,
+                              &retired_module_filters,
+                              filters);
+}
+
+int
+pyddd_ipa_load_pending_files(const char *filenames)
+{
+  return pyddd_ipa_load_lines(&pyddd_ipa_pending_files,
+                              &retired_pending_files,
+                              filenames);
+}
+
+/*
+ * Check whether the symbols of module code should be collected.
+ * Return 0 if the module is ignored, 2 if any pending breakpoint is
+ * in this module, otherwise 1.
+ */
+static int
+pyddd_ipa_check_module(PyCodeObject *code)
+{
+  const char *filename = (*FPyString_AsString)(code->co_filename);
+
+  if (!filename) {
+    (*FPyErr_Clear)();
+    return 0;
+  }
+  return pyddd_ipa_check_filename(filename);
+}
+
+/*
+ * Same as pyddd_ipa_check_module, but check filename of module. The
+ * rules of filters are same as py-symbol-file filter: if there is any
+ * include pattern, filename must match one of them, and it must not
+ * match any exclude pattern.
+ */
+static int
+pyddd_ipa_check_filename(const char *filename)
+{
+  register char **p;
+  int included = 1;
+
+  /* Not a script, for example, "<string>" and "<stdin>" */
+  if (*filename == '<')
+    return 0;
+
+  /* Modules with pending breakpoints are always collected */
+  if ((p = pyddd_ipa_pending_files) != NULL)
+    for (; *p; p++)
+      if (!strcmp(*p, filename))
+        return 2;
+
+  /* included is 2 once any include pattern is matched */
+  if ((p = pyddd_ipa_module_filters) != NULL)
+    for (; *p; p++) {
+      if (**p == '-' && pyddd_ipa_fnmatch(*p + 1, filename))
+        return 0;
+      if (**p == '+' && included < 2)
+        included = pyddd_ipa_fnmatch(*p + 1, filename) ? 2 : 0;
+    }
+  return included ? 1 : 0;
+}
+
+/*
+ * Collect symbols of module code, replace the old symbols if this
+ * filename has been added. Return NULL if out of memory. Called in
+ * the trace function after pyddd_ipa_check_module.
+ */
+static struct pyddd_ipa_t_module *
+pyddd_ipa_add_module(PyCodeObject *code)
+{
+  struct pyddd_ipa_t_module *module;
+  const char *filename = (*FPyString_AsString)(code->co_filename);
+  int capacity = 1024;
+
+  if (!filename) {
+    (*FPyErr_Clear)();
+    return NULL;
+  }
+
+  module = pyddd_ipa_find_module(filename);
+  if (module) {
+    free(module->symbols);
+    module->symbols = NULL;
+    module->size = 0;
+  }
+  else {
+    if (pyddd_ipa_module_counter >= PYDDD_IPA_MAX_MODULE)
+      return NULL;
+    module = pyddd_ipa_module_table + pyddd_ipa_module_counter;
+    module->filename = strdup(filename);
+    if (!module->filename)
+      return NULL;
+    pyddd_ipa_module_counter ++;
+  }
+
+  module->symbols = malloc(capacity);
+  if (!module->symbols
+      || pyddd_ipa_collect_symbols(module, &capacity, code, "")) {
+    free(module->symbols);
+    module->symbols = NULL;
+    module->size = 0;
+    return NULL;
+  }
+  return module;
+}
+
+/* Return module of filename, NULL if not found */
+struct pyddd_ipa_t_module *
+pyddd_ipa_find_module(const char *filename)
+{
+  register struct pyddd_ipa_t_module *module;
+  if (filename)
+    for (module = pyddd_ipa_module_table + pyddd_ipa_module_counter;
+         module-- > pyddd_ipa_module_table; )
+      if (!strcmp(module->filename, filename))
+        return module;
+  return NULL;
+}
+
+/*
+ * Put object into release queue, it will be released in the trace
+ * function. If the queue is full, the object is leaked.
+ */
+static void
+pyddd_ipa_release_object(PyObject *o)
+{
+  if (o && pyddd_ipa_release_head - pyddd_ipa_release_tail
+      < PYDDD_IPA_RELEASE_QUEUE_SIZE) {
+    pyddd_ipa_release_queue[pyddd_ipa_release_head
+                            & (PYDDD_IPA_RELEASE_QUEUE_SIZE - 1)] = o;
+    __sync_synchronize();
+    pyddd_ipa_release_head ++;
+  }
+}
+
+/* Called in the trace function, the current thread holds GIL */
+static void
+pyddd_ipa_release_pending_objects(void)
+{
+  register PyObject *o;
+  while (pyddd_ipa_release_tail != pyddd_ipa_release_head) {
+    o = pyddd_ipa_release_queue[pyddd_ipa_release_tail
+                                & (PYDDD_IPA_RELEASE_QUEUE_SIZE - 1)];
+    pyddd_ipa_release_tail ++;
+    (*FPy_DecRef)(o);
+  }
+}
+
+/*
+ * Get entry of this code object in the code cache. The entry is
+ * updated only once for each code object until any breakpoint is
+ * changed. Called in the trace function, the current thread holds
+ * GIL.
+ */
+static struct pyddd_ipa_t_code_entry *
+pyddd_ipa_lookup_code(PyCodeObject *code)
+{
+  register struct pyddd_ipa_t_code_entry *entry;
+  register struct pyddd_ipa_t_code_entry *set;
+  register unsigned int k;
+  const char *filename;
+  unsigned int hash;
+
+  pyddd_ipa_trace_counters.code_lookups ++;
+  k = PYDDD_IPA_CODE_CACHE_HASH(code);
+  set = pyddd_ipa_code_cache + k * PYDDD_IPA_CODE_CACHE_WAYS;
+  for (entry = set; entry < set + PYDDD_IPA_CODE_CACHE_WAYS; entry++)
+    if (entry->code == code && entry->co_filename == code->co_filename) {
+      if (entry->generation == pyddd_ipa_breakpoint_generation)
+        return entry;
+      break;
+    }
+
+  /* Not found, replace one way of this set */
+  if (entry == set + PYDDD_IPA_CODE_CACHE_WAYS) {
+    entry = set + pyddd_ipa_code_victim[k];
+    pyddd_ipa_code_victim[k] = (pyddd_ipa_code_victim[k] + 1)
+      & (PYDDD_IPA_CODE_CACHE_WAYS - 1);
+    (*FPy_IncRef)((PyObject*)code);
+    (*FPy_IncRef)(code->co_filename);
+    if (entry->co_filename)
+      (*FPy_DecRef)(entry->co_filename);
+    if (entry->code)
+      (*FPy_DecRef)((PyObject*)entry->code);
+    entry->co_filename = code->co_filename;
+    entry->code = code;
+    entry->catch_generation = 0;
+    entry->firstlineno = code->co_firstlineno;
+    entry->lastlineno = code->co_firstlineno;
+#if PY_VERSION_HEX < 0x030A0000
+    /* Line increments are odd bytes of co_lnotab, they are signed
+       since Python 3.6 */
+    {
+      register unsigned char *p;
+      register int n;
+      p = (unsigned char*)(*FPyString_AsString)(code->co_lnotab);
+      n = p ? (*FPyString_Size)(code->co_lnotab) / 2 : 0;
+      for (; n--; p += 2)
+#if PY_VERSION_HEX < 0x03060000
+        entry->lastlineno += p[1];
+#else
+        entry->lastlineno += (signed char)p[1];
+#endif
+      if (entry->lastlineno < entry->firstlineno)
+        entry->lastlineno = INT_MAX;
+    }
+#else
+    entry->lastlineno = INT_MAX;
+#endif
+  }
+  entry->generation = pyddd_ipa_breakpoint_generation;
+  filename = (*FPyString_AsString)(code->co_filename);
+  hash = filename ? pyddd_ipa_hash_filename(filename) : 0;
+  entry->file_hash = hash;
+  entry->bound = pyddd_ipa_bind_filename(code->co_filename, filename, hash);
+  pyddd_ipa_update_code_lines(entry, hash);
+  return entry;
+}
+
+/*
+ * Set bitmap of lines which have breakpoints in this code, only the
+ * breakpoints in the bucket of filename hash are checked.
+ */
+static void
+pyddd_ipa_update_code_lines(struct pyddd_ipa_t_code_entry *entry,
+                            const unsigned int hash)
+{
+  register struct pyddd_ipa_t_breakpoint *p;
+  register int rindex;
+  register int k;
+
+  memset(entry->lines, 0, sizeof(entry->lines));
+  entry->count = 0;
+  if (!entry->bound)
+    return;
+
+  for (rindex = pyddd_ipa_file_index[hash & (PYDDD_IPA_FILE_HASH_SIZE - 1)];
+       rindex;
+       rindex = p->file_next) {
+    p = pyddd_ipa_breakpoint_table + rindex - 1;
+    if (p->bpnum
+        && pyddd_ipa_breakpoint_stats.stats[rindex - 1].enabled
+        && p->co_filename == entry->bound
+        && p->lineno >= entry->firstlineno
+        && p->lineno <= entry->lastlineno) {
+      entry->count ++;
+      k = p->lineno - entry->firstlineno;
+      if (k < PYDDD_IPA_CODE_LINE_BITS)
+        entry->lines[k / 32] |= 1U << (k % 32);
+    }
+  }
+}
+
+/* Hash of filename in the filename index */
+static unsigned int
+pyddd_ipa_hash_filename(const char *filename)
+{
+  register unsigned int hash = 0;
+  while (*filename)
+    hash = hash * 31 + (unsigned char)*filename++;
+  return hash;
+}
+
+/*
+ * Bind all the breakpoints in the filename to same filename
+ * object. If one of them has been bound, use its filename object,
+ * otherwise use co_filename. Only the breakpoints in the bucket of
+ * hash are checked.
+ */
+static PyObject *
+pyddd_ipa_bind_filename(PyObject *co_filename,
+                        const char *filename,
+                        const unsigned int hash)
+{
+  register struct pyddd_ipa_t_breakpoint *p;
+  register int rindex;
+  register int head;
+  PyObject *bound=NULL;
+
+  if (!filename)
+    return NULL;
+  head = pyddd_ipa_file_index[hash & (PYDDD_IPA_FILE_HASH_SIZE - 1)];
+
+  for (rindex = head; rindex; rindex = p->file_next) {
+    p = pyddd_ipa_breakpoint_table + rindex - 1;
+    if (p->bpnum
+        && p->co_filename
+        && p->file_hash == hash
+        && !strcmp(p->filename, filename)) {
+      bound = p->co_filename;
+      break;
+    }
+  }
+
+  for (rindex = head; rindex; rindex = p->file_next) {
+    p = pyddd_ipa_breakpoint_table + rindex - 1;
+    if (p->bpnum
+        && !p->co_filename
+        && p->file_hash == hash
+        && !strcmp(p->filename, filename)) {
+      if (!bound)
+        bound = co_filename;
+      (*FPy_IncRef)(bound);
+      p->co_filename = bound;
+    }
+  }
+
+  return bound;
+}
+
+/*
+ * Add breakpoint to the head of the chain in the index. The entry is
+ * filled before it's published, so the other running threads always
+ * walk through a complete chain.
+ */
+static void
+pyddd_ipa_link_breakpoint(const int rindex)
 {
-  return 0;
+  register struct pyddd_ipa_t_breakpoint *p;
+  register int *head;
+  p = pyddd_ipa_breakpoint_table + rindex;
+  p->file_hash = pyddd_ipa_hash_filename(p->filename);
+  head = pyddd_ipa_breakpoint_index
+    + PYDDD_IPA_BREAKPOINT_HASH(p->file_hash, p->lineno);
+  p->next = *head;
+  __sync_synchronize();
+  *head = rindex + 1;
+
+  /* Same as the filename index */
+  head = pyddd_ipa_file_index
+    + (p->file_hash & (PYDDD_IPA_FILE_HASH_SIZE - 1));
+  p->file_next = *head;
+  __sync_synchronize();
+  *head = rindex + 1;
 }
 
-#undef frame
-#undef thread
-#undef _filename
-#undef _lineno
-#undef bp
-#undef name
-#undef excname
-
-
 /*
- * Format of namelist:
- *
- *  - Separating name pattern by one whitespace.
- *  - '?' stands for one any character in name pattern
- *  - Name patterns start with '*' match any same prefix.
- *    Espcially, name pattern "*" matches any name.
- *  - Name patterns end with '*' match any same suffix.
- *
+ * Remove breakpoint from the index and the filename index. Field next
+ * and file_next of this breakpoint are kept, so the thread which is
+ * visiting this breakpoint still could go on.
  */
-static char *
-find_name_in_list(const char *name, const char *namelist)
+static void
+pyddd_ipa_unlink_breakpoint(const int rindex)
 {
-  register char *s=(char*)name;
-  register char *p=(char*)namelist;
-  if (s && *s && p && *p)
-    while (*p) {
-      while (*s && (*p == *s || *p == '?'))
-        p++, s++;
-      /* name end */
-      if (!*s) {
-        if (!*p || *p == '*' || *p == ' ')
-          return (char*)name;
-      }
-      /* asterisk match */
-      else if (*p == '*') {
-        p++;
-        /* suffix match */
-        if (*p == 0 || *p == ' ')
-          return (char*)name;
-        /* prefix match */
-        if (*s) {
-          register char *t=p;
-          int i=0;
-          int j=strlen(s);
-          while (*t && *t != ' ' && (++i))
-            t++;
-          if (i <= j) {
-            s += j;
-            do {
-              t--, s--;
-            } while (*t==*s && i--);
-            if (!i)
-              return (char*)name;
-          }
-        }
-      }
-      /* next pattern */
-      s = (char*)name;
-      if ((p=strchr(p, ' ')) == NULL)
-        break;
-      p++;
+  register int *prev;
+  prev = pyddd_ipa_breakpoint_index
+    + PYDDD_IPA_BREAKPOINT_HASH(pyddd_ipa_breakpoint_table[rindex].file_hash,
+                                pyddd_ipa_breakpoint_table[rindex].lineno);
+  while (*prev) {
+    if (*prev == rindex + 1) {
+      *prev = pyddd_ipa_breakpoint_table[rindex].next;
+      break;
     }
-  return NULL;
+    prev = &(pyddd_ipa_breakpoint_table[*prev - 1].next);
+  }
+
+  prev = pyddd_ipa_file_index
+    + (pyddd_ipa_breakpoint_table[rindex].file_hash
+       & (PYDDD_IPA_FILE_HASH_SIZE - 1));
+  while (*prev) {
+    if (*prev == rindex + 1) {
+      *prev = pyddd_ipa_breakpoint_table[rindex].file_next;
+      break;
+    }
+    prev = &(pyddd_ipa_breakpoint_table[*prev - 1].file_next);
+  }
+}
+
+/* Retire string s, it's leaked if out of memory */
+static void
+pyddd_ipa_retire_string(char *s)
+{
+  char **list;
+  int n;
+
+  if (!s)
+    return;
+  if (retired_breakpoint_strings_count == retired_breakpoint_strings_size) {
+    n = retired_breakpoint_strings_size ? retired_breakpoint_strings_size * 2
+      : 64;
+    list = realloc(retired_breakpoint_strings, n * sizeof(char*));
+    if (!list)
+      return;
+    retired_breakpoint_strings = list;
+    retired_breakpoint_strings_size = n;
+  }
+  retired_breakpoint_strings[retired_breakpoint_strings_count++] = s;
+}
+
+/* Free all the retired strings */
+static void
+pyddd_ipa_free_retired_strings(void)
+{
+  while (retired_breakpoint_strings_count)
+    free(retired_breakpoint_strings[--retired_breakpoint_strings_count]);
 }
 
 /*
@@ -368,17 +2238,48 @@ pyddd_ipa_update_breakpoint(const int rindex,
   assert (filename);
   p = pyddd_ipa_breakpoint_table + rindex;
 
+  /* Remove it from index first, because lineno may be changed */
+  if (p->bpnum)
+    pyddd_ipa_unlink_breakpoint(rindex);
+
+  /* Condition may be changed, compile it again when it's used */
+  pyddd_ipa_release_object(p->co_condition);
+  p->co_condition = NULL;
+  p->condition_error = 0;
+  p->cond_op = condition
+    ? pyddd_ipa_parse_condition(condition, p->cond_name, &p->cond_value)
+    : PYDDD_IPA_COND_NONE;
+  p->cond_code = NULL;
+  p->cond_index = -1;
+
   p->locnum = locnum;
   p->thread_id = thread_id;
   p->condition = (char*)condition;
   p->ignore_count = ignore_count;
-  p->hit_count = 0;
-  p->enabled = enabled;
+  p->tracepoint = PYDDD_IPA_TRACEPOINT_NONE;
+  p->message = NULL;
+  pyddd_ipa_release_object(p->co_message);
+  p->co_message = NULL;
+  p->message_error = 0;
+  pyddd_ipa_breakpoint_stats.stats[rindex].hit_count = 0;
+  pyddd_ipa_breakpoint_stats.stats[rindex].enabled = enabled;
+  pyddd_ipa_breakpoint_stats.stats[rindex].trace_count = 0;
+  pyddd_ipa_breakpoint_stats.stats[rindex].first_time = 0;
+  pyddd_ipa_breakpoint_stats.stats[rindex].last_time = 0;
   p->lineno = lineno;
   p->filename = (char*)filename;
   p->filename_size = strlen(filename);
+  /* Filename may be changed, bind it again in the trace function */
+  pyddd_ipa_release_object(p->co_filename);
   p->co_filename = NULL;
   p->bpnum = bpnum;
+  /* Strings aren't owned unless they're copied by load */
+  p->strings_owned = 0;
+
+  pyddd_ipa_link_breakpoint(rindex);
+  pyddd_ipa_breakpoint_generation ++;
+  pyddd_ipa_breakpoint_stats.count = pyddd_ipa_breakpoint_counter;
+  pyddd_ipa_breakpoint_stats.generation ++;
 }
 
 int
@@ -426,15 +2327,471 @@ pyddd_ipa_insert_breakpoint(const int bpnum,
 void
 pyddd_ipa_remove_breakpoint(const int rindex)
 {
+  register struct pyddd_ipa_t_breakpoint *p;
   if (rindex >= 0
       && rindex < PYDDD_IPA_MAX_BREAKPOINT
       && pyddd_ipa_breakpoint_table[rindex].bpnum > 0) {
+    p = pyddd_ipa_breakpoint_table + rindex;
     /* In order to support multi-threads, don't decrease counter */
-    pyddd_ipa_breakpoint_table[rindex].bpnum = 0;
+    pyddd_ipa_unlink_breakpoint(rindex);
+    p->bpnum = 0;
+    pyddd_ipa_release_object(p->co_condition);
+    p->co_condition = NULL;
+    pyddd_ipa_release_object(p->co_message);
+    p->co_message = NULL;
+    pyddd_ipa_release_object(p->co_filename);
+    p->co_filename = NULL;
+    if (p->strings_owned) {
+      pyddd_ipa_retire_string(p->condition);
+      pyddd_ipa_retire_string(p->filename);
+      pyddd_ipa_retire_string(p->message);
+      p->strings_owned = 0;
+    }
+    pyddd_ipa_breakpoint_generation ++;
+    pyddd_ipa_breakpoint_stats.stats[rindex].enabled = 0;
+    pyddd_ipa_breakpoint_stats.generation ++;
+    if (pyddd_ipa_auto_trace)
+      pyddd_ipa_update_tracing();
+  }
+}
+
+/* Copy data to the log ring at position pos, it may wrap around */
+static void
+pyddd_ipa_copy_log(unsigned long long pos, const void *data, int size)
+{
+  register int offset = pos & (PYDDD_IPA_LOG_SIZE - 1);
+  register int n = PYDDD_IPA_LOG_SIZE - offset;
+
+  if (n >= size)
+    memcpy(pyddd_ipa_log.data + offset, data, size);
+  else {
+    memcpy(pyddd_ipa_log.data + offset, data, n);
+    memcpy(pyddd_ipa_log.data, (const char*)data + n, size - n);
+  }
+}
+
+/* Format "<error: TYPE>" of current exception in buf, and clear it.
+   Module prefix of TYPE is removed, for example, "exceptions." */
+static void
+pyddd_ipa_format_error(char *buf, int size)
+{
+  register PyObject *type = (*FPyErr_Occurred)();
+  const char *name = "unknown";
+
+  if (type && PyType_Check(type)) {
+    name = ((PyTypeObject*)type)->tp_name;
+    if (strrchr(name, '.'))
+      name = strrchr(name, '.') + 1;
   }
+  snprintf(buf, size, "<error: %s>", name);
+  (*FPyErr_Clear)();
 }
 
+/*
+ * Evaluate message of logpoint in frame, and append it to the log
+ * ring. The message is dropped if the ring is full. If the evaluation
+ * fails, "<error: TYPE>" is logged as the message, TYPE is the name
+ * of exception. If the message can't be compiled, "<error: invalid
+ * message>" is always logged.
+ */
 static void
+pyddd_ipa_write_log(struct pyddd_ipa_t_breakpoint *bp,
+                    PyFrameObject *frame,
+                    long thread_id,
+                    long long now)
+{
+  struct pyddd_ipa_t_log_record r;
+  register unsigned long long head = pyddd_ipa_log.head;
+  PyObject *result = NULL;
+  PyObject *text = NULL;
+  const char *s = NULL;
+  char error[PYDDD_IPA_LOG_ERROR_SIZE];
+  int n;
+
+  /* Compile message only once, it's released when this breakpoint
+     is updated or removed. */
+  if (!bp->co_message && bp->message && !bp->message_error) {
+    bp->co_message = (*FPy_CompileStringFlags)(bp->message,
+                                               "",
+                                               Py_eval_input,
+                                               NULL
+                                               );
+    if (!bp->co_message) {
+      (*FPyErr_Clear)();
+      bp->message_error = 1;
+    }
+  }
+  if (bp->co_message) {
+    /* Local variables of function are only in the fast locals */
+    if ((frame->f_code->co_flags & CO_OPTIMIZED) && FPyFrame_FastToLocals)
+      (*FPyFrame_FastToLocals)(frame);
+    frame->f_tstate->use_tracing = 0;
+    result = (*FPyEval_EvalCode)((PyCodeObject*)bp->co_message,
+                                 frame->f_globals,
+                                 frame->f_locals);
+    frame->f_tstate->use_tracing = 1;
+  }
+  if (result) {
+    text = (*FPyObject_Str)(result);
+    (*FPy_DecRef)(result);
+    if (text)
+      s = (*FPyString_AsString)(text);
+  }
+  if (bp->message_error)
+    s = "<error: invalid message>";
+  else if (!s) {
+    pyddd_ipa_format_error(error, sizeof(error));
+    s = error;
+  }
+
+  n = strlen(s);
+  if (n >= PYDDD_IPA_LOG_MESSAGE_SIZE)
+    n = PYDDD_IPA_LOG_MESSAGE_SIZE - 1;
+  r.size = (sizeof(r) + n + 1 + 7) & ~7;
+  if (head - pyddd_ipa_log.tail + r.size > PYDDD_IPA_LOG_SIZE)
+    pyddd_ipa_log.dropped ++;
+  else {
+    r.bpnum = bp->bpnum;
+    r.thread_id = thread_id;
+    r.time = now;
+    pyddd_ipa_copy_log(head, &r, sizeof(r));
+    pyddd_ipa_copy_log(head + sizeof(r), s, n);
+    pyddd_ipa_copy_log(head + sizeof(r) + n, "", 1);
+    /* GDB may read it as soon as head is changed */
+    __sync_synchronize();
+    pyddd_ipa_log.head = head + r.size;
+  }
+  if (text)
+    (*FPy_DecRef)(text);
+}
+
+/*
+ * Parse simple condition "name OP integer" or "integer OP name", OP
+ * is one of == != < <= > >=, integer is decimal. Return operator,
+ * PYDDD_IPA_COND_NONE if it's not simple condition.
+ */
+static int
+pyddd_ipa_parse_condition(const char *s, char *name, long *value)
+{
+  static const char *ops[] = {"==", "!=", "<=", ">=", "<", ">", NULL};
+  static const int codes[] = {PYDDD_IPA_COND_EQ, PYDDD_IPA_COND_NE,
+                              PYDDD_IPA_COND_LE, PYDDD_IPA_COND_GE,
+                              PYDDD_IPA_COND_LT, PYDDD_IPA_COND_GT};
+  /* Operator after swap of operands */
+  static const int swaps[] = {0, PYDDD_IPA_COND_EQ, PYDDD_IPA_COND_NE,
+                              PYDDD_IPA_COND_GT, PYDDD_IPA_COND_GE,
+                              PYDDD_IPA_COND_LT, PYDDD_IPA_COND_LE};
+  register const char *p = s;
+  int op = PYDDD_IPA_COND_NONE;
+  int swap = 0;
+  int i, n;
+
+  *name = '\0';
+  for (i = 0; i < 2; i++) {
+    while (*p == ' ' || *p == '\t')
+      p++;
+
+    if (isalpha((unsigned char)*p) || *p == '_') {
+      if (*name)
+        return PYDDD_IPA_COND_NONE;
+      for (n = 0; isalnum((unsigned char)p[n]) || p[n] == '_'; n++);
+      if (n >= PYDDD_IPA_COND_NAME_SIZE)
+        return PYDDD_IPA_COND_NONE;
+      memcpy(name, p, n);
+      name[n] = '\0';
+      p += n;
+    }
+
+    /* Leading 0 means octal in python 2 */
+    else if ((isdigit((unsigned char)*p)
+              && (*p != '0' || !isdigit((unsigned char)p[1])))
+             || (*p == '-' && isdigit((unsigned char)p[1]) && p[1] != '0')) {
+      char *end;
+      if (!i)
+        swap = 1;
+      else if (swap)
+        return PYDDD_IPA_COND_NONE;
+      errno = 0;
+      *value = strtol(p, &end, 10);
+      if (errno || isalnum((unsigned char)*end) || *end == '.' || *end == '_')
+        return PYDDD_IPA_COND_NONE;
+      p = end;
+    }
+    else
+      return PYDDD_IPA_COND_NONE;
+
+    while (*p == ' ' || *p == '\t')
+      p++;
+    if (!i) {
+      for (n = 0; ops[n]; n++)
+        if (!strncmp(p, ops[n], strlen(ops[n])))
+          break;
+      if (!ops[n])
+        return PYDDD_IPA_COND_NONE;
+      op = codes[n];
+      p += strlen(ops[n]);
+    }
+  }
+
+  if (*p || !*name)
+    return PYDDD_IPA_COND_NONE;
+  return swap ? swaps[op] : op;
+}
+
+/* Return 1 if name is in the tuple of names, 0 if not, -1 if error */
+static int
+pyddd_ipa_find_name_in_tuple(PyObject *names, const char *name)
+{
+  register Py_ssize_t i;
+  const char *s;
+
+  for (i = 0; i < PyTuple_GET_SIZE(names); i++) {
+    s = (*FPyString_AsString)((*FPyTuple_GetItem)(names, i));
+    if (!s) {
+      (*FPyErr_Clear)();
+      return -1;
+    }
+    if (!strcmp(s, name))
+      return 1;
+  }
+  return 0;
+}
+
+/*
+ * Evaluate simple condition of breakpoint in frame, the variable is
+ * got from fast locals, locals, globals and builtins in turn. Return
+ * 1 if it's true, 0 if false, -1 if the variable isn't found or
+ * isn't an integer, or it's a cell or free variable of the code, then
+ * python evaluates the condition.
+ */
+static int
+pyddd_ipa_eval_simple_condition(struct pyddd_ipa_t_breakpoint *bp,
+                                PyFrameObject *frame)
+{
+  PyCodeObject *code = frame->f_code;
+  PyObject *value = NULL;
+  register long v;
+  register int i;
+  const char *s;
+  int overflow;
+
+  if (code->co_flags & CO_OPTIMIZED) {
+    /* Code object isn't referenced, another code may be allocated at
+       the same address, so check the name again. Non-local name is
+       always searched, it's the slow path of globals anyway. */
+    i = bp->cond_index;
+    if (bp->cond_code != code
+        || i < 0
+        || !(s = (*FPyString_AsString)
+             ((*FPyTuple_GetItem)(code->co_varnames, i)))
+        || strcmp(s, bp->cond_name)) {
+      bp->cond_code = NULL;
+      bp->cond_index = -1;
+      /* Cell is shared with the closures, fast local may be stale */
+      if (pyddd_ipa_find_name_in_tuple(code->co_cellvars, bp->cond_name)
+          || pyddd_ipa_find_name_in_tuple(code->co_freevars, bp->cond_name))
+        return -1;
+      for (i = 0; i < code->co_nlocals; i++) {
+        s = (*FPyString_AsString)((*FPyTuple_GetItem)(code->co_varnames, i));
+        if (!s) {
+          (*FPyErr_Clear)();
+          return -1;
+        }
+        if (!strcmp(s, bp->cond_name)) {
+          bp->cond_index = i;
+          break;
+        }
+      }
+      bp->cond_code = code;
+    }
+    /* Unbound local variable */
+    if (bp->cond_index >= 0 && !(value = frame->f_localsplus[bp->cond_index]))
+      return -1;
+  }
+  else if (frame->f_locals)
+    value = (*FPyDict_GetItemString)(frame->f_locals, bp->cond_name);
+  if (!value)
+    value = (*FPyDict_GetItemString)(frame->f_globals, bp->cond_name);
+  if (!value)
+    value = (*FPyDict_GetItemString)(frame->f_builtins, bp->cond_name);
+  if (!value)
+    return -1;
+
+  /* Only builtin integer, the subclass may change comparison */
+  s = Py_TYPE(value)->tp_name;
+#if PY_MAJOR_VERSION < 3
+  if (PyType_HasFeature(Py_TYPE(value), Py_TPFLAGS_INT_SUBCLASS)
+      && (!strcmp(s, "int") || !strcmp(s, "bool")))
+    v = ((PyIntObject*)value)->ob_ival;
+  else
+#endif
+  if (PyType_HasFeature(Py_TYPE(value), Py_TPFLAGS_LONG_SUBCLASS)
+      && FPyLong_AsLongAndOverflow
+      && (!strcmp(s, "int") || !strcmp(s, "long") || !strcmp(s, "bool"))) {
+    v = (*FPyLong_AsLongAndOverflow)(value, &overflow);
+    if (overflow)
+      return -1;
+    if (v == -1 && (*FPyErr_Occurred)()) {
+      (*FPyErr_Clear)();
+      return -1;
+    }
+  }
+  else
+    return -1;
+
+  switch (bp->cond_op) {
+  case PYDDD_IPA_COND_EQ: return v == bp->cond_value;
+  case PYDDD_IPA_COND_NE: return v != bp->cond_value;
+  case PYDDD_IPA_COND_LT: return v < bp->cond_value;
+  case PYDDD_IPA_COND_LE: return v <= bp->cond_value;
+  case PYDDD_IPA_COND_GT: return v > bp->cond_value;
+  case PYDDD_IPA_COND_GE: return v >= bp->cond_value;
+  }
+  return -1;
+}
+
+/*
+ * Copy string from the data buffer. The old string is reused if it's
+ * same. The replaced string is retired, it isn't freed at once,
+ * because the stopped thread may still use it.
+ */
+static char *
+pyddd_ipa_copy_string(char *old, const char *s)
+{
+  if (old && !strcmp(old, s))
+    return old;
+  return strdup(s);
+}
+
+/*
+ * Load count breakpoint records in the data buffer, insert them if
+ * field rindex is -1, otherwise update them. Field rindex of each
+ * record is set to rindex of the breakpoint.
+ *
+ * Return the number of loaded records, it's less than count if
+ * breakpoint table is full or out of memory. The strings retired by
+ * the last load are freed here.
+ */
+int
+pyddd_ipa_load_breakpoints(const int count)
+{
+  register struct pyddd_ipa_t_breakpoint_record *r;
+  register char *s = pyddd_ipa_data_buffer;
+  char *end = pyddd_ipa_data_buffer + PYDDD_IPA_DATA_BUFFER_SIZE;
+  register struct pyddd_ipa_t_breakpoint *p;
+  struct pyddd_ipa_t_breakpoint *old;
+  char *condition;
+  char *filename;
+  char *message;
+  int rindex;
+  int i;
+
+  pyddd_ipa_free_retired_strings();
+  for (i = 0; i < count; i++, s += PYDDD_IPA_RECORD_SIZE(r)) {
+    r = (struct pyddd_ipa_t_breakpoint_record*)s;
+    if (s + sizeof(struct pyddd_ipa_t_breakpoint_record) > end
+        || s + PYDDD_IPA_RECORD_SIZE(r) > end
+        || r->bpnum <= 0
+        || r->filename_size <= 0
+        || r->condition_size < 0
+        || r->message_size < 0
+        || r->rindex < -1
+        || r->rindex >= PYDDD_IPA_MAX_BREAKPOINT)
+      break;
+
+    /* Only the strings copied by load are reused or retired */
+    rindex = r->rindex;
+    old = NULL;
+    if (rindex != -1 && pyddd_ipa_breakpoint_table[rindex].strings_owned)
+      old = pyddd_ipa_breakpoint_table + rindex;
+    condition = NULL;
+    if (r->condition_size)
+      condition = pyddd_ipa_copy_string(old ? old->condition : NULL,
+                                        (char*)(r + 1));
+    filename = pyddd_ipa_copy_string(old ? old->filename : NULL,
+                                     (char*)(r + 1) + r->condition_size);
+    message = NULL;
+    if (r->message_size)
+      message = pyddd_ipa_copy_string(old ? old->message : NULL,
+                                      (char*)(r + 1) + r->condition_size
+                                      + r->filename_size);
+
+    if ((r->condition_size && !condition)
+        || !filename
+        || (r->message_size && !message)) {
+      /* Free the new copies, they aren't used by any breakpoint */
+      if (!old || condition != old->condition)
+        free(condition);
+      if (!old || filename != old->filename)
+        free(filename);
+      if (!old || message != old->message)
+        free(message);
+      break;
+    }
+
+    if (rindex == -1) {
+      rindex = pyddd_ipa_insert_breakpoint(r->bpnum, r->locnum,
+                                           (long)r->thread_id,
+                                           condition, r->ignore_count,
+                                           r->enabled, r->lineno,
+                                           filename);
+      if (rindex == -1) {
+        free(condition);
+        free(filename);
+        free(message);
+        break;
+      }
+      r->rindex = rindex;
+    }
+    else {
+      if (old) {
+        if (old->condition != condition)
+          pyddd_ipa_retire_string(old->condition);
+        if (old->filename != filename)
+          pyddd_ipa_retire_string(old->filename);
+        if (old->message != message)
+          pyddd_ipa_retire_string(old->message);
+      }
+      pyddd_ipa_update_breakpoint(rindex, r->bpnum, r->locnum,
+                                  (long)r->thread_id,
+                                  condition, r->ignore_count,
+                                  r->enabled, r->lineno,
+                                  filename);
+    }
+    p = pyddd_ipa_breakpoint_table + rindex;
+    p->tracepoint = r->tracepoint;
+    p->message = message;
+    p->strings_owned = 1;
+  }
+  if (pyddd_ipa_auto_trace)
+    pyddd_ipa_update_tracing();
+  return i;
+}
+
+/* Return volatile breakpoint of this thread, NULL if not found */
+static struct pyddd_ipa_t_volatile_breakpoint *
+pyddd_ipa_find_volatile_breakpoint(const long thread_id)
+{
+  register struct pyddd_ipa_t_volatile_breakpoint *vp;
+  register int i, n;
+  i = PYDDD_IPA_THREAD_HASH(thread_id);
+  for (n = PYDDD_IPA_MAX_THREAD; n; n--) {
+    vp = pyddd_ipa_volatile_breakpoint_table + i;
+    if (vp->thread_id == thread_id)
+      return vp;
+    if (!vp->thread_id)
+      break;
+    i = (i + 1) & (PYDDD_IPA_MAX_THREAD - 1);
+  }
+  return NULL;
+}
+
+/*
+ * Set volatile breakpoint of this thread. If this thread has no
+ * entry, take a free one or a disabled one. Return -1 if there is no
+ * any available entry.
+ */
+static int
 pyddd_ipa_set_volatile_breakpoint(const int enabled,
                                   const long thread_id,
                                   PyFrameObject *f_frame,
@@ -442,87 +2799,132 @@ pyddd_ipa_set_volatile_breakpoint(const int enabled,
                                   const int lineno)
 {
   register struct pyddd_ipa_t_volatile_breakpoint *vp;
+  register int i, n;
   assert(thread_id);
 
-  vp = &pyddd_ipa_volatile_breakpoint;
-  vp->enabled = enabled;
+  vp = pyddd_ipa_find_volatile_breakpoint(thread_id);
+  if (!vp) {
+    i = PYDDD_IPA_THREAD_HASH(thread_id);
+    for (n = PYDDD_IPA_MAX_THREAD; n; n--) {
+      vp = pyddd_ipa_volatile_breakpoint_table + i;
+      if (!vp->thread_id || !vp->enabled)
+        break;
+      i = (i + 1) & (PYDDD_IPA_MAX_THREAD - 1);
+    }
+    if (!n)
+      return -1;
+  }
+
+  if (vp->enabled)
+    __sync_sub_and_fetch(&pyddd_ipa_volatile_breakpoint_armed, 1);
+  vp->enabled = 0;
   vp->thread_id = thread_id;
   vp->f_frame = f_frame;
   vp->co_filename = co_filename;
   vp->lineno = lineno;
+  __sync_synchronize();
+  vp->enabled = enabled;
+  if (enabled)
+    __sync_add_and_fetch(&pyddd_ipa_volatile_breakpoint_armed, 1);
+  if (pyddd_ipa_auto_trace)
+    pyddd_ipa_update_tracing();
+  return 0;
+}
+
+/* Disable volatile breakpoint of this thread */
+static void
+pyddd_ipa_clear_volatile_breakpoint(const long thread_id)
+{
+  register struct pyddd_ipa_t_volatile_breakpoint *vp;
+  if (pyddd_ipa_volatile_breakpoint_armed
+      && (vp = pyddd_ipa_find_volatile_breakpoint(thread_id))
+      && vp->enabled) {
+    vp->enabled = 0;
+    __sync_sub_and_fetch(&pyddd_ipa_volatile_breakpoint_armed, 1);
+  }
+}
+
+/*
+ * Thread state of the thread in which GDB calls this function. It's
+ * not the one holds GIL if GDB has switched to other thread.
+ */
+static PyThreadState *
+pyddd_ipa_this_thread_state(void)
+{
+  PyThreadState *tstate=NULL;
+  if (FPyGILState_GetThisThreadState)
+    tstate = (*FPyGILState_GetThisThreadState)();
+  if (!tstate)
+    tstate = (*FPyThreadState_Get)();
+  return tstate;
 }
 
 /* Running command: step, next, finish, advance, untill, advance */
 int
 pyddd_ipa_step_command(int count)
 {
-  register PyThreadState *tstate=(*FPyThreadState_Get)();
+  register PyThreadState *tstate=pyddd_ipa_this_thread_state();
   assert (count);
-  pyddd_ipa_set_volatile_breakpoint(count,
-                                    tstate->thread_id,
-                                    NULL,
-                                    NULL,
-                                    0
-                                    );
-  return 0;
+  return pyddd_ipa_set_volatile_breakpoint(count,
+                                           tstate->thread_id,
+                                           NULL,
+                                           NULL,
+                                           0
+                                           );
 }
 
 int
 pyddd_ipa_next_command(int count)
 {
-  register PyThreadState *tstate=(*FPyThreadState_Get)();
+  register PyThreadState *tstate=pyddd_ipa_this_thread_state();
   assert (count);
-  pyddd_ipa_set_volatile_breakpoint(count,
-                                    tstate->thread_id,
-                                    tstate->frame,
-                                    NULL,
-                                    0
-                                    );
-  return 0;
+  return pyddd_ipa_set_volatile_breakpoint(count,
+                                           tstate->thread_id,
+                                           tstate->frame,
+                                           NULL,
+                                           0
+                                           );
 }
 
 int
 pyddd_ipa_finish_command(void)
 {
-  register PyThreadState *tstate=(*FPyThreadState_Get)();
+  register PyThreadState *tstate=pyddd_ipa_this_thread_state();
   register PyFrameObject *frame=tstate->frame;
-  pyddd_ipa_set_volatile_breakpoint(1,
-                                    tstate->thread_id,
-                                    frame->f_back,
-                                    NULL,
-                                    0
-                                    );
-  return 0;
+  return pyddd_ipa_set_volatile_breakpoint(1,
+                                           tstate->thread_id,
+                                           frame->f_back,
+                                           NULL,
+                                           0
+                                           );
 }
 
 int
 pyddd_ipa_until_command(int lineno)
 {
-  register PyThreadState *tstate=(*FPyThreadState_Get)();
+  register PyThreadState *tstate=pyddd_ipa_this_thread_state();
   register PyFrameObject *frame=tstate->frame;
   if (!lineno)
     lineno = -(*FPyFrame_GetLineNumber)(frame);
-  pyddd_ipa_set_volatile_breakpoint(1,
-                                    tstate->thread_id,
-                                    frame->f_back,
-                                    NULL,
-                                    lineno
-                                    );
-  return 0;
+  return pyddd_ipa_set_volatile_breakpoint(1,
+                                           tstate->thread_id,
+                                           frame->f_back,
+                                           NULL,
+                                           lineno
+                                           );
 }
 
 int
 pyddd_ipa_advance_command(int lineno)
 {
-  register PyThreadState *tstate=(*FPyThreadState_Get)();
+  register PyThreadState *tstate=pyddd_ipa_this_thread_state();
   PyObject *co_filename = tstate->frame->f_code->co_filename;
-  pyddd_ipa_set_volatile_breakpoint(1,
-                                    tstate->thread_id,
-                                    NULL,
-                                    co_filename,
-                                    lineno
-                                    );
-  return 0;
+  return pyddd_ipa_set_volatile_breakpoint(1,
+                                           tstate->thread_id,
+                                           NULL,
+                                           co_filename,
+                                           lineno
+                                           );
 }
 
 /*
@@ -645,6 +3047,175 @@ pyddd_ipa_frame_variable(PyFrameObject *frame, char *varname, int global)
   return NULL;
 }
 
+/*
+ * Append one variable to the snapshot at *ps in the data buffer:
+ *
+ *   kind name '\0' repr '\0'
+ *
+ * Repr is truncated to maxsize bytes if maxsize > 0. Return -1 if
+ * there is no enough space, otherwise *ps is moved to the end.
+ */
+static int
+pyddd_ipa_snapshot_variable(char **ps,
+                            const char kind,
+                            PyObject *key,
+                            PyObject *value,
+                            const int maxsize)
+{
+  register char *s = *ps;
+  char *end = pyddd_ipa_data_buffer + PYDDD_IPA_DATA_BUFFER_SIZE;
+  const char *name = (*FPyString_AsString)(key);
+  const char *repr = NULL;
+  PyObject *o;
+  int n, m;
+
+  if (!name) {
+    (*FPyErr_Clear)();
+    return 0;
+  }
+  o = (*FPyObject_Repr)(value);
+  if (o)
+    repr = (*FPyString_AsString)(o);
+  if (!repr) {
+    (*FPyErr_Clear)();
+    repr = "<unknown>";
+  }
+
+  n = strlen(name);
+  m = strlen(repr);
+  if (maxsize > 0 && m > maxsize)
+    m = maxsize;
+  if (s + n + m + 3 > end)
+    s = NULL;
+  else {
+    *s++ = kind;
+    memcpy(s, name, n + 1);
+    s += n + 1;
+    memcpy(s, repr, m);
+    s += m;
+    *s++ = 0;
+    *ps = s;
+  }
+  if (o)
+    (*FPy_DecRef)(o);
+  return s ? 0 : -1;
+}
+
+/*
+ * Write all the variables of frame to the data buffer, so GDB could
+ * read them by one memory read. Kind of variable is
+ *
+ *   'a'  argument
+ *   'l'  local variable
+ *   'c'  cell variable
+ *   'g'  global variable
+ *
+ * Only global variables are written if global is not 0. Unbound
+ * variables are ignored, and the variables which can't be put into
+ * the buffer are dropped. Return size of data in the buffer.
+ */
+int
+pyddd_ipa_frame_snapshot(PyFrameObject *frame, int global, int maxsize)
+{
+  char *s = pyddd_ipa_data_buffer;
+  PyCodeObject *co;
+  PyObject *key, *value;
+  Py_ssize_t pos = 0;
+  int oldvalue;
+  int full = 0;
+  int i, n;
+
+  if (!frame)
+    frame = (*FPyThreadState_Get)()->frame;
+  assert (frame);
+  co = frame->f_code;
+
+  /* repr may call python function, don't trace it */
+  oldvalue = frame->f_tstate->use_tracing;
+  frame->f_tstate->use_tracing = 0;
+
+  if (global) {
+    while (!full && (*FPyDict_Next)(frame->f_globals, &pos, &key, &value))
+      full = pyddd_ipa_snapshot_variable(&s, 'g', key, value, maxsize);
+  }
+
+  /* Fast locals and cells */
+  else if (co->co_flags & CO_OPTIMIZED) {
+    n = co->co_nlocals;
+    for (i = 0; !full && i < n; i++)
+      if (frame->f_localsplus[i])
+        full = pyddd_ipa_snapshot_variable
+          (&s,
+           i < co->co_argcount ? 'a' : 'l',
+           (*FPyTuple_GetItem)(co->co_varnames, i),
+           frame->f_localsplus[i],
+           maxsize);
+    n = PyTuple_GET_SIZE(co->co_cellvars);
+    for (i = 0; !full && i < n; i++) {
+      value = frame->f_localsplus[co->co_nlocals + i];
+      if (value && PyCell_GET(value))
+        full = pyddd_ipa_snapshot_variable
+          (&s,
+           'c',
+           (*FPyTuple_GetItem)(co->co_cellvars, i),
+           PyCell_GET(value),
+           maxsize);
+    }
+  }
+
+  /* Module or class body, locals are in the dict */
+  else if (frame->f_locals && frame->f_locals != frame->f_globals) {
+    while (!full && (*FPyDict_Next)(frame->f_locals, &pos, &key, &value))
+      full = pyddd_ipa_snapshot_variable(&s, 'l', key, value, maxsize);
+  }
+
+  frame->f_tstate->use_tracing = oldvalue;
+  return s - pyddd_ipa_data_buffer;
+}
+
+/*
+ * Write records of frame and its older frames to the data buffer, at
+ * most count frames, all the frames if count < 0. It stops when the
+ * buffer is full. Return size of data in the buffer.
+ */
+int
+pyddd_ipa_frame_backtrace(PyFrameObject *frame, int count)
+{
+  register char *s = pyddd_ipa_data_buffer;
+  register struct pyddd_ipa_t_frame_record *r;
+  char *end = pyddd_ipa_data_buffer + PYDDD_IPA_DATA_BUFFER_SIZE;
+  const char *filename;
+  const char *name;
+
+  if (!frame)
+    frame = (*FPyThreadState_Get)()->frame;
+
+  for (; frame && count; frame = frame->f_back, count--) {
+    filename = (*FPyString_AsString)(frame->f_code->co_filename);
+    name = (*FPyString_AsString)(frame->f_code->co_name);
+    if (!filename || !name)
+      (*FPyErr_Clear)();
+
+    r = (struct pyddd_ipa_t_frame_record*)s;
+    if (s + sizeof(struct pyddd_ipa_t_frame_record) > end)
+      break;
+    r->filename_size = (filename ? strlen(filename) : 0) + 1;
+    r->name_size = (name ? strlen(name) : 0) + 1;
+    if (s + PYDDD_IPA_FRAME_RECORD_SIZE(r) > end)
+      break;
+
+    r->frame = (long long)(long)frame;
+    r->lineno = (*FPyFrame_GetLineNumber)(frame);
+    r->argcount = frame->f_code->co_argcount;
+    memcpy(r + 1, filename ? filename : "", r->filename_size);
+    memcpy((char*)(r + 1) + r->filename_size,
+           name ? name : "",
+           r->name_size);
+    s += PYDDD_IPA_FRAME_RECORD_SIZE(r);
+  }
+  return s - pyddd_ipa_data_buffer;
+}
+
 /* Alter variables in python */
 int
 pyddd_ipa_alter_variable(PyFrameObject *frame,
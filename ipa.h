@@ -11,35 +11,417 @@
 #define PYDDD_IPA_BREAKPOINT_PAGE 256
 #define PYDDD_IPA_MAX_BREAKPOINT 1024
 
+/* Size of volatile breakpoint table, it must be power of 2 */
+#define PYDDD_IPA_MAX_THREAD 64
+#define PYDDD_IPA_THREAD_HASH(thread_id) \
+  (((unsigned long)(thread_id) ^ ((unsigned long)(thread_id) >> 12)) \
+   & (PYDDD_IPA_MAX_THREAD - 1))
+
+/*
+ * Size of breakpoint index, it must be power of 2. The key is hash of
+ * filename and lineno, so the lines of one file are in the continuous
+ * buckets.
+ */
+#define PYDDD_IPA_BREAKPOINT_HASH_SIZE 1024
+#define PYDDD_IPA_BREAKPOINT_HASH(file_hash, lineno) \
+  (((file_hash) + (unsigned int)(lineno)) \
+   & (PYDDD_IPA_BREAKPOINT_HASH_SIZE - 1))
+
+/* Size of filename index of breakpoints, it must be power of 2 */
+#define PYDDD_IPA_FILE_HASH_SIZE 256
+
+/*
+ * Size of code object cache, it must be power of 2. It's set
+ * associative, the code object may be in any way of its set.
+ */
+#define PYDDD_IPA_CODE_CACHE_SIZE 1024
+#define PYDDD_IPA_CODE_CACHE_WAYS 4
+#define PYDDD_IPA_CODE_CACHE_SETS \
+  (PYDDD_IPA_CODE_CACHE_SIZE / PYDDD_IPA_CODE_CACHE_WAYS)
+#define PYDDD_IPA_CODE_CACHE_HASH(co)                                   \
+  ((((unsigned long)(co) >> 4) ^ ((unsigned long)(co) >> 12))           \
+   & (PYDDD_IPA_CODE_CACHE_SETS - 1))
+
+/* Number of lines from co_firstlineno in the bitmap of code entry */
+#define PYDDD_IPA_CODE_LINE_BITS 256
+
+/* Size of queue for python objects to be released, power of 2 */
+#define PYDDD_IPA_RELEASE_QUEUE_SIZE 1024
+
+/* Size of buffer used to transfer data between GDB and python-ipa */
+#define PYDDD_IPA_DATA_BUFFER_SIZE 65536
+
+/* Max number of modules whose symbols are collected */
+#define PYDDD_IPA_MAX_MODULE 4096
+#define PYDDD_IPA_MAX_QUALNAME 512
+
 /*
  * Internal used to support step/next/until/advance/finish commands.
  *
  * ignore_count is in GDB side, not in python-ipa.
+ *
+ * Each thread has its own volatile breakpoint, thread_id is never
+ * cleared once it's set. Entry is aligned to cache line, so the
+ * threads don't share cache line when they update field enabled.
  */
 struct pyddd_ipa_t_volatile_breakpoint {
-  int enabled;
+  volatile int enabled;
   long thread_id;
   PyFrameObject *f_frame;
   PyObject *co_filename;
   int lineno;
+} __attribute__ ((aligned (64)));
+
+/*
+ * Cache of code object, only used in the trace function.
+ *
+ * An entry is valid only if both code and co_filename are same, and
+ * generation equals pyddd_ipa_breakpoint_generation. The references
+ * of code and co_filename are hold by the entry, so they can't be
+ * reused by any other object.
+ */
+struct pyddd_ipa_t_code_entry {
+  PyCodeObject *code;
+  PyObject *co_filename;
+  unsigned int generation;
+  unsigned int catch_generation;/* Field catch_call is valid only if it
+                                   equals pyddd_ipa_catch_generation */
+  int catch_call;               /* 1 if co_name matches py-catch call */
+  PyObject *bound;              /* Filename object bound to breakpoints
+                                   in this file, 0 means no breakpoint */
+  unsigned int file_hash;       /* Hash of co_filename */
+  int firstlineno;              /* Lines of this code, got from */
+  int lastlineno;               /* co_firstlineno and co_lnotab */
+  int count;                    /* Number of breakpoints in this code */
+  unsigned int lines[PYDDD_IPA_CODE_LINE_BITS / 32];
+                                /* Bit n is set if there is breakpoint
+                                   in the line firstlineno + n */
+};
+
+/*
+ * Node of trie in the compiled catch patterns. Node 0 is root, the
+ * children of one node are chained by sibling, 0 means none.
+ */
+struct pyddd_ipa_t_trie_node {
+  int child;
+  int sibling;
+  char ch;
+  char terminal;                /* 1 if any pattern ends here */
+};
+
+/*
+ * Catch patterns compiled from the namelist of find_name_in_list. It
+ * isn't changed any more after it's compiled.
+ */
+struct pyddd_ipa_t_catch_patterns {
+  int any;                      /* 1 if there is pattern "*" */
+  unsigned int exact_mask;      /* Size of table exact - 1 */
+  char **exact;                 /* Hash table of names without '*'
+                                   and '?' */
+  struct pyddd_ipa_t_trie_node *prefix;
+                                /* Trie of patterns "name*" */
+  struct pyddd_ipa_t_trie_node *suffix;
+                                /* Trie of patterns "*name", reversed */
+  char *others;                 /* The other patterns, matched by
+                                   find_name_in_list, 0 means none */
+  char *buffer;                 /* Copy of namelist */
 };
 
+/*
+ * Operators of simple condition "name OP integer", it's evaluated
+ * in the trace function without python.
+ */
+#define PYDDD_IPA_COND_NONE 0
+#define PYDDD_IPA_COND_EQ 1
+#define PYDDD_IPA_COND_NE 2
+#define PYDDD_IPA_COND_LT 3
+#define PYDDD_IPA_COND_LE 4
+#define PYDDD_IPA_COND_GT 5
+#define PYDDD_IPA_COND_GE 6
+#define PYDDD_IPA_COND_NAME_SIZE 32
+
 struct pyddd_ipa_t_breakpoint {
   int bpnum;                    /* GDB bpnum */
   int locnum;                   /* Location number */
   long thread_id;               /* Thread id, 0 means any thread */
   char *condition;              /* Python condition expression */
+  PyObject *co_condition;       /* Compiled condition, 0 means not
+                                   compiled yet */
+  int condition_error;          /* 1 means condition couldn't be
+                                   compiled, always skip it */
+  int cond_op;                  /* Operator of simple condition, 0
+                                   means condition isn't simple */
+  long cond_value;              /* Integer of simple condition */
+  char cond_name[PYDDD_IPA_COND_NAME_SIZE];
+                                /* Name of simple condition */
+  PyCodeObject *cond_code;      /* Code of cond_index, not referenced */
+  int cond_index;               /* Index of cond_name in f_localsplus
+                                   of cond_code, -1 means not local */
+  int tracepoint;               /* PYDDD_IPA_TRACEPOINT_XXX */
+  char *message;                /* Python expression of log message */
+  PyObject *co_message;         /* Compiled message, 0 means not
+                                   compiled yet */
+  int message_error;            /* 1 means message couldn't be
+                                   compiled, always log error */
+  int strings_owned;            /* 1 means condition, filename and
+                                   message are copied by
+                                   pyddd_ipa_load_breakpoints */
   int ignore_count;             /* Ignore count */
-  int hit_count;
-  int enabled;                  /* 0 or 1 */
-
+                                /* Hit count and enabled are in
+                                   pyddd_ipa_breakpoint_stats */
   int lineno;                   /* > 0 */
   char *filename;               /* NOT NULL */
   int filename_size;            /* Size of filename */
-  PyObject *co_filename;        /* 0 means unresolved address */
+  PyObject *co_filename;        /* Filename object bound to this
+                                   breakpoint, 0 means unresolved */
+  unsigned int file_hash;       /* Hash of filename */
+  int file_next;                /* 1 + rindex of next breakpoint in
+                                   the same filename bucket */
+
+  int next;                     /* 1 + rindex of next breakpoint in
+                                   the same hash bucket, 0 means end */
+};
+
+/*
+ * Kind of breakpoint, tracepoint never stops, it only counts hits
+ * which pass ignore count and condition in the stat.
+ */
+#define PYDDD_IPA_TRACEPOINT_NONE 0
+#define PYDDD_IPA_TRACEPOINT_COUNT 1
+#define PYDDD_IPA_TRACEPOINT_TIME 2 /* Count and timestamps */
+#define PYDDD_IPA_TRACEPOINT_LOG 3  /* Count, timestamps and message */
+
+/*
+ * Record of breakpoint in the data buffer, written by GDB. It's
+ * followed by condition, filename and message, all of them end with
+ * '\0'. The
+ * total size of one record is aligned to 8 bytes.
+ *
+ * Fields have same size in all the platforms, so GDB could pack them
+ * by python module struct with format "=7i4xq3i4x".
+ */
+struct pyddd_ipa_t_breakpoint_record {
+  int rindex;                   /* -1 means new breakpoint, it's set
+                                   to rindex in python-ipa after
+                                   loaded */
+  int bpnum;
+  int locnum;
+  int ignore_count;
+  int enabled;
+  int lineno;
+  int tracepoint;               /* PYDDD_IPA_TRACEPOINT_XXX */
+  long long thread_id;
+  int condition_size;           /* Including '\0', 0 means none */
+  int filename_size;            /* Including '\0' */
+  int message_size;             /* Including '\0', 0 means none */
+};
+
+#define PYDDD_IPA_RECORD_SIZE(r)                                        \
+  ((sizeof(struct pyddd_ipa_t_breakpoint_record)                        \
+    + (r)->condition_size + (r)->filename_size + (r)->message_size     \
+    + 7) & ~7)
+
+/*
+ * Record of frame in the data buffer, written by
+ * pyddd_ipa_frame_backtrace. It's followed by filename and name, both
+ * of them end with '\0'. The total size of one record is aligned to 8
+ * bytes. The format in python module struct is "=q4i".
+ */
+struct pyddd_ipa_t_frame_record {
+  long long frame;              /* PyFrameObject* */
+  int lineno;
+  int argcount;
+  int filename_size;            /* Including '\0' */
+  int name_size;                /* Including '\0' */
+};
+
+#define PYDDD_IPA_FRAME_RECORD_SIZE(r)                                  \
+  ((sizeof(struct pyddd_ipa_t_frame_record)                             \
+    + (r)->filename_size + (r)->name_size + 7) & ~7)
+
+/*
+ * Symbols of module collected when it's executed, got from all the
+ * code objects in co_consts of the module code. Each symbol is
+ *
+ *   name '\0' firstlineno '\0'
+ *
+ * firstlineno is decimal string, so GDB reads all of them by one
+ * memory read and splits them by '\0'.
+ */
+struct pyddd_ipa_t_module {
+  char *filename;
+  char *symbols;
+  int size;                     /* Size of symbols */
+};
+
+struct pyddd_ipa_t_breakpoint_stat {
+  volatile int hit_count;       /* Total hits, updated atomically */
+  volatile int enabled;         /* 0 or 1, < 0 means enabled count
+                                   times */
+  volatile int trace_count;     /* Hits of tracepoint */
+  long long first_time;         /* Realtime of the first and last hit
+                                   of tracepoint in nanoseconds, 0
+                                   means no timestamp */
+  long long last_time;
+};
+
+#define PYDDD_IPA_STATS_MAGIC 0x53444450 /* "PDDS" */
+#define PYDDD_IPA_STATS_VERSION 2
+
+/*
+ * Hit counts and enabled flags of all the breakpoints, indexed by
+ * rindex. It's contiguous and has same layout in all the platforms,
+ * so GDB reads it by one memory read and unpacks it by python module
+ * struct with format "=2iIi" and "=3i4x2q" for each stat.
+ *
+ * Field generation is increased when any stat is changed, GDB needn't
+ * unpack the stats if it's not changed.
+ */
+struct pyddd_ipa_t_breakpoint_stats {
+  int magic;                    /* PYDDD_IPA_STATS_MAGIC */
+  int version;                  /* PYDDD_IPA_STATS_VERSION */
+  volatile unsigned int generation;
+  int count;                    /* Same as pyddd_ipa_breakpoint_counter */
+  struct pyddd_ipa_t_breakpoint_stat stats[PYDDD_IPA_MAX_BREAKPOINT];
+};
+
+/*
+ * Counters of the trace function, GDB reads them to measure how much
+ * work is done in each event. They're updated with GIL, not atomic.
+ */
+#define PYDDD_IPA_TRACE_EVENTS 8
+struct pyddd_ipa_t_trace_counters {
+  unsigned long events[PYDDD_IPA_TRACE_EVENTS]; /* Index is PyTrace_XXX */
+  unsigned long line_candidates; /* Line events passed code filter */
+  unsigned long lineno_lookups;  /* Calls of PyFrame_GetLineNumber */
+  unsigned long filename_lookups; /* Calls of PyString_AsString for
+                                     co_filename */
+  unsigned long code_lookups;    /* Calls of pyddd_ipa_lookup_code */
+};
+
+/* Size of profile table, index size must be power of 2 */
+#define PYDDD_IPA_PROFILE_SIZE 4096
+#define PYDDD_IPA_PROFILE_HASH_SIZE 8192
+#define PYDDD_IPA_PROFILE_HASH(co) \
+  (((unsigned long)(co) >> 4) & (PYDDD_IPA_PROFILE_HASH_SIZE - 1))
+/* Max depth of call stack in each thread */
+#define PYDDD_IPA_PROFILE_DEPTH 256
+#define PYDDD_IPA_PROFILE_NAME_SIZE 48
+#define PYDDD_IPA_PROFILE_FILENAME_SIZE 112
+
+/*
+ * Profile data of one code object, the time is in nanoseconds. Only
+ * the tail of long filename is saved. GDB unpacks it by format
+ * "=3q2i48s112s".
+ */
+struct pyddd_ipa_t_profile_entry {
+  long long call_count;
+  long long total_time;         /* Includes the time of callees */
+  long long self_time;
+  int firstlineno;
+  int recursion;                /* Active calls in all the threads */
+  char name[PYDDD_IPA_PROFILE_NAME_SIZE];
+  char filename[PYDDD_IPA_PROFILE_FILENAME_SIZE];
+};
+
+/*
+ * Profile table, entries are appended in the order of first call, so
+ * GDB reads header "=2i" and count entries by one memory read.
+ */
+struct pyddd_ipa_t_profile {
+  int count;                    /* Number of used entries */
+  int dropped;                  /* Calls not recorded, because the
+                                   table is full or stack is too deep */
+  struct pyddd_ipa_t_profile_entry entries[PYDDD_IPA_PROFILE_SIZE];
+};
+
+struct pyddd_ipa_t_profile_frame {
+  int index;                    /* Entry index, -1 if not recorded */
+  long long start;
+  long long children;           /* Total time of callees */
+};
+
+/* Call stack of one thread, free when thread_id is 0 */
+struct pyddd_ipa_t_profile_thread {
+  long thread_id;
+  int depth;
+  struct pyddd_ipa_t_profile_frame frames[PYDDD_IPA_PROFILE_DEPTH];
+};
+
+/*
+ * Size of sampled stack table, index size must be power of 2. Only
+ * the innermost frames are kept in the deep stack.
+ */
+#define PYDDD_IPA_SAMPLE_SIZE 2048
+#define PYDDD_IPA_SAMPLE_HASH_SIZE 4096
+#define PYDDD_IPA_SAMPLE_DEPTH 64
+
+/*
+ * One distinct python stack, frames are indexes of profile entries,
+ * the outermost frame first. GDB unpacks it by format "=66i".
+ */
+struct pyddd_ipa_t_sample_stack {
+  int count;                    /* Times of this stack sampled */
+  int depth;
+  int frames[PYDDD_IPA_SAMPLE_DEPTH];
+};
+
+/*
+ * Sampled stacks, GDB reads header "=4i" and count stacks by one
+ * memory read.
+ */
+struct pyddd_ipa_t_sample {
+  int count;                    /* Number of used stacks */
+  int dropped;                  /* Stacks not recorded, because the
+                                   table is full */
+  int signals;                  /* Number of timer signals */
+  int samples;                  /* Number of snapshots of all threads */
+  struct pyddd_ipa_t_sample_stack stacks[PYDDD_IPA_SAMPLE_SIZE];
+};
+
+/* Size of log ring, must be power of 2 */
+#define PYDDD_IPA_LOG_SIZE 65536
+#define PYDDD_IPA_LOG_MESSAGE_SIZE 1024
+#define PYDDD_IPA_LOG_ERROR_SIZE 128
+
+/*
+ * Ring of log messages written by logpoints. There is only one
+ * writer, because the trace function runs with GIL, and only GDB
+ * reads it when the inferior is stopped, so no lock is required. The
+ * writer only changes head after the record is written, GDB only
+ * changes tail. GDB unpacks header by format "=2Q2I".
+ */
+struct pyddd_ipa_t_log {
+  volatile unsigned long long head; /* Total bytes written */
+  volatile unsigned long long tail; /* Total bytes read by GDB */
+  volatile unsigned int dropped;    /* Messages dropped when full */
+  unsigned int size;                /* PYDDD_IPA_LOG_SIZE */
+  char data[PYDDD_IPA_LOG_SIZE];
+};
+
+/*
+ * Record of log message in the ring, followed by the message which
+ * ends with '\0', size is aligned to 8 bytes. A record may wrap
+ * around the end of data. GDB unpacks it by format "=2i2q".
+ */
+struct pyddd_ipa_t_log_record {
+  int size;
+  int bpnum;
+  long long thread_id;
+  long long time;               /* Realtime in nanoseconds */
 };
 
 const char * pyddd_ipa_version(void);
+void pyddd_ipa_reset_trace_counters(void);
+
+int pyddd_ipa_profile_start(void);
+int pyddd_ipa_profile_stop(void);
+void pyddd_ipa_profile_reset(void);
+
+int pyddd_ipa_sample_start(int rate);
+int pyddd_ipa_sample_stop(void);
+void pyddd_ipa_sample_reset(void);
+int pyddd_ipa_sample_take(void);
 
 int
 pyddd_ipa_trace_trampoline(PyObject *self,
@@ -51,6 +433,11 @@ pyddd_ipa_profile_trampoline(PyObject *self,
                              PyFrameObject *frame,
                              int what,
                              PyObject *arg);
+int
+pyddd_ipa_module_trampoline(PyObject *self,
+                            PyFrameObject *frame,
+                            int what,
+                            PyObject *arg);
 
 int
 pyddd_ipa_insert_breakpoint(const int bpnum,
@@ -74,6 +461,13 @@ pyddd_ipa_update_breakpoint(const int rindex,
                             const char *filename
                             );
 void pyddd_ipa_remove_breakpoint(const int rindex);
+int pyddd_ipa_load_breakpoints(const int count);
+
+int pyddd_ipa_load_catch_functions(const char *namelist);
+int pyddd_ipa_load_catch_exceptions(const char *namelist);
+
+int pyddd_ipa_update_tracing(void);
+int pyddd_ipa_attach(void);
 
 int pyddd_ipa_step_command(int count);
 int pyddd_ipa_next_command(int count);
@@ -96,6 +490,12 @@ const char * pyddd_ipa_frame_values(PyFrameObject *frame,
 const char * pyddd_ipa_frame_variable(PyFrameObject *frame,
                                       char *varname,
                                       int global);
+int pyddd_ipa_frame_snapshot(PyFrameObject *frame, int global, int maxsize);
+int pyddd_ipa_frame_backtrace(PyFrameObject *frame, int count);
+
+struct pyddd_ipa_t_module * pyddd_ipa_find_module(const char *filename);
+int pyddd_ipa_load_module_filters(const char *filters);
+int pyddd_ipa_load_pending_files(const char *filenames);
 
 int pyddd_ipa_alter_variable(PyFrameObject *frame,
                              char *name,
@@ -113,8 +513,10 @@ const char *pyddd_ipa_format_object(PyObject *o);
 #define FPyEval_EvalCode pyddd_ipa_pyeval_evalcode
 #define FPyEval_SetTrace pyddd_ipa_pyeval_settrace
 #define FPy_DecRef pyddd_ipa_py_decref
+#define FPy_IncRef pyddd_ipa_py_incref
 #define FPyObject_IsTrue pyddd_ipa_pyobject_istrue
 #define FPyThreadState_Get pyddd_ipa_pythreadstate_get
+#define FPyGILState_GetThisThreadState pyddd_ipa_pygilstate_getthisthreadstate
 #define FPyObject_Str pyddd_ipa_pyobject_str
 #define FPyObject_Repr pyddd_ipa_pyobject_repr
 #define FPyTuple_GetItem pyddd_ipa_pytuple_getitem
@@ -130,14 +532,22 @@ const char *pyddd_ipa_format_object(PyObject *o);
 #define FPyErr_Clear pyddd_ipa_pyerr_clear
 #define FPyErr_PrintEx pyddd_ipa_pyerr_printex
 #define FPyErr_Occurred pyddd_ipa_pyerr_occurred
+#define FPyInterpreterState_ThreadHead pyddd_ipa_pyinterpreterstate_threadhead
+#define FPyThreadState_Next pyddd_ipa_pythreadstate_next
+#define FPy_AddPendingCall pyddd_ipa_py_addpendingcall
+#define FPyLong_AsLongAndOverflow pyddd_ipa_pylong_aslongandoverflow
+#define FPyFrame_FastToLocals pyddd_ipa_pyframe_fasttolocals
+#define FPyModule_GetDict pyddd_ipa_pymodule_getdict
 
 extern char* (*FPyString_AsString)(PyObject *o);
 extern int (*FPyFrame_GetLineNumber)(PyFrameObject *frame);
 extern void (*FPy_DecRef)(PyObject *);
+extern void (*FPy_IncRef)(PyObject *);
 extern int (*FPyObject_IsTrue)(PyObject *);
 extern Py_ssize_t (*FPyString_Size)(PyObject *string);
 extern void (*FPyEval_SetTrace)(Py_tracefunc func, PyObject *arg);
 extern PyThreadState* (*FPyThreadState_Get)(void);
+extern PyThreadState* (*FPyGILState_GetThisThreadState)(void);
 extern PyObject* (*FPyObject_Str)(PyObject *o);
 extern PyObject* (*FPyObject_Repr)(PyObject *o);
 extern PyObject* (*FPyTuple_GetItem)(PyObject *p, Py_ssize_t pos);
@@ -160,6 +570,13 @@ extern PyObject* (*FPyIter_Next)(PyObject *o);
 extern void (*FPyErr_Clear)(void);
 extern void (*FPyErr_PrintEx)(int set_sys_last_vars);
 extern PyObject* (*FPyErr_Occurred)(void);
+extern PyThreadState* (*FPyInterpreterState_ThreadHead)
+     (PyInterpreterState *interp);
+extern PyThreadState* (*FPyThreadState_Next)(PyThreadState *tstate);
+extern int (*FPy_AddPendingCall)(int (*func)(void *), void *arg);
+extern long (*FPyLong_AsLongAndOverflow)(PyObject *o, int *overflow);
+extern void (*FPyFrame_FastToLocals)(PyFrameObject *frame);
+extern PyObject* (*FPyModule_GetDict)(PyObject *module);
 extern PyObject* (*FPy_CompileStringFlags)(const char *str,
                                            const char *filename,
                                            int start,
@@ -14,11 +14,18 @@
 from __future__ import with_statement
 
 import ast
+import bisect
+import dis
 import fnmatch
+import hashlib
 import locale
 import os
+import pickle
+import signal
 import sys
-import string
+import struct
+import threading
+import time
 
 import gdb
 from gdb.FrameDecorator import FrameDecorator
@@ -38,11 +45,61 @@ _python_frame_index = -1
 _python_breakpoint_table = []
 _python_catchpoint_table = []
 
-# Used to filter python imported module by fnmatch
+# Used to filter python imported module by fnmatch, applied in python-ipa
 _imported_script_filters = {'includes' : [], 'excludes' : []}
-_imported_script_symbol_table = {}
+class PythonSymbolTable(dict):
+    '''Symbol tables of scripts, {filename: {qualname: lineno}}.
+
+    It also keeps a reverse index {name: set([(filename, qualname)])},
+    name is the last part of qualname, so a function could be found in
+    all the scripts by one hash lookup.
+    '''
+    def __init__(self):
+        super(PythonSymbolTable, self).__init__()
+        self.index = {}
+
+    def __setitem__(self, filename, symbols):
+        if filename in self:
+            self._unindex(filename)
+        super(PythonSymbolTable, self).__setitem__(filename, symbols)
+        for qualname in symbols:
+            self.index.setdefault(qualname.rsplit('.', 1)[-1], set()).add(
+                (filename, qualname))
+
+    def __delitem__(self, filename):
+        self._unindex(filename)
+        super(PythonSymbolTable, self).__delitem__(filename)
+
+    def pop(self, filename, *args):
+        if filename in self:
+            self._unindex(filename)
+        return super(PythonSymbolTable, self).pop(filename, *args)
+
+    def clear(self):
+        self.index.clear()
+        super(PythonSymbolTable, self).clear()
+
+    def _unindex(self, filename):
+        for qualname in self[filename]:
+            name = qualname.rsplit('.', 1)[-1]
+            self.index[name].discard((filename, qualname))
+            if not self.index[name]:
+                del self.index[name]
+
+    def lookup(self, name, filename=None):
+        '''Yield (filename, qualname, lineno) of all the symbols match
+        name, which is qualname or its tail, for example, "run" and
+        "Foo.run" both match "Foo.run".'''
+        for f, qualname in self.index.get(name.rsplit('.', 1)[-1], ()):
+            if (filename is None or f == filename) \
+               and (qualname == name or qualname.endswith('.' + name)):
+                yield f, qualname, self[f][qualname]
+
+# Collect symbols of imported module in python-ipa
+_imported_script_autoload = False
+_imported_script_symbol_table = PythonSymbolTable()
 # Save symbol add by command py-symbol-file
-_python_script_symbol_table = {}
+_python_script_symbol_table = PythonSymbolTable()
 
 #################################################################
 #
@@ -55,6 +112,20 @@ gdb_eval_str = lambda s : gdb.parse_and_eval(s).string()
 gdb_eval_int = lambda s : int(gdb.parse_and_eval(s))
 gdb_output = lambda s, sep='\n' : sys.stdout.write (s + sep)
 target_has_execution = lambda : gdb.selected_inferior ().pid
+to_bytes = lambda s : s if isinstance(s, bytes) else s.encode('utf-8')
+to_str = lambda s : s if isinstance(s, str) else s.decode('utf-8', 'replace')
+
+def read_ipa_data_buffer(n):
+    '''Read n bytes from pyddd_ipa_data_buffer.'''
+    addr = gdb_eval_int('(long)pyddd_ipa_data_buffer')
+    return bytes(gdb.selected_inferior().read_memory(addr, n))
+
+def write_ipa_data_buffer(data):
+    '''Write data into pyddd_ipa_data_buffer by one memory write.'''
+    addr = gdb_eval_int('(long)pyddd_ipa_data_buffer')
+    if len(data) > gdb_eval_int('sizeof(pyddd_ipa_data_buffer)'):
+        raise gdb.GdbError('Too much data for python-ipa')
+    gdb.selected_inferior().write_memory(addr, data)
 
 def list_pending_python_breakpoints(filename=None):
     for bp in _python_breakpoint_table:
@@ -80,27 +151,296 @@ def list_python_catchpoints(name=None, bpnums=None):
             yield bp
 
 def get_symbol_table(filename):
-    return _imported_script_symbol_table.get(
-                filename,
-                _python_script_symbol_table.get(filename, {})
-                )
+    if filename in _imported_script_symbol_table:
+        return _imported_script_symbol_table[filename]
+    if filename in _python_script_symbol_table:
+        return _python_script_symbol_table[filename]
+    # pull symbols from python-ipa if this module has been executed
+    if _imported_script_autoload and target_has_execution():
+        try:
+            result = python_ipa_read_module_symbols(filename)
+        except (gdb.error, gdb.GdbError):
+            result = None
+        if result is not None:
+            _imported_script_symbol_table[filename] = result[1]
+            return result[1]
+    return {}
+
+def lookup_symbol(name, filename=None):
+    '''Return sorted (filename, qualname, lineno) of all the symbols
+    match name, in all the known scripts if filename is None. The
+    symbols in the imported module override the parsed ones.'''
+    if filename is not None:
+        get_symbol_table(filename)
+    result = {}
+    for table in (_python_script_symbol_table,
+                  _imported_script_symbol_table):
+        for f, qualname, lineno in table.lookup(name, filename):
+            result[f, qualname] = lineno
+    return sorted([(f, q, lineno) for (f, q), lineno in result.items()],
+                  key=lambda x : (x[0], x[2]))
+
+def python_ipa_read_module_symbols(filename=None):
+    '''Read symbols of module collected by python-ipa, filename None
+    means the module just added. All the symbols are read by one
+    memory read. Return (filename, {name: lineno}), or None if not
+    found.'''
+    if filename is None:
+        module = gdb_eval('pyddd_ipa_current_module')
+    else:
+        # Filename is passed in the data buffer, it may have backslash
+        # or quote which can't be in C string literal as is
+        write_ipa_data_buffer(to_bytes(filename) + b'\0')
+        module = gdb_eval('pyddd_ipa_find_module(pyddd_ipa_data_buffer)')
+    if int(module) == 0:
+        return None
+    module = module.dereference()
+    size = int(module['size'])
+    symbols = {}
+    if size > 0:
+        fields = bytes(gdb.selected_inferior().read_memory(
+            int(module['symbols']), size
+            )).split(b'\0')
+        for name, lineno in zip(fields[0::2], fields[1::2]):
+            symbols[to_str(name)] = int(lineno)
+    return module['filename'].string(), symbols
+
+def python_ipa_load_lines(func, lines):
+    '''Upload lines to python-ipa by function func.'''
+    write_ipa_data_buffer(to_bytes('\n'.join(lines)) + b'\0')
+    if gdb_eval_int('%s(pyddd_ipa_data_buffer)' % func):
+        raise gdb.GdbError('Out of memory in python-ipa')
+
+def python_ipa_load_autoload():
+    '''Tell python-ipa whether to collect symbols of imported module,
+    and upload filters of imported module. python-ipa checks filters
+    itself, so GDB needn't stop for the ignored modules.'''
+    if target_has_execution():
+        gdb.execute('set var pyddd_ipa_module_autoload = %d' \
+                    % int(_imported_script_autoload))
+        gdb_eval_int('pyddd_ipa_update_tracing()')
+        python_ipa_load_lines(
+            'pyddd_ipa_load_module_filters',
+            ['+' + s for s in _imported_script_filters['includes']] +
+            ['-' + s for s in _imported_script_filters['excludes']]
+            )
+        python_ipa_load_pending_files(force=True)
+
+# (pid, filenames) of last uploaded pending files
+_pending_files_uploaded = None
+
+def python_ipa_load_pending_files(force=False):
+    '''Upload filenames of pending breakpoints, python-ipa stops only
+    when one of these modules is executed.'''
+    global _pending_files_uploaded
+    if target_has_execution():
+        filenames = sorted(set(
+            [bp.filename for bp in list_python_breakpoints()
+             if bp.state == 1 and bp.filename is not None]))
+        key = target_has_execution(), filenames
+        if force or key != _pending_files_uploaded:
+            python_ipa_load_lines('pyddd_ipa_load_pending_files', filenames)
+            _pending_files_uploaded = key
 def resolve_filename_breakpoints(filename):
-    for bp in list_pending_python_breakpoints(filename):
-        if bp._resolve(get_symbol_table(filename)):
-            bp._load()
+    python_ipa_load_breakpoints(
+        [bp for bp in list_pending_python_breakpoints(filename)
+         if bp._resolve(filename)]
+        )
+
+# struct pyddd_ipa_t_breakpoint_record in ipa.h
+_breakpoint_record_format = '=7i4xq3i4x'
+
+def pack_breakpoint_record(bp):
+    condition = to_bytes(bp.condition) + b'\0' if bp.condition else b''
+    filename = to_bytes(bp.filename) + b'\0'
+    message = to_bytes(bp.message) + b'\0' if bp.message else b''
+    s = struct.pack(_breakpoint_record_format,
+                    bp.rindex, bp.bpnum, bp.locnum, bp.ignore_count,
+                    bp.enabled, int(bp.lineno), bp.tracepoint,
+                    int(bp.thread),
+                    len(condition), len(filename), len(message)
+                    ) + condition + filename + message
+    return s + b'\0' * (-len(s) % 8)
+
+def python_ipa_load_breakpoints(bplist):
+    '''Upload breakpoints to python-ipa in bulk.
+
+    Breakpoint records are written into pyddd_ipa_data_buffer by one
+    memory write and loaded by one inferior call, then rindex of all
+    the breakpoints are read back by one memory read.'''
+    if not target_has_execution():
+        return
+    python_ipa_load_pending_files()
+    # pending breakpoints are loaded after they're resolved
+    bplist = [bp for bp in bplist if bp.state != 1]
+    # breakpoints set before the inferior runs are snapped here
+    for bp in bplist:
+        bp._snap()
+    for cache in _python_line_caches.values():
+        cache.save()
+    bplist = [loc for loc in list_breakpoint_locations(bplist)
+              if loc.filename is not None]
+    if not bplist:
+        return
+    inferior = gdb.selected_inferior()
+    addr = gdb_eval_int('(long)pyddd_ipa_data_buffer')
+    size = gdb_eval_int('sizeof(pyddd_ipa_data_buffer)')
+    while bplist:
+        records = []
+        offsets = []
+        n = 0
+        for bp in bplist:
+            s = pack_breakpoint_record(bp)
+            if n + len(s) > size:
+                break
+            records.append(s)
+            offsets.append(n)
+            n += len(s)
+        if not records:
+            raise gdb.GdbError('Breakpoint #%d is too large' % bp.bpnum)
+        inferior.write_memory(addr, b''.join(records))
+        k = gdb_eval_int('pyddd_ipa_load_breakpoints(%d)' % len(records))
+        buf = inferior.read_memory(addr, n)
+        for bp, offset in zip(bplist[:k], offsets):
+            bp.rindex = struct.unpack_from('=i', buf, offset)[0]
+        if k < len(records):
+            raise gdb.GdbError('Only %d breakpoints loaded in python-ipa' % k)
+        bplist = bplist[k:]
 
 def python_ipa_load_catchpoint():
+    '''Upload catch patterns, they're compiled in python-ipa.'''
     if target_has_execution():
-        gdb.execute('set var pyddd_ipa_python_catch_exceptions = %s' % \
-            build_catch_patterns('exception'))
-        gdb.execute('set var pyddd_ipa_python_catch_functions = %s' % \
-            build_catch_patterns('call'))
+        for name, func in (('exception', 'pyddd_ipa_load_catch_exceptions'),
+                           ('call', 'pyddd_ipa_load_catch_functions')):
+            if gdb_eval_int('%s(%s)' % (func, build_catch_patterns(name))):
+                raise gdb.GdbError('Out of memory in python-ipa')
 
 def build_catch_patterns(name):
     return '"%s"' % ' '.join(
         [c.lineno for c in list_python_catchpoints(name) if c.enabled]
         )
 
+# struct pyddd_ipa_t_breakpoint_stats in ipa.h
+_breakpoint_stats_format = '=2iIi'
+_breakpoint_stat_format = '=3i4x2q'
+_breakpoint_stats_magic = 0x53444450
+_breakpoint_stats_version = 2
+# (pid, generation) of last read stats
+_breakpoint_stats_generation = None
+
+def python_ipa_read_breakpoint_stats():
+    '''Update hit_count and enabled of all the breakpoints.
+
+    The used part of stats block in python-ipa is read by one memory
+    read, nothing is changed if generation of stats isn't changed.'''
+    global _breakpoint_stats_generation
+    bplist = [loc for loc in list_breakpoint_locations(
+                  list_python_breakpoints())
+              if loc.rindex != -1]
+    if not bplist:
+        return
+    pid = target_has_execution()
+    n = struct.calcsize(_breakpoint_stats_format)
+    k = struct.calcsize(_breakpoint_stat_format)
+    addr = gdb_eval_int('(long)&pyddd_ipa_breakpoint_stats')
+    buf = gdb.selected_inferior().read_memory(
+        addr, n + k * (max([bp.rindex for bp in bplist]) + 1)
+        )
+    magic, version, generation, count = \
+        struct.unpack_from(_breakpoint_stats_format, buf)
+    if magic != _breakpoint_stats_magic \
+       or version != _breakpoint_stats_version:
+        raise gdb.GdbError('Unsupported version of python-ipa')
+    if _breakpoint_stats_generation == (pid, generation):
+        return
+    _breakpoint_stats_generation = pid, generation
+    owners = {}
+    for bp in bplist:
+        hit_count, enabled, bp.trace_count, first_time, last_time = \
+            struct.unpack_from(_breakpoint_stat_format, buf, n + k * bp.rindex)
+        bp.hit_count = hit_count
+        bp.trace_time = (first_time / 1e9, last_time / 1e9) \
+            if first_time else None
+        if isinstance(bp, PythonBreakpointLocation):
+            owners.setdefault(bp.owner, []).append(enabled)
+        else:
+            bp.enabled = enabled
+    # enabled of multiple locations are counted down separately
+    for bp, values in owners.items():
+        bp.hit_count = sum([loc.hit_count for loc in bp.multiloc])
+        bp.trace_count = sum([loc.trace_count for loc in bp.multiloc])
+        times = [loc.trace_time for loc in bp.multiloc if loc.trace_time]
+        bp.trace_time = (min([x[0] for x in times]),
+                         max([x[1] for x in times])) if times else None
+        bp.enabled = ([x for x in values if x] or [0])[0]
+
+# struct pyddd_ipa_t_trace_counters in ipa.h, events are indexed by
+# PyTrace_XXX, the last one is not used
+_trace_event_names = ('call', 'exception', 'line', 'return',
+                      'c_call', 'c_exception', 'c_return', None)
+_trace_counter_names = ('line candidates', 'lineno lookups',
+                        'filename lookups', 'code lookups')
+
+def python_ipa_read_trace_counters():
+    '''Read counters of trace function by one memory read, return
+    ({event: count}, {counter: count}).'''
+    n = len(_trace_event_names) + len(_trace_counter_names)
+    size = gdb_eval_int('sizeof(pyddd_ipa_trace_counters)')
+    addr = gdb_eval_int('(long)&pyddd_ipa_trace_counters')
+    values = struct.unpack('=%d%s' % (n, 'Q' if size // n == 8 else 'I'),
+                           gdb.selected_inferior().read_memory(addr, size))
+    k = len(_trace_event_names)
+    return (dict([(name, v) for name, v in zip(_trace_event_names, values)
+                  if name is not None]),
+            dict(zip(_trace_counter_names, values[k:])))
+
+_profile_entry_format = '=3q2i48s112s'
+
+def python_ipa_read_table(symbol, header_format, item_format):
+    '''Read a table in python-ipa by two memory reads, the header
+    starts with the number of items. Return (header, data of items).'''
+    header = struct.calcsize(header_format)
+    addr = gdb_eval_int('(long)&%s' % symbol)
+    inferior = gdb.selected_inferior()
+    values = struct.unpack(header_format, inferior.read_memory(addr, header))
+    if not values[0]:
+        return values, b''
+    size = values[0] * struct.calcsize(item_format)
+    return values, inferior.read_memory(addr + header, size)
+
+def python_ipa_read_profile():
+    '''Read profile table by one memory read, return (dropped,
+    [(name, filename, lineno, calls, total, self)]), time in seconds.
+    All the entries are returned, the index is used by sampled
+    stacks.'''
+    (count, dropped), data = python_ipa_read_table(
+        'pyddd_ipa_profile', '=2i', _profile_entry_format)
+    size = struct.calcsize(_profile_entry_format)
+    entries = []
+    for i in range(count):
+        calls, total, self_, lineno, recursion, name, filename = \
+            struct.unpack_from(_profile_entry_format, data, i * size)
+        entries.append((to_str(name.split(b'\0')[0]),
+                        to_str(filename.split(b'\0')[0]),
+                        lineno, calls, total / 1e9, self_ / 1e9))
+    return dropped, entries
+
+# struct pyddd_ipa_t_sample_stack in ipa.h
+_sample_stack_format = '=66i'
+
+def python_ipa_read_samples():
+    '''Read sampled stacks by one memory read, return ((dropped,
+    signals, samples), [(count, [entry index])]), the outermost frame
+    first.'''
+    values, data = python_ipa_read_table(
+        'pyddd_ipa_sample', '=4i', _sample_stack_format)
+    size = struct.calcsize(_sample_stack_format)
+    stacks = []
+    for i in range(values[0]):
+        item = struct.unpack_from(_sample_stack_format, data, i * size)
+        stacks.append((item[0], item[2:2+item[1]]))
+    return values[1:], stacks
+
 def python_breakpoint_hit_command_list():
     '''Do after a python script breakpoint is hit.'''
     gdb.execute('python-ipa-frame setup')
@@ -184,10 +524,7 @@ class PythonInternalLineBreakpoint (gdb.Breakpoint):
 
     def stop (self):
         # update hit count of all breakpoints from pyddd ipa
-        rtable = gdb.parse_and_eval('pyddd_ipa_breakpoint_table')
-        for bp in list_python_breakpoints():
-            if bp.rindex != -1:
-                bp.hit_count = int(rtable[bp.rindex]['hit_count'])
+        python_ipa_read_breakpoint_stats()
         # stop at bpnum
         bpnum = gdb_eval_int('pyddd_ipa_current_breakpoint->bpnum')
         locnum = gdb_eval_int('pyddd_ipa_current_breakpoint->locnum')
@@ -200,7 +537,7 @@ class PythonInternalLineBreakpoint (gdb.Breakpoint):
             bp._info()
             # if bp is temporary, remove it
             if bp.temporary:
-                _python_breakpoint_table.pop(bp)
+                _python_breakpoint_table.remove(bp)
                 bp._unload()
         python_breakpoint_hit_command_list()
         return True
@@ -245,120 +582,59 @@ class PythonInternalStartupBreakpoint (gdb.Breakpoint):
         self.enabled = False
         return False
 
-class PythonInternalImportModuleBreakpoint (gdb.Breakpoint):
+class PythonInternalModuleBreakpoint (gdb.Breakpoint):
     '''This is an internal breakpoint.
 
-        PyObject* PyImport_ExecCodeModuleEx(
-            char *name,
-            PyObject *co,
-            char *pathname)
+    python-ipa stops here after it collects symbols of one module,
+    only if there is any pending breakpoint in this module.
     '''
-
-    def __init__(self, cobp):
-        super(PythonInternalImportModuleBreakpoint, self).__init__(
-            spec="PyImport_ExecCodeModuleEx",
+    def __init__(self):
+        super(PythonInternalModuleBreakpoint, self).__init__(
+            spec="pyddd_ipa_module_addr",
             internal=True,
             )
         self.silent = True
-        self.enabled = False
-        self._cobp = cobp
-        self._argoffset = None
-        self._exprs = \
-            '{char*}($fp+0x%x)', \
-            '{PyObject*}($fp+0x%x)', \
-            '{char*}($fp+0x%x)'
-        self._args = \
-            'sizeof($fp)+sizeof($pc)', \
-            'sizeof($fp)+sizeof($pc)+sizeof(char*)', \
-            'sizeof($fp)+sizeof($pc)+sizeof(char*)+sizeof(PyObject*)'
 
     def stop (self):
-        '''Filter module'''
-        pathname = self._argvalue(2)
-        name = self._argvalue(0)
-        enabled = True
-        for s in _imported_script_filters['includes']:
-            if fnmatch.fnmatch(pathname, s):
-                enabled = True
-                break
-            elif enabled:
-                enabled = False
-        if enabled:
-            for s in _imported_script_filters['excludes']:
-                if fnmatch.fnmatch(pathname, s):
-                    enabled = False
-                    break
-        self._cobp.enabled = enabled
+        result = python_ipa_read_module_symbols()
+        if result is not None:
+            filename, symbols = result
+            _imported_script_symbol_table[filename] = symbols
+            resolve_filename_breakpoints(filename)
         return False
 
-    def _argvalue(self, index):
-        if self._argoffset is None:
-            self._argoffset = \
-                gdb_eval_int(self._args[0]), \
-                gdb_eval_int(self._args[1]), \
-                gdb_eval_int(self._args[2])
-        return gdb_eval_str(self._exprs[index] % self._argoffset[index])
-
-class PythonInternalNewCodeObjectBreakpoint (gdb.Breakpoint):
+class PythonInternalAttachBreakpoint (gdb.Breakpoint):
     '''This is an internal breakpoint.
-        PyCodeObject *PyCode_New(int argcount,
-                                 int nlocals,
-                                 int stacksize,
-                                 int flags,
-                                 PyObject *code,
-                                 PyObject *consts,
-                                 PyObject *names,
-                                 PyObject *varnames,
-                                 PyObject *freevars,
-                                 PyObject *cellvars,
-                                 PyObject *filename,
-                                 PyObject *name,
-                                 int firstlineno,
-                                 PyObject *lnotab)
+
+    python-ipa stops here once after it's attached to a running python
+    process, all the imported modules will never be executed again, so
+    their symbols are loaded from the source files by one pass.
     '''
     def __init__(self):
-        super(PythonInternalNewCodeObjectBreakpoint, self).__init__(
-            spec="PyCode_New",
+        super(PythonInternalAttachBreakpoint, self).__init__(
+            spec="pyddd_ipa_attach_addr",
             internal=True,
             )
         self.silent = True
-        self.enabled = False
-        self._symbol_table = {}
-        self._argoffset = None
-        self._exprs = \
-            '(char*)(PyString_AsString({PyObject*}($fp+0x%x)))', \
-            '(char*)(PyString_AsString({PyObject*}($fp+0x%x)))', \
-            '(int)({int*}($fp+0x%x))'
-        self._args = \
-            'sizeof($fp)+sizeof($pc)+sizeof(int)*4+sizeof(PyObject*)*6', \
-            'sizeof($fp)+sizeof($pc)+sizeof(int)*4+sizeof(PyObject*)*7', \
-            'sizeof($fp)+sizeof($pc)+sizeof(int)*4+sizeof(PyObject*)*8'
 
     def stop (self):
-        self._add_symbol(
-            self._argvalue(0).string(),
-            self._argvalue(1).string(),
-            int(self._argvalue(2)),
-            )
+        size = gdb_eval_int('pyddd_ipa_attach_size')
+        filelist = [to_str(s) for s in
+                    read_ipa_data_buffer(size).split(b'\0')[:-1]]
+        start = time.time()
+        cached, parsed, failed = load_symbol_files(
+            filelist, _imported_script_symbol_table)
+        gdb_output ('Load symbols of %d imported modules (%d cached, '
+                    '%d parsed, %d failed) in %.2f seconds'
+                    % (cached + parsed, cached, parsed, failed,
+                       time.time() - start))
+        filenames = set([bp.filename for bp in
+                         list_pending_python_breakpoints()])
+        for filename in filenames:
+            if filename in _imported_script_symbol_table:
+                resolve_filename_breakpoints(filename)
         return False
 
-    def _argvalue(self, index):
-        if self._argoffset is None:
-            self._argoffset = \
-                gdb_eval_int(self._args[0]), \
-                gdb_eval_int(self._args[1]), \
-                gdb_eval_int(self._args[2])
-        return gdb_eval(self._exprs[index] % self._argoffset[index])
-
-    def _add_symbol(self, filename, symbol, lineno):
-        if symbol == '<module>':
-            self.enabled = False
-            _imported_script_symbol_table[filename] = self._symbol_table
-            self._symbol_table = {}
-            resolve_filename_breakpoints(filename)
-        else:
-            self._symbol_table[symbol] = lineno
-
 #################################################################
 #
 # Part: Python Script Breakpoint
@@ -374,13 +650,28 @@ class PythonBreakpoint (object):
         state           0  fixed
                         1  pending
                         2  resolved
-        In future:
 
-        multiloc        A tuple for breakpoint has multiple addresses
-          (rindex, enabled, hit_count, filename, lineno), ...
+        funcname        Function name in the location, and offset
+        offset          is the line offset from this function
+
+        multiloc        A list of PythonBreakpointLocation for
+                        breakpoint has multiple addresses, filename
+                        is None in this case
+
+        tracepoint      0  normal breakpoint
+                        1  tracepoint, only count hits
+                        2  tracepoint, count hits and timestamps
+                        3  logpoint, also log message
+
+        message         Python expression of log message
+        format          FORMAT of logpoint, message is compiled
+                        from it
+
+        trace_count     Hits of tracepoint, and realtime of the first
+        trace_time      and last hit in seconds, None if no timestamp
     '''
     BP_COUNTER = 0
-    def __init__(self, spec, temporary=0):
+    def __init__(self, spec, temporary=0, tracepoint=0):
         super(PythonBreakpoint, self).__init__()
         self.rindex = -1
         self.location = spec
@@ -391,15 +682,25 @@ class PythonBreakpoint (object):
         self.hit_count = 0
         self.condition = 0
         self.visible = 1
+        self.tracepoint = tracepoint
+        self.message = None
+        self.format = None
+        self.trace_count = 0
+        self.trace_time = None
 
         self.filename = None
         self.lineno = 0
+        self.locnum = 0
         self.multiloc = None
         self.state = 0
+        self.funcname = None
+        self.offset = 0
         self._parse(spec)
+        if self.state == 0:
+            self._snap()
 
-        self.BP_COUNTER += 1
-        self.bpnum = self.BP_COUNTER
+        PythonBreakpoint.BP_COUNTER += 1
+        self.bpnum = PythonBreakpoint.BP_COUNTER
 
     def is_valid (self):
         return True
@@ -429,15 +730,23 @@ class PythonBreakpoint (object):
 
     def _parse1(self, arg):
         filename = PythonIPAFrameCommand.current_filename()
-        if filename is None:
-            raise gdb.GdbError('There is no script')
         try:
             offset = int(arg)
         except ValueError:
             offset = None
         if offset is None:
-            self._parsen(filename, arg)
+            # search function in all the scripts, pending in the
+            # current script if not found
+            if filename is not None:
+                get_symbol_table(filename)
+            self._parsen(None, arg)
+            if self.state == 1:
+                if filename is None:
+                    raise gdb.GdbError('Function "%s" not defined' % arg)
+                self.filename = filename
         else:
+            if filename is None:
+                raise gdb.GdbError('There is no script')
             lineno = offset
             if arg[0] in '+-':
                 lineno += PythonIPAFrameCommand.current_lineno()
@@ -456,10 +765,8 @@ class PythonBreakpoint (object):
             else:
                 self._parsen(arg1, arg2)
         elif arg2.isdigit():
-            k = int(arg2)
+            self.offset = int(arg2)
             self._parsen(PythonIPAFrameCommand.current_filename(), arg1)
-            if self.state == 2:
-                self.lineno += k
         elif arg1 in ('exception', 'call'):
             self.filename = arg1
             self.lineno = arg2
@@ -468,44 +775,123 @@ class PythonBreakpoint (object):
             raise gdb.GdbError('Invalid breakpoint location')
 
     def _parse3(self, filename, funcname, offset):
-        k = int(offset)
+        self.offset = int(offset)
         self._parsen(filename, funcname)
-        if self.state == 2:
-            self.lineno += k
 
     def _parsen(self, filename, funcname):
-        if self._resolve(get_symbol_table(filename)):
-            self.filename = filename
+        # filename is also set for pending breakpoint, so it could be
+        # resolved when this file is imported
+        self.filename = filename
+        self.funcname = funcname
+        self._resolve(filename)
 
-    def _resolve(self, symtable):
-        '''Only find first location, multi-location is not implemented.'''
+    def _resolve(self, filename=None):
+        '''Resolve funcname to all the matched locations, search all
+        the known scripts if filename is None.'''
         self.state = 1
-        for name in symtable:
-            if self.location == name:
-                self.lineno = symtable[name]
-                self.state = 2
-                return True
+        matches = lookup_symbol(self.funcname, filename)
+        if not matches:
+            return False
+        self.state = 2
+        if len(matches) == 1:
+            self.filename = matches[0][0]
+            self.lineno = matches[0][2] + self.offset
+            self.multiloc = None
+        else:
+            self.filename = None
+            self.lineno = 0
+            self.multiloc = [
+                PythonBreakpointLocation(self, i + 1, f, lineno + self.offset)
+                for i, (f, qualname, lineno) in enumerate(matches)
+                ]
+        self._snap()
+        return True
+
+    def _snap(self):
+        '''Move each address to the next executable line.'''
+        for loc in list_breakpoint_locations([self]):
+            if loc.filename is not None:
+                loc.lineno = snap_breakpoint_lineno(loc.filename, loc.lineno)
+
+    def _locations(self):
+        '''Return list of (filename, lineno) of this breakpoint.'''
+        return [(loc.filename, int(loc.lineno))
+                for loc in list_breakpoint_locations([self])]
 
     def _load(self):
-        if target_has_execution():
-            s = string.Template(
-                '$bpnum, $locnum, $thread, $condition, ' \
-                ' $ignore_count, $enabled, $lineno, "$filename"'
-                ).substitute(self.__dict__, locnum=0)
-            if self.rindex == -1:
-                i = gdb_eval_int('pyddd_ipa_insert_breakpoint(%s)' % s)
-                self.rindex = i
-            else:
-                gdb.execute('call pyddd_ipa_update_breakpoint(%d, %s)' \
-                    % (self.rindex, s))
+        python_ipa_load_breakpoints([self])
 
     def _unload(self):
-        if target_has_execution() and self.rindex != -1:
-            gdb.execute('call pyddd_ipa_remove_breakpoint(%d)' % self.rindex)
+        if target_has_execution():
+            for loc in list_breakpoint_locations([self]):
+                if loc.rindex != -1:
+                    gdb.execute('call pyddd_ipa_remove_breakpoint(%d)'
+                                % loc.rindex)
 
     def _info(self):
-        gdb_output ('bpnum=%d, location=%s, hit_count=%s' % \
-            (self.bpnum, self.location, self.hit_count))
+        if self.tracepoint:
+            gdb_output ('tpnum=%d, location=%s, hit_count=%s, %s' % \
+                (self.bpnum, self.location, self.hit_count,
+                 format_trace_count(self.trace_count, self.trace_time)))
+        else:
+            gdb_output ('bpnum=%d, location=%s, hit_count=%s' % \
+                (self.bpnum, self.location, self.hit_count))
+        if self.format is not None:
+            gdb_output ('  format "%s"' % self.format)
+        if self.multiloc is not None:
+            for loc in self.multiloc:
+                gdb_output ('  %d.%d %s:%s, hit_count=%s%s' % \
+                    (self.bpnum, loc.locnum, loc.filename, loc.lineno,
+                     loc.hit_count,
+                     ', ' + format_trace_count(loc.trace_count, loc.trace_time)
+                     if self.tracepoint else ''))
+
+def format_trace_count(count, times):
+    '''Show hits of tracepoint, and the time range and rate if there
+    are timestamps.'''
+    if not times:
+        return 'trace_count=%d' % count
+    first, last = times
+    rate = count / (last - first) if last > first else 0
+    return 'trace_count=%d, first=%s.%06d, last=%s.%06d, %.1f hits/s' % \
+        (count,
+         time.strftime('%H:%M:%S', time.localtime(first)),
+         int(first % 1 * 1e6),
+         time.strftime('%H:%M:%S', time.localtime(last)),
+         int(last % 1 * 1e6),
+         rate)
+
+class PythonBreakpointLocation(object):
+    '''One address of breakpoint which has multiple locations, it's
+    loaded in python-ipa as a separate breakpoint with same bpnum. The
+    other fields are got from the owner breakpoint.'''
+    def __init__(self, owner, locnum, filename, lineno):
+        self.owner = owner
+        self.locnum = locnum
+        self.rindex = -1
+        self.filename = filename
+        self.lineno = lineno
+        self.hit_count = 0
+        self.trace_count = 0
+        self.trace_time = None
+
+    bpnum = property(lambda self : self.owner.bpnum)
+    enabled = property(lambda self : self.owner.enabled)
+    ignore_count = property(lambda self : self.owner.ignore_count)
+    condition = property(lambda self : self.owner.condition)
+    thread = property(lambda self : self.owner.thread)
+    tracepoint = property(lambda self : self.owner.tracepoint)
+    message = property(lambda self : self.owner.message)
+
+def list_breakpoint_locations(bplist):
+    '''Yield each address of breakpoints, it's the breakpoint itself
+    or its PythonBreakpointLocation.'''
+    for bp in bplist:
+        if bp.multiloc is None:
+            yield bp
+        else:
+            for loc in bp.multiloc:
+                yield loc
 
 #################################################################
 #
@@ -527,6 +913,8 @@ class PythonBreakpoint (object):
 #  Breakpoint commands:
 #    py-break
 #    py-tbreak
+#    py-trace
+#    py-logpoint
 #    py-rbreak
 #    py-clear
 #    py-catch
@@ -555,14 +943,13 @@ class PythonIPALoadDataCommand(gdb.Command):
         self.dont_repeat()
         # upload catchpoints to python-ipa
         python_ipa_load_catchpoint()
+        python_ipa_load_autoload()
         # upload breakpoints to python-ipa
-        for bp in list_python_breakpoints():
+        bplist = list(list_python_breakpoints())
+        for loc in list_breakpoint_locations(bplist):
             # Reset rindex, force new breakpoint in ipa
-            bp.rindex = -1
-            if bp.filename is not None:
-                bp._load()
-            elif bp.multiloc is not None:
-                raise NotImplementedError('multi-locations')
+            loc.rindex = -1
+        python_ipa_load_breakpoints(bplist)
 
 class PythonFileCommand(gdb.Command):
     '''
@@ -596,7 +983,14 @@ class PythonSymbolFileCommand(gdb.Command):
            py-symbol-file add FILENAME
     Parse FILENAME, get lineno of each function/class, add to symbol
     table. These information is used to resolve symbol in breakpoint
-    location to filename:lineno.
+    location to filename:lineno. The parsed symbols are cached in
+    $PYDDD_CACHE_DIR (default ~/.cache/pyddd), unchanged files are
+    not parsed again in the next session.
+
+    Usage: py-symbol-file add-tree DIR [PATTERN]
+    Add all the scripts match PATTERN (default "*.py") in the
+    directory tree DIR, hidden directories are skipped. The changed
+    scripts are parsed by a pool of processes if possible.
 
     Usage: py-symbol-file clear
     Clear the whole symbol table.
@@ -604,6 +998,9 @@ class PythonSymbolFileCommand(gdb.Command):
     Usage: py-symbol-file clear autoload
     Clear only those symbol file imported in running time.
 
+    Usage: py-symbol-file clear cache
+    Clear the cache of symbols and executable lines on disk.
+
     Usage: py-symbol-file clear FILENAME
     Clear all the symbol belong to FILENAME.
 
@@ -631,24 +1028,26 @@ class PythonSymbolFileCommand(gdb.Command):
                               gdb.COMMAND_FILES,
                               gdb.COMPLETE_FILENAME,
                               )
-        self._cobp = PythonInternalNewCodeObjectBreakpoint()
-        self._imbp = PythonInternalImportModuleBreakpoint(self._cobp)
 
     def invoke(self, args, from_tty):
+        global _imported_script_autoload
         self.dont_repeat()
         try:
             cmd, args = args.split(' ', 1)
         except Exception:
             cmd, args = args, ''
         if 'disable'.startswith(cmd):
-            self._imbp.enabled = False
-            self._cobp.enabled = False
+            _imported_script_autoload = False
+            python_ipa_load_autoload()
             gdb_output('Disabled autoload imported symbol')
         elif 'enable'.startswith(cmd):
-            self._imbp.enabled = True
+            _imported_script_autoload = True
+            python_ipa_load_autoload()
             gdb_output('Enabled autoload imported symbol')
         elif 'clear'.startswith(cmd):
             self._clear(args)
+        elif cmd == 'add-tree':
+            self._add_tree(args)
         elif 'add'.startswith(cmd):
             self._add(args)
         elif 'filter'.startswith(cmd):
@@ -667,6 +1066,11 @@ class PythonSymbolFileCommand(gdb.Command):
             if 'autoload'.startswith(args):
                 _imported_script_symbol_table.clear()
                 gdb_output ('Imported python symbol tables are cleared')
+            elif args == 'cache':
+                _python_symbol_cache.clear()
+                _python_symbol_cache.save()
+                clear_line_caches()
+                gdb_output ('Python symbol cache is cleared')
             elif args in _python_script_symbol_table:
                 _python_script_symbol_table.pop(args)
                 gdb_output ('Remove "%s" from python symbol table' % args)
@@ -675,25 +1079,53 @@ class PythonSymbolFileCommand(gdb.Command):
 
     def _add(self, args):
         arglist = gdb.string_to_argv(args)
-        for filename in arglist:
-            if os.path.exists(filename):
-                s = PythonSymbolList(filename)
-                s.load()
-                _python_script_symbol_table[filename] = dict(s)
-                gdb_output ('Add "%s" to python symbol table' % filename)
-            else:
-                raise gdb.GdbError('File "%s" not found' % filename)
+        try:
+            for filename in arglist:
+                if os.path.exists(filename):
+                    s = PythonSymbolList(filename)
+                    _python_script_symbol_table[filename] = dict(s)
+                    gdb_output ('Add "%s" to python symbol table' % filename)
+                else:
+                    raise gdb.GdbError('File "%s" not found' % filename)
+        finally:
+            _python_symbol_cache.save()
+
+    def _add_tree(self, args):
+        arglist = gdb.string_to_argv(args)
+        if len(arglist) not in (1, 2):
+            raise gdb.GdbError('Usage: py-symbol-file add-tree DIR [PATTERN]')
+        if not os.path.isdir(arglist[0]):
+            raise gdb.GdbError('Directory "%s" not found' % arglist[0])
+        pattern = arglist[1] if len(arglist) == 2 else '*.py'
+
+        start = time.time()
+        filelist = []
+        for root, dirs, files in os.walk(arglist[0]):
+            dirs[:] = sorted([s for s in dirs if not s.startswith('.')])
+            for s in sorted(fnmatch.filter(files, pattern)):
+                filelist.append(os.path.join(root, s))
+        cached, parsed, failed = load_symbol_files(
+            filelist, _python_script_symbol_table)
+        elapsed = time.time() - start
+        total = cached + parsed
+        gdb_output ('Add %d files to python symbol table (%d cached, '
+                    '%d parsed, %d failed) in %.2f seconds, '
+                    '%.0f files per second'
+                    % (total, cached, parsed, failed, elapsed,
+                       total / elapsed if elapsed > 0 else total))
 
     def _update(self, args):
         raise NotImplementedError('py-symbol-file update')
 
     def _info(self, args):
         gdb_output ('Autoload imported symbol state: %s' % \
-            'enabled' if self._imbp.enabled else 'disabled')
+            ('enabled' if _imported_script_autoload else 'disabled'))
         gdb_output ('Include filters: %s' % \
             str(_imported_script_filters['includes']))
         gdb_output ('Exclude filters: %s' % \
             str(_imported_script_filters['excludes']))
+        gdb_output ('Symbol cache directory: %s' % \
+            (_python_symbol_cache.path or 'disabled'))
         gdb_output ('Python symbol tables:')
         gdb_output (' '.join(_python_script_symbol_table.keys()))
         gdb_output ('Auto imported symbol tables:')
@@ -702,7 +1134,8 @@ class PythonSymbolFileCommand(gdb.Command):
     def _filter(self, args):
         if 'clear'.startswith(args):
             for k in _imported_script_filters:
-                _imported_script_filters[:] = []
+                _imported_script_filters[k][:] = []
+            python_ipa_load_autoload()
             gdb_output ('Python symbol filters are cleared')
         else:
             for arg in gdb.string_to_argv(args):
@@ -712,6 +1145,7 @@ class PythonSymbolFileCommand(gdb.Command):
                 else:
                     _imported_script_filters['includes'].append(arg)
                     gdb_output ('Added include filter "%s"' % arg)
+            python_ipa_load_autoload()
 
 class PythonRunCommand(gdb.Command):
     '''
@@ -746,7 +1180,7 @@ class PythonRunCommand(gdb.Command):
             fmt = 'set args %s %s %s'
             gdb_output ('load symbols from main script')
             s = PythonSymbolList(_python_main_script)
-            s.load()
+            _python_symbol_cache.save()
             _python_script_symbol_table[_python_main_script] = dict(s)
         else:
             fmt = 'set args %s -c "%s" %s'
@@ -756,6 +1190,39 @@ class PythonRunCommand(gdb.Command):
         gdb.execute('py-symbol-file disable autoload')
         gdb.execute('run')
 
+class PythonAttachCommand(gdb.Command):
+    '''
+    Attach to a running python process
+
+    Usage: py-attach PID
+    Wrap gdb command 'attach', then load python-ipa into the process,
+    for example,
+      (gdb) py-exec-file python
+      (gdb) py-attach 1234
+      (gdb) py-break foo.py:12
+      (gdb) py-continue
+
+    The trace function is installed and the symbols of the imported
+    modules are loaded when python executes the next bytecode in the
+    main thread, so it's done after continue.
+    '''
+    def __init__(self):
+        gdb.Command.__init__ (self,
+                              'py-attach',
+                              gdb.COMMAND_RUNNING,
+                              gdb.COMPLETE_NONE,
+                              )
+
+    def invoke(self, args, from_tty):
+        self.dont_repeat()
+        try:
+            pid = int(args)
+        except ValueError:
+            raise gdb.GdbError('Usage: py-attach PID')
+        gdb.execute('attach %d' % pid)
+        gdb.execute('python-ipa-attach')
+        gdb.execute('py-symbol-file enable autoload')
+
 class PythonExecArgsCommand(gdb.Command):
     '''
     Set arguments to be passed to python, not to python scripts.
@@ -863,7 +1330,11 @@ class PythonBreakpointCommand(gdb.Command):
     Add breakpoint in the LINENO of current file.
 
     Usage: py-break FUNCTION
-    Add breakpoint in the FUNCTION of current file.
+    Add breakpoint in the FUNCTION of all the known scripts, the
+    breakpoint has multiple locations if FUNCTION is found in more
+    than one place. FUNCTION could be qualified name, for example,
+    "run", "Foo.run" and "outer.<locals>.inner". If it's not found,
+    add pending breakpoint in the current file.
 
     Usage: py-break FILENAME:LINENO
     Add breakpoint in the FILENAME:LINEO
@@ -882,15 +1353,21 @@ class PythonBreakpointCommand(gdb.Command):
                               gdb.COMPLETE_LOCATION,
                               )
         self._temporary = temporary
+        self._tracepoint = 0
 
     def invoke(self, args, from_tty):
         self.dont_repeat()
         arglist = gdb.string_to_argv(args)
+        tracepoint = self._tracepoint
+        if tracepoint and arglist and arglist[0] == '/t':
+            tracepoint = 2
+            arglist.pop(0)
         try:
             spec = arglist[0]
         except IndexError:
             spec = ''
-        bp = PythonBreakpoint(spec, temporary=self._temporary)
+        bp = PythonBreakpoint(spec, temporary=self._temporary,
+                              tracepoint=tracepoint)
         try:
             bp.condition = arglist[2]
         except IndexError:
@@ -912,6 +1389,130 @@ class PythonTempBreakpointCommand(PythonBreakpointCommand):
             temporary=True
             )
 
+class PythonTracepointCommand(PythonBreakpointCommand):
+    '''
+    Create python script tracepoints.
+
+    Usage: py-trace [/t] LOCATION [if cond]
+    Same as py-break, but the tracepoint never stops the script, it
+    only counts the hits in python-ipa. With /t the realtime of the
+    first and last hit are also recorded.
+
+    Use py-info to read the counters of all the tracepoints.
+    '''
+    def __init__(self):
+        super(PythonTracepointCommand, self).__init__(name='py-trace')
+        self._tracepoint = 1
+
+def compile_log_format(fmt):
+    '''Convert log format "text {expr} text" to python expression
+    which is evaluated in python-ipa, "{{" and "}}" are literal
+    braces.'''
+    text = []
+    exprs = []
+    i = 0
+    n = len(fmt)
+    while i < n:
+        c = fmt[i]
+        if c in '{}' and fmt[i+1:i+2] == c:
+            text.append(c)
+            i += 2
+        elif c == '{':
+            k = fmt.find('}', i)
+            if k == -1 or not fmt[i+1:k].strip():
+                raise gdb.GdbError('Invalid log format "%s"' % fmt)
+            exprs.append('(%s)' % fmt[i+1:k])
+            text.append('%s')
+            i = k + 1
+        elif c == '}':
+            raise gdb.GdbError('Single "}" in log format "%s"' % fmt)
+        else:
+            text.append('%%' if c == '%' else c)
+            i += 1
+    expr = '%r %% (%s)' % (''.join(text), ''.join([x + ',' for x in exprs]))
+    try:
+        compile(expr, '', 'eval')
+    except SyntaxError:
+        raise gdb.GdbError('Invalid expression in log format "%s"' % fmt)
+    return expr
+
+# struct pyddd_ipa_t_log and pyddd_ipa_t_log_record in ipa.h
+_log_format = '=2Q2I'
+_log_record_format = '=2i2q'
+
+def python_ipa_read_log():
+    '''Drain the log ring by one memory read, then move its tail by
+    one memory write. Return (dropped, [(bpnum, thread_id, time,
+    message)]), time in seconds.'''
+    inferior = gdb.selected_inferior()
+    addr = gdb_eval_int('(long)&pyddd_ipa_log')
+    k = struct.calcsize(_log_format)
+    size = gdb_eval_int('sizeof(pyddd_ipa_log)') - k
+    buf = inferior.read_memory(addr, k + size)
+    head, tail, dropped, size = struct.unpack_from(_log_format, buf)
+    start = tail % size
+    data = bytes(buf[k:k+size])
+    data = (data[start:] + data[:start])[:head - tail]
+    inferior.write_memory(addr + 8, struct.pack('=QI', head, 0))
+    result = []
+    n = struct.calcsize(_log_record_format)
+    i = 0
+    while i < len(data):
+        rsize, bpnum, thread_id, t = \
+            struct.unpack_from(_log_record_format, data, i)
+        message = data[i+n:i+rsize].split(b'\0')[0]
+        result.append((bpnum, thread_id, t / 1e9, to_str(message)))
+        i += rsize
+    return dropped, result
+
+class PythonLogpointCommand(PythonBreakpointCommand):
+    '''
+    Create python script logpoints.
+
+    Usage: py-logpoint LOCATION "FORMAT" [if cond]
+    Same as py-trace, but each time the logpoint is hit, the message
+    is formatted in the frame and appended to the log ring in
+    python-ipa. Python expression in the braces of FORMAT is
+    evaluated, for example, "i={i} name={self.name}". Use "{{" and
+    "}}" for literal braces.
+
+    Usage: py-logpoint dump
+    Print all the messages in the log ring and empty it.
+    '''
+    def __init__(self):
+        super(PythonLogpointCommand, self).__init__(name='py-logpoint')
+        self._tracepoint = 3
+
+    def invoke(self, args, from_tty):
+        self.dont_repeat()
+        arglist = gdb.string_to_argv(args)
+        if arglist == ['dump']:
+            self._dump()
+            return
+        if len(arglist) < 2:
+            raise gdb.GdbError('Usage: py-logpoint LOCATION "FORMAT" [if cond]')
+        message = compile_log_format(arglist[1])
+        bp = PythonBreakpoint(arglist[0], tracepoint=self._tracepoint)
+        bp.message = message
+        bp.format = arglist[1]
+        if len(arglist) > 3 and arglist[2] == 'if':
+            bp.condition = arglist[3]
+        _python_breakpoint_table.append(bp)
+        bp._load()
+        bp._info()
+
+    def _dump(self):
+        if not target_has_execution():
+            raise gdb.GdbError('The program is not being run.')
+        dropped, messages = python_ipa_read_log()
+        for bpnum, thread_id, t, message in messages:
+            gdb_output ('[%s.%06d] #%d %s' % \
+                (time.strftime('%H:%M:%S', time.localtime(t)),
+                 int(t % 1 * 1e6), bpnum, message))
+        if dropped:
+            gdb_output ('%d messages are dropped, the log ring is full'
+                        % dropped)
+
 class PythonClearCommand(gdb.Command):
     '''
     Clear python script breakpoints or catchpoints.
@@ -946,12 +1547,10 @@ class PythonClearCommand(gdb.Command):
             self._clear_breakpoint(args)
 
     def _clear_breakpoint(self, location):
-        bp = PythonBreakpoint(location)
-        filename = bp.filename
-        lineno = bp.lineno
+        locations = set(PythonBreakpoint(location)._locations())
         bplist = []
         for bp in list_python_breakpoints():
-            if bp.lineno == lineno and bp.filename == filename:
+            if locations.intersection(bp._locations()):
                 bplist.append(bp)
         for bp in bplist:
             _python_breakpoint_table.remove(bp)
@@ -1069,7 +1668,8 @@ class PythonEnableCommand(gdb.Command):
 
     def _enable_breakpoints(self, args, enabled=0, temporary=False):
         arglist = [int(x) for x in args.split()]
-        for bp in list_python_breakpoints(arglist):
+        bplist = list(list_python_breakpoints(arglist))
+        for bp in bplist:
             if enabled:
                 bp.enabled = enabled
                 if enabled > 0:
@@ -1081,7 +1681,7 @@ class PythonEnableCommand(gdb.Command):
             if temporary:
                 bp.temporary = temporary
                 gdb_output ('Make breakpoint #%d volatile' % bp.bpnum)
-            bp._load()
+        python_ipa_load_breakpoints(bplist)
 
 class PythonDisableCommand(gdb.Command):
     '''
@@ -1106,10 +1706,11 @@ class PythonDisableCommand(gdb.Command):
             arglist = None
         else:
             arglist = [int(x) for x in gdb.string_to_argv(args)]
-        for bp in list_python_breakpoints(arglist):
+        bplist = list(list_python_breakpoints(arglist))
+        for bp in bplist:
             bp.enabled = 0
             gdb_output ('Disable breakpoint #%d' % bp.bpnum)
-            bp._load()
+        python_ipa_load_breakpoints(bplist)
 
 class PythonInfoCommand(gdb.Command):
     '''
@@ -1140,6 +1741,15 @@ class PythonInfoCommand(gdb.Command):
 
     Usage: py-info [breakpoints] RANGES
     Show the information of breakpoints in the RANGES
+
+    Usage: py-info tracepoints
+    Show the hits of all the tracepoints, they're read by one memory
+    read.
+
+    Usage: py-info counters [reset]
+    Show or reset the counters of trace function in python-ipa, they
+    tell how many times the line number and filename are looked up
+    in each kind of events.
     '''
     def __init__(self):
         gdb.Command.__init__ (self, 'py-info', gdb.COMMAND_STATUS)
@@ -1158,6 +1768,14 @@ class PythonInfoCommand(gdb.Command):
             gdb.execute('python-ipa-frame globals')
         elif 'frame'.startswith(args):
             gdb.execute('python-ipa-frame print verbose')
+        elif args.split(' ')[0] == 'counters':
+            self._counters(args.split(' ')[1:])
+        elif args == 'tracepoints':
+            if target_has_execution():
+                python_ipa_read_breakpoint_stats()
+            for bp in list_python_breakpoints(None):
+                if bp.tracepoint:
+                    bp._info()
         elif 'catchpoints'.startswith(args):
             if ' ' in args:
                 arglist = [int(x) for x in args.split()[1:]]
@@ -1170,9 +1788,217 @@ class PythonInfoCommand(gdb.Command):
                 arglist = [int(x) for x in args.split() if x.isdigital()]
             else:
                 arglist = None
+            if target_has_execution():
+                python_ipa_read_breakpoint_stats()
             for bp in list_python_breakpoints(arglist):
                 bp._info()
 
+    def _counters(self, arglist):
+        if not target_has_execution():
+            raise gdb.GdbError('The program is not being run.')
+        if arglist and 'reset'.startswith(arglist[0]):
+            gdb.execute('call pyddd_ipa_reset_trace_counters()')
+            gdb_output ('Trace counters are reset')
+            return
+        events, counters = python_ipa_read_trace_counters()
+        total = sum(events.values())
+        gdb_output ('Trace events: %d' % total)
+        for name in _trace_event_names:
+            if name is not None:
+                gdb_output ('  %-12s %d' % (name, events[name]))
+        for name in _trace_counter_names:
+            gdb_output ('%-17s %d (%.3f per event)' % \
+                (name.capitalize() + ':', counters[name],
+                 counters[name] / float(total) if total else 0))
+
+class PythonProfileCommand(gdb.Command):
+    '''
+    Profile python functions in python-ipa.
+
+    Usage: py-profile start
+    Install profile function in all the python threads.
+
+    Usage: py-profile stop
+    Remove profile function from all the python threads.
+
+    Usage: py-profile report [N] [calls|total|self]
+    Show the first N functions, default is 20, sorted by call count,
+    total time or self time (default).
+
+    Usage: py-profile reset
+    Clear all the counters and time.
+
+    The call count and time of each function are kept in a fixed size
+    table in python-ipa, so the program runs without stopping. Total
+    time of recursive function only counts the outermost call.
+    '''
+    _sort_keys = {'calls' : 3, 'total' : 4, 'self' : 5}
+
+    def __init__(self):
+        gdb.Command.__init__ (self, 'py-profile', gdb.COMMAND_RUNNING)
+
+    def invoke(self, args, from_tty):
+        self.dont_repeat()
+        if not target_has_execution():
+            raise gdb.GdbError('The program is not being run.')
+        arglist = args.split()
+        if not arglist:
+            raise gdb.GdbError('Missing subcommand: start, stop, report or reset')
+        cmd = arglist.pop(0)
+        if cmd == 'start':
+            k = gdb_eval_int('pyddd_ipa_profile_start()')
+            if k == -2:
+                raise gdb.GdbError('Profile function is installed by the '
+                                   'script, for example, cProfile.')
+            if k:
+                raise gdb.GdbError('No python thread state found.')
+            gdb_output ('Profile started')
+        elif cmd == 'stop':
+            gdb_eval_int('pyddd_ipa_profile_stop()')
+            gdb_output ('Profile stopped')
+        elif cmd == 'reset':
+            gdb.execute('call pyddd_ipa_profile_reset()')
+            gdb_output ('Profile data are reset')
+        elif cmd == 'report':
+            self._report(arglist)
+        else:
+            raise gdb.GdbError('Unknown subcommand "%s"' % cmd)
+
+    def _report(self, arglist):
+        n = 20
+        key = self._sort_keys['self']
+        for arg in arglist:
+            if arg.isdigit():
+                n = int(arg)
+            elif arg in self._sort_keys:
+                key = self._sort_keys[arg]
+            else:
+                raise gdb.GdbError('Invalid argument "%s"' % arg)
+        dropped, entries = python_ipa_read_profile()
+        entries = [x for x in entries if x[3]]
+        entries.sort(key=lambda x : x[key], reverse=True)
+        gdb_output ('%10s %12s %12s  %s' % ('Calls', 'Total(s)', 'Self(s)',
+                                            'Function'))
+        for name, filename, lineno, calls, total, self_ in entries[:n]:
+            gdb_output ('%10d %12.6f %12.6f  %s (%s:%d)' % \
+                (calls, total, self_, name, filename, lineno))
+        if dropped:
+            gdb_output ('%d calls are not recorded, the profile table or '
+                        'call stack is full' % dropped)
+
+class PythonSampleCommand(gdb.Command):
+    '''
+    Sample python stacks of all the threads in python-ipa.
+
+    Usage: py-sample start [RATE]
+    Sample RATE times per second of cpu time, default is 100.
+
+    Usage: py-sample stop
+    Stop sampling, the sampled stacks are kept.
+
+    Usage: py-sample report [FILENAME]
+    Write the sampled stacks in collapsed format, one stack per line,
+    which could be used to generate flame graph. Print them if no
+    FILENAME.
+
+    Usage: py-sample reset
+    Clear all the sampled stacks.
+
+    Usage: py-sample take [COUNT [INTERVAL]]
+    Take COUNT samples when the program is stopped, default is 1. If
+    COUNT > 1, continue the program and interrupt it every INTERVAL
+    seconds between two samples, default is 0.01.
+
+    A timer signal SIGPROF schedules a pending call in python, which
+    walks the frames of all the threads, so there is no trace function
+    between two samples. The samples are only taken when the main
+    thread runs python code. If the main thread is blocked, for
+    example, in join() or I/O, use py-sample take instead, it reads
+    the frames when GDB stops all the threads.
+    '''
+    def __init__(self):
+        gdb.Command.__init__ (self, 'py-sample', gdb.COMMAND_RUNNING)
+
+    def invoke(self, args, from_tty):
+        self.dont_repeat()
+        if not target_has_execution():
+            raise gdb.GdbError('The program is not being run.')
+        arglist = args.split()
+        if not arglist:
+            raise gdb.GdbError('Missing subcommand: start, stop, report or reset')
+        cmd = arglist.pop(0)
+        if cmd == 'start':
+            rate = int(arglist[0]) if arglist else 100
+            gdb.execute('handle SIGPROF nostop noprint pass', to_string=True)
+            if gdb_eval_int('pyddd_ipa_sample_start(%d)' % rate):
+                raise gdb.GdbError('Start sampling failed.')
+            gdb_output ('Sampling %d times per second' % rate)
+        elif cmd == 'stop':
+            gdb_eval_int('pyddd_ipa_sample_stop()')
+            gdb_output ('Sampling stopped')
+        elif cmd == 'reset':
+            gdb.execute('call pyddd_ipa_sample_reset()')
+            gdb_output ('Sampled stacks are cleared')
+        elif cmd == 'report':
+            self._report(arglist[0] if arglist else None)
+        elif cmd == 'take':
+            count = int(arglist[0]) if arglist else 1
+            interval = float(arglist[1]) if len(arglist) > 1 else 0.01
+            self._take(count, interval)
+        else:
+            raise gdb.GdbError('Unknown subcommand "%s"' % cmd)
+
+    def _interrupted(self):
+        '''Return True if the program is stopped by SIGINT.'''
+        try:
+            return int(gdb_eval('$_siginfo.si_signo')) == signal.SIGINT
+        except gdb.error:
+            return False
+
+    def _take(self, count, interval):
+        pid = target_has_execution()
+        taken = 0
+        for i in range(count):
+            if i:
+                timer = threading.Timer(interval, os.kill,
+                                        (pid, signal.SIGINT))
+                timer.start()
+                try:
+                    gdb.execute('continue', to_string=True)
+                finally:
+                    timer.cancel()
+                # Stopped by breakpoint or exited
+                if not target_has_execution() or not self._interrupted():
+                    break
+            if gdb_eval_int('pyddd_ipa_sample_take()'):
+                raise gdb.GdbError('Take sample failed.')
+            taken += 1
+        gdb_output ('Take %d samples' % taken)
+
+    def _report(self, filename):
+        (dropped, signals, samples), stacks = python_ipa_read_samples()
+        if signals and not samples:
+            gdb_output ('Warning: %d signals but no sample, the main thread '
+                        'may be blocked, try "py-sample take"' % signals)
+        if not stacks:
+            gdb_output ('No stack sampled')
+            return
+        entries = python_ipa_read_profile()[1]
+        names = ['%s (%s:%d)' % (x[0], os.path.basename(x[1]), x[2])
+                 for x in entries]
+        lines = ['%s %d' % (';'.join([names[k] for k in frames]), count)
+                 for count, frames in stacks]
+        if filename is None:
+            for line in lines:
+                gdb_output (line)
+        else:
+            with open(filename, 'w') as f:
+                f.write('\n'.join(lines))
+                f.write('\n')
+            gdb_output ('Write %d stacks to "%s"' % (len(lines), filename))
+        gdb_output ('%d samples of %d signals, %d stacks not recorded' % \
+                    (samples, signals, dropped))
+
 #################################################################
 #
 # Part: Python Frame (PyFrameObject*)
@@ -1185,13 +2011,16 @@ class PythonFrame(object):
 
     _frame is gdb.Value
     '''
-    def __init__(self, frame):
+    def __init__(self, frame, filename=None, lineno=None, name=None,
+                 argcount=None):
         self._frame = frame
-        self._filename = None
-        self._lineno = None
+        self._filename = filename
+        self._lineno = lineno
         self._listlineno = None
         self._listsize = gdb.parameter('listsize')
-        self._name = None
+        self._name = name
+        self._argcount = argcount
+        self._variables = None
         self._args = None
         self._locals = None
         self._globals = None
@@ -1227,46 +2056,42 @@ class PythonFrame(object):
             self._name = gdb_eval_str(self._expr('name'))
         return self._name
 
+    def _snapshot(self, isglobal=0):
+        '''Get all the variables by one inferior call and one memory
+        read, return a list of (kind, name, value).
+
+        kind is 'a' for argument, 'l' for local, 'c' for cell
+        variable, or 'g' for global variable.'''
+        maxsize = gdb.parameter('print elements') or 0
+        n = gdb_eval_int('pyddd_ipa_frame_snapshot((PyFrameObject*)%s, %d, %d)'
+                         % (self._frame, isglobal, maxsize))
+        if n <= 0:
+            return []
+        fields = read_ipa_data_buffer(n).split(b'\0')
+        return [(to_str(k[:1]), to_str(k[1:]), to_str(v))
+                for k, v in zip(fields[0::2], fields[1::2])]
+
     def info_args(self):
         if self._args is None:
-            code = self._frame.dereference()['f_code']
-            argcount = code.dereference()['co_argcount']
-            varnames = eval(gdb_eval_str(self._expr('varnames')))
-            self._args = []
-            for i in range(argcount):
-                name = varnames[i]
-                expr = self._expr('values')[:-1] + ', 0, %d)'
-                value = gdb_eval_str(expr % i)
-                self._args.append((name, value))
+            if self._variables is None:
+                self._variables = self._snapshot()
+            self._args = [(name, value)
+                          for kind, name, value in self._variables
+                          if kind == 'a']
         return self._args
 
     def info_locals(self):
         if self._locals is None:
-            self._locals = {}
-            code = self._frame.dereference()['f_code']
-            nlocals = code.dereference()['co_nlocals']
-            varnames = eval(gdb_eval_str(self._expr('varnames')))
-            cellvars = eval(gdb_eval_str(self._expr('cellvars')))
-            expr = self._expr('values')[:-1] + ', 0, %d)'
-            assert nlocals <= len(varnames)
-            for i in range(nlocals):
-                name = varnames[i]
-                expr = self._expr('values')[:-1] + ', 0, %d)'
-                self._locals[name] = gdb_eval_str(expr % i)
-            j = nlocals
-            for name in cellvars:
-                expr = self._expr('values')[:-1] + ', 0, %d)'
-                self._locals[name] = gdb_eval_str(expr % j)
-                j += 1
+            if self._variables is None:
+                self._variables = self._snapshot()
+            self._locals = dict([(name, value)
+                                 for kind, name, value in self._variables])
         return self._locals
 
     def info_globals(self):
         if self._globals is None:
-            self._globals = {}
-            expr = self._expr('variable')[:-1] + ', "%s", 0)'
-            names = eval(gdb_eval_str(self._expr('globals')))
-            for s in names:
-                self._globals[s] = gdb_eval_str(expr % s)
+            self._globals = dict([(name, value)
+                                  for kind, name, value in self._snapshot(1)])
         return self._globals
 
     def info_sources(self, args):
@@ -1374,6 +2199,32 @@ class PythonFrame(object):
                 if k not in self.info_args():
                     gdb_output ('  %s=%s' % (k, v))
 
+# struct pyddd_ipa_t_frame_record in ipa.h
+_frame_record_format = '=q4i'
+
+def python_ipa_backtrace(frame, count=-1):
+    '''Get frame and its older frames by one inferior call and one
+    memory read, at most count frames, all the frames if count < 0.
+    Return a list of PythonFrame.'''
+    n = gdb_eval_int('pyddd_ipa_frame_backtrace((PyFrameObject*)%s, %d)'
+                     % (frame, count))
+    if n <= 0:
+        return []
+    buf = read_ipa_data_buffer(n)
+    k = struct.calcsize(_frame_record_format)
+    ftype = gdb.lookup_type('PyFrameObject').pointer()
+    result = []
+    i = 0
+    while i < n:
+        f, lineno, argcount, size1, size2 = \
+            struct.unpack_from(_frame_record_format, buf, i)
+        filename = to_str(buf[i+k:i+k+size1-1])
+        name = to_str(buf[i+k+size1:i+k+size1+size2-1])
+        result.append(PythonFrame(gdb.Value(f).cast(ftype),
+                                  filename, lineno, name, argcount))
+        i += (k + size1 + size2 + 7) & ~7
+    return result
+
 class PythonIPAFrameCommand(gdb.Command):
     '''
     Manage python frame (internal command).
@@ -1453,9 +2304,9 @@ class PythonIPAFrameCommand(gdb.Command):
 
     def _setup(self):
         global _python_frame_index
-        _python_frame_stack[:] = [
-            PythonFrame(gdb_eval('pyddd_ipa_current_frame'))
-            ]
+        _python_frame_stack[:] = python_ipa_backtrace(
+            gdb_eval('pyddd_ipa_current_frame'), 1
+            )
         _python_frame_index = 0
 
     def _teardown(self):
@@ -1463,15 +2314,17 @@ class PythonIPAFrameCommand(gdb.Command):
         _python_frame_index = -1
 
     def _push(self, n):
-        frame = _python_frame_stack[-1]
+        '''Push n older frames, all the frames if n < 0. Return the
+        number of frames not pushed.'''
         while n:
-            f = frame.older()
-            if f == 0:
+            frames = python_ipa_backtrace(_python_frame_stack[-1]._frame,
+                                          n + 1 if n > 0 else -1)[1:]
+            if not frames:
                 break
-            frame = PythonFrame(f)
-            _python_frame_stack.append(frame)
-            n -= 1
-        return n
+            _python_frame_stack.extend(frames)
+            if n > 0:
+                n -= len(frames)
+        return n if n > 0 else 0
 
     def _select(self, args):
         global _python_frame_index
@@ -1505,22 +2358,11 @@ class PythonIPAFrameCommand(gdb.Command):
                     d = self._push(len(_python_frame_stack) - n + 1)
                     _python_frame_index = n - d
             else:
-                _python_frame_index = 0
-                for frame in _python_frame_stack:
-                    if frame._name == args:
+                self._push(-1)
+                for i, frame in enumerate(_python_frame_stack):
+                    if frame.info_name() == args:
+                        _python_frame_index = i
                         break
-                    _python_frame_index += 1
-                else:
-                    frame = _python_frame_stack[-1]
-                    while True:
-                        f = frame.older()
-                        if f == 0:
-                            break
-                        frame = PythonFrame(f)
-                        _python_frame_stack.append(frame)
-                        if frame.info_name() == args:
-                            break
-                        _python_frame_index += 1
 
     def _print(self, args):
         verbose = args!=''
@@ -1565,26 +2407,15 @@ class PythonIPAFrameCommand(gdb.Command):
                 n = int(args)
                 start = _python_frame_index
         try:
-            while n:
-                try:
-                    frame = _python_frame_stack[start]
-                except IndexError:
-                    frame = None
-                if frame is None:
-                    frame = _python_frame_stack[-1]
-                    while n:
-                        f = frame.older()
-                        if f == 0:
-                            break
-                        frame = PythonFrame(f)
-                        _python_frame_stack.append(frame)
-                        frame._print(level=start, verbose=verbose)
-                        start += 1
-                        n -= 1
-                    break
+            # fetch all the missing frames at once
+            if n < 0:
+                self._push(-1)
+            elif start + n > len(_python_frame_stack):
+                self._push(start + n - len(_python_frame_stack))
+            end = None if n < 0 else start + n
+            for frame in _python_frame_stack[start:end]:
                 frame._print(level=start, verbose=verbose)
                 start += 1
-                n -= 1
         except KeyboardInterrupt:
             pass
 
@@ -1597,8 +2428,10 @@ class PythonIPAFrameCommand(gdb.Command):
 class PythonSymbolList(list):
     '''
     Parse python scripts to a list like
-        (name, lineno), ...
-    name is any function/class/method in the python script
+        (qualname, lineno), ...
+    qualname is qualified name of any function/class/method in the
+    python script, same as __qualname__ of python3, for example,
+    "Foo.run" and "outer.<locals>.inner".
     '''
     def __init__(self, filename=None):
         super(PythonSymbolList, self).__init__()
@@ -1606,20 +2439,24 @@ class PythonSymbolList(list):
         if filename is not None:
             self.load(filename)
 
-    def visit(self, level, node):
+    _function_nodes = tuple([getattr(ast, s) for s in
+                             ('FunctionDef', 'AsyncFunctionDef')
+                             if hasattr(ast, s)])
+
+    def visit(self, prefix, node):
         if isinstance(node, ast.mod):
             for child in ast.iter_child_nodes(node):
-                self.visit(level, child)
+                self.visit(prefix, child)
 
-        elif isinstance(node, ast.FunctionDef):
-            self.append((node.name, node.lineno))
+        elif isinstance(node, self._function_nodes):
+            self.append((prefix + node.name, node.lineno))
             for child in node.body:
-                self.visit(level+1, child)
+                self.visit(prefix + node.name + '.<locals>.', child)
 
         elif isinstance(node, ast.ClassDef):
-            self.append((node.name, node.lineno))
+            self.append((prefix + node.name, node.lineno))
             for child in node.body:
-                self.visit(level+1, child)
+                self.visit(prefix + node.name + '.', child)
 
     def reload(self):
         del self[:]
@@ -1632,12 +2469,273 @@ class PythonSymbolList(list):
             self.filename = filename
         if filename is None:
             return
-        f = open(filename, 'r')
+        self.extend(_python_symbol_cache.load(filename, self.parse))
+
+    def parse(self, data):
+        '''Return symbols of script source data as a list.'''
+        symbols = PythonSymbolList()
+        symbols.visit('', ast.parse(data))
+        return list(symbols)
+
+class PythonSymbolCache(object):
+    '''
+    Persistent cache of parsed symbols, saved in one pickle file in
+    the cache directory, $PYDDD_CACHE_DIR or ~/.cache/pyddd. Set
+    PYDDD_CACHE_DIR to empty string to disable it.
+
+    Each entry is keyed on the absolute path of script:
+        path: (mtime, size, digest, [(name, lineno), ...])
+
+    If mtime and size are not changed, the script isn't read at all.
+    Otherwise it's parsed again only if the digest of content is
+    changed. Pickle protocol 2 is used so that both python2 and
+    python3 of GDB can share the cache.
+    '''
+    version = 2
+    filename = 'symbols.pickle'
+
+    def __init__(self, path=None, filename=None):
+        if filename is not None:
+            self.filename = filename
+        if path is None:
+            path = os.environ.get('PYDDD_CACHE_DIR')
+        if path is None:
+            path = os.path.join(
+                os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'),
+                                            '.cache')),
+                'pyddd')
+        self.path = path
+        self.table = None
+        self.dirty = False
+
+    def _load_table(self):
+        if self.table is None:
+            self.table = {}
+            if self.path:
+                try:
+                    with open(os.path.join(self.path, self.filename),
+                              'rb') as f:
+                        version, table = pickle.load(f)
+                    if version == self.version:
+                        self.table = table
+                except Exception:
+                    pass
+        return self.table
+
+    def load(self, filename, parse):
+        '''Return symbols of filename, parse(data) is called to get
+        symbols only if the content of filename is changed.'''
+        st = os.stat(filename)
+        symbols = self.lookup(filename, st)
+        if symbols is not None:
+            return symbols
+        with open(filename, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        entry = self._load_table().get(os.path.abspath(filename))
+        if entry is not None and entry[2] == digest:
+            symbols = entry[3]
+        else:
+            symbols = parse(data)
+        self.store(filename, st, digest, symbols)
+        return symbols
+
+    def lookup(self, filename, st):
+        '''Return cached symbols if mtime and size in st are same as
+        the cached ones, otherwise None.'''
+        entry = self._load_table().get(os.path.abspath(filename))
+        if entry is not None and entry[:2] == (st.st_mtime, st.st_size):
+            return entry[3]
+
+    def store(self, filename, st, digest, symbols):
+        self._load_table()[os.path.abspath(filename)] = \
+            st.st_mtime, st.st_size, digest, symbols
+        self.dirty = True
+
+    def save(self):
+        '''Write cache file if it's changed. The cache is only an
+        optimization, so any error is ignored.'''
+        if not (self.dirty and self.path):
+            return
+        filename = os.path.join(self.path, self.filename)
+        tmpname = '%s.%d' % (filename, os.getpid())
         try:
-            node = ast.parse('\n'.join(f.readlines()))
-            self.visit(0, node)
-        finally:
-            f.close()
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            with open(tmpname, 'wb') as f:
+                pickle.dump((self.version, self.table), f, 2)
+            if os.path.exists(filename) and sys.platform == 'win32':
+                os.remove(filename)
+            os.rename(tmpname, filename)
+            self.dirty = False
+        except (IOError, OSError):
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+    def clear(self):
+        self.table = {}
+        self.dirty = True
+
+_python_symbol_cache = PythonSymbolCache()
+
+def parse_executable_lines(data, filename):
+    '''Return sorted line numbers which have code in the script, they
+    are got from line tables of all the code objects. Return empty
+    list if the script can't be compiled by python of GDB.'''
+    try:
+        code = compile(data, filename, 'exec')
+    except (SyntaxError, TypeError, ValueError):
+        return []
+    lines = set()
+    codelist = [code]
+    while codelist:
+        code = codelist.pop()
+        lines.update([lineno for offset, lineno in dis.findlinestarts(code)
+                      if lineno])
+        codelist.extend([c for c in code.co_consts
+                         if isinstance(c, type(code))])
+    return sorted(lines)
+
+# (pid, (major, minor)) of python in the inferior
+_python_inferior_version = None
+
+def python_inferior_version():
+    '''Return (major, minor) version of python in the inferior, or None
+    if the inferior isn't running.'''
+    global _python_inferior_version
+    pid = target_has_execution()
+    if not pid:
+        return None
+    if _python_inferior_version is None or _python_inferior_version[0] != pid:
+        try:
+            version = tuple([int(x) for x in gdb_eval_str(
+                '(char*)Py_GetVersion()').split()[0].split('.')[:2]])
+        except (gdb.error, ValueError):
+            version = None
+        _python_inferior_version = pid, version
+    return _python_inferior_version[1]
+
+# Same as symbols, the executable lines of each script are cached,
+# one cache file for each python version
+_python_line_caches = {}
+
+def python_line_cache(version):
+    cache = _python_line_caches.get(version)
+    if cache is None:
+        cache = PythonSymbolCache(filename='lines-%d.%d.pickle' % version)
+        _python_line_caches[version] = cache
+    return cache
+
+def clear_line_caches():
+    '''Clear the line caches of all the python versions.'''
+    path = _python_symbol_cache.path
+    if path and os.path.isdir(path):
+        for name in fnmatch.filter(os.listdir(path), 'lines-*.pickle'):
+            version = name[6:-7].split('.')
+            if len(version) == 2 and ''.join(version).isdigit():
+                python_line_cache(tuple([int(x) for x in version]))
+    for cache in _python_line_caches.values():
+        cache.clear()
+        cache.save()
+
+def snap_breakpoint_lineno(filename, lineno):
+    '''Return the first executable line from lineno in filename, so
+    the breakpoint in blank line, comment, decorator or continuation
+    line could be hit. lineno is not changed if it's unknown.
+
+    Line tables are different between python versions, so lineno is
+    changed only if python of GDB has the same version as the
+    inferior. The cache is saved by the caller.'''
+    if not (str(lineno).isdigit() and os.path.isfile(filename)):
+        return lineno
+    version = python_inferior_version()
+    if version != tuple(sys.version_info[:2]):
+        return lineno
+    try:
+        lines = python_line_cache(version).load(
+            filename, lambda data : parse_executable_lines(data, filename))
+    except (IOError, OSError):
+        return lineno
+    k = bisect.bisect_left(lines, int(lineno))
+    return lines[k] if k < len(lines) else lineno
+
+def parse_symbol_file(filename):
+    '''Parse one script, it's called in the worker process of
+    py-symbol-file add-tree. Return (filename, stat, digest, symbols),
+    symbols is None if the script can't be parsed.'''
+    try:
+        st = os.stat(filename)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        return (filename, st, hashlib.sha1(data).hexdigest(),
+                PythonSymbolList().parse(data))
+    except (IOError, OSError, SyntaxError, TypeError, ValueError):
+        return filename, None, None, None
+
+def parse_symbol_files(filelist, jobs=None):
+    '''Parse scripts by a pool of worker processes, yield the result
+    of parse_symbol_file for each script in any order. Fall back to
+    parse them one by one if the pool can't be used.'''
+    if jobs is None:
+        try:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            jobs = 1
+    # The pool needs fork, GDB itself can't be spawned as python
+    jobs = min(jobs, len(filelist) // 16)
+    if jobs > 1 and hasattr(os, 'fork'):
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs)
+        except (ImportError, OSError):
+            pool = None
+        if pool is not None:
+            try:
+                for result in pool.imap_unordered(parse_symbol_file,
+                                                  filelist, 16):
+                    yield result
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+            return
+    for filename in filelist:
+        yield parse_symbol_file(filename)
+
+def load_symbol_files(filelist, table):
+    '''Load symbols of all the files in filelist into table, from
+    the symbol cache if it's not changed, otherwise parse them in
+    parallel. The missing files are ignored. Return (cached, parsed,
+    failed).'''
+    pending = []
+    cached = parsed = failed = 0
+    try:
+        for filename in filelist:
+            try:
+                symbols = _python_symbol_cache.lookup(
+                    filename, os.stat(filename))
+            except OSError:
+                continue
+            if symbols is None:
+                pending.append(filename)
+            else:
+                cached += 1
+                table[filename] = dict(symbols)
+        for filename, st, digest, symbols in parse_symbol_files(pending):
+            if symbols is None:
+                failed += 1
+                gdb_output ('Failed to parse "%s"' % filename)
+            else:
+                parsed += 1
+                _python_symbol_cache.store(filename, st, digest, symbols)
+                table[filename] = dict(symbols)
+    finally:
+        _python_symbol_cache.save()
+    return cached, parsed, failed
 
 #################################################################
 #
@@ -1761,6 +2859,8 @@ PythonInternalExceptionCatchpoint()
 PythonInternalCallCatchpoint()
 PythonInternalLineBreakpoint()
 PythonInternalVolatileBreakpoint()
+PythonInternalModuleBreakpoint()
+PythonInternalAttachBreakpoint()
 
 # Register commands
 PythonIPALoadDataCommand()
@@ -1769,8 +2869,11 @@ PythonFileCommand()
 PythonExecArgsCommand()
 PythonSymbolFileCommand()
 PythonRunCommand()
+PythonAttachCommand()
 PythonBreakpointCommand()
 PythonTempBreakpointCommand()
+PythonTracepointCommand()
+PythonLogpointCommand()
 PythonCatchpointCommand()
 PythonTempCatchpointCommand()
 PythonClearCommand()
@@ -1778,6 +2881,8 @@ PythonDeleteCommand()
 PythonEnableCommand()
 PythonDisableCommand()
 PythonInfoCommand()
+PythonProfileCommand()
+PythonSampleCommand()
 
 # Clear imported symbol table when the inferior exits
 gdb.events.exited.connect (
@@ -1,16 +1,42 @@
 #include "../ipa.h"
+#include <time.h>
 
 extern int pyddd_ipa_hit_flag;
 
 extern struct pyddd_ipa_t_volatile_breakpoint
-pyddd_ipa_volatile_breakpoint;
+pyddd_ipa_volatile_breakpoint_table[];
+extern volatile int pyddd_ipa_volatile_breakpoint_armed;
 extern struct pyddd_ipa_t_breakpoint pyddd_ipa_breakpoint_table[];
+extern struct pyddd_ipa_t_breakpoint_stats pyddd_ipa_breakpoint_stats;
 
 extern int pyddd_ipa_breakpoint_top;
 extern int pyddd_ipa_breakpoint_counter;
+extern int pyddd_ipa_breakpoint_index[];
+extern volatile unsigned int pyddd_ipa_breakpoint_generation;
+extern struct pyddd_ipa_t_code_entry pyddd_ipa_code_cache[];
+extern int pyddd_ipa_code_filter;
+extern int pyddd_ipa_simple_condition;
+extern int pyddd_ipa_auto_trace;
+extern int pyddd_ipa_tracing;
+extern int pyddd_ipa_attach_pending;
+extern int pyddd_ipa_attach_size;
+extern volatile unsigned int pyddd_ipa_release_head;
+extern volatile unsigned int pyddd_ipa_release_tail;
+extern char pyddd_ipa_data_buffer[];
+extern int pyddd_ipa_module_autoload;
+extern char **pyddd_ipa_module_filters;
+extern char **pyddd_ipa_pending_files;
+extern struct pyddd_ipa_t_module *pyddd_ipa_current_module;
+extern struct pyddd_ipa_t_trace_counters pyddd_ipa_trace_counters;
+extern struct pyddd_ipa_t_profile pyddd_ipa_profile;
+extern struct pyddd_ipa_t_sample pyddd_ipa_sample;
+extern struct pyddd_ipa_t_log pyddd_ipa_log;
 
-extern char * pyddd_ipa_python_catch_exceptions;
-extern char * pyddd_ipa_python_catch_functions;
+extern struct pyddd_ipa_t_catch_patterns *pyddd_ipa_catch_exceptions;
+extern struct pyddd_ipa_t_catch_patterns *pyddd_ipa_catch_functions;
+extern volatile unsigned int pyddd_ipa_catch_generation;
+extern char **retired_breakpoint_strings;
+extern int retired_breakpoint_strings_count;
 
 static void 
 init_func(void)
@@ -28,8 +54,10 @@ init_func(void)
   FPyEval_EvalCode       = PyEval_EvalCode;
   FPyEval_SetTrace       = PyEval_SetTrace;
   FPy_DecRef             = Py_DecRef;
+  FPy_IncRef             = Py_IncRef;
   FPyObject_IsTrue       = PyObject_IsTrue;
   FPyThreadState_Get     = PyThreadState_Get;
+  FPyGILState_GetThisThreadState = PyGILState_GetThisThreadState;
   FPyObject_Str          = PyObject_Str;
   FPyObject_Repr         = PyObject_Repr;
   FPyTuple_GetItem       = PyTuple_GetItem;
@@ -45,6 +73,12 @@ init_func(void)
   FPyErr_Clear           = PyErr_Clear;
   FPyErr_PrintEx         = PyErr_PrintEx;
   FPyErr_Occurred        = PyErr_Occurred;
+  FPyInterpreterState_ThreadHead = PyInterpreterState_ThreadHead;
+  FPyThreadState_Next    = PyThreadState_Next;
+  FPy_AddPendingCall     = Py_AddPendingCall;
+  FPyLong_AsLongAndOverflow = PyLong_AsLongAndOverflow;
+  FPyFrame_FastToLocals  = PyFrame_FastToLocals;
+  FPyModule_GetDict      = PyModule_GetDict;
 }
 
 static PyFrameObject *
@@ -77,6 +111,23 @@ make_test_frame(char *code, char *filename)
   return PyFrame_New(tstate, co_code, f_globals, f_locals);
 }
 
+static void
+clear_breakpoint_table(void)
+{
+  int i;
+  for (i = 0; i < pyddd_ipa_breakpoint_counter; i++)
+    pyddd_ipa_remove_breakpoint (i);
+}
+
+static void
+clear_volatile_breakpoints(void)
+{
+  int i;
+  for (i = 0; i < PYDDD_IPA_MAX_THREAD; i++)
+    pyddd_ipa_volatile_breakpoint_table[i].enabled = 0;
+  pyddd_ipa_volatile_breakpoint_armed = 0;
+}
+
 /*
  * test find_name_in_list
  */
@@ -124,6 +175,56 @@ void test_find_name_in_list(void)
   assert (!find_name_in_list ("foo", "hello *koo fight"));
 }
 
+/*
+ * test compiled catch patterns, they must match same names as
+ * find_name_in_list
+ */
+extern struct pyddd_ipa_t_catch_patterns*
+pyddd_ipa_compile_catch_patterns(const char *namelist);
+extern void
+pyddd_ipa_free_catch_patterns(struct pyddd_ipa_t_catch_patterns *patterns);
+extern int
+pyddd_ipa_match_catch_patterns(const struct pyddd_ipa_t_catch_patterns
+                               *patterns,
+                               const char *name);
+void test_pyddd_ipa_catch_patterns(void)
+{
+  const char *namelists[] = {
+    "foo", "f?o", "f*", "*o", "f*o", "fo", "f?", "f*b", "*ooo", "*koo",
+    "*", "foo*", "*foo", "fooo*", "*fooo", "<module>", "bar foo",
+    "hello f?o fight", "hello f*o fight", "hello *koo fo*",
+    "fight  fo*  *ht", "fa* fb* fc* fo* *xo *yo *zo *oo",
+    NULL
+  };
+  const char *names[] = {
+    "foo", "fo", "f", "o", "bar", "fight", "<module>", "hello", "ffoo",
+    NULL
+  };
+  struct pyddd_ipa_t_catch_patterns *patterns;
+  int i, j;
+
+  for (i = 0; namelists[i]; i++) {
+    patterns = pyddd_ipa_compile_catch_patterns(namelists[i]);
+    assert (patterns);
+    for (j = 0; names[j]; j++)
+      assert (pyddd_ipa_match_catch_patterns(patterns, names[j])
+              == !!find_name_in_list(names[j], namelists[i]));
+    assert (!pyddd_ipa_match_catch_patterns(patterns, ""));
+    assert (!pyddd_ipa_match_catch_patterns(patterns, NULL));
+    pyddd_ipa_free_catch_patterns(patterns);
+  }
+
+  assert (!pyddd_ipa_match_catch_patterns(NULL, "foo"));
+
+  /* Only the complex patterns are left to find_name_in_list */
+  patterns = pyddd_ipa_compile_catch_patterns("foo f* *o f?o f*o");
+  assert (patterns && !strcmp(patterns->others, "f?o f*o"));
+  pyddd_ipa_free_catch_patterns(patterns);
+  patterns = pyddd_ipa_compile_catch_patterns("foo f* *o");
+  assert (patterns && !patterns->others);
+  pyddd_ipa_free_catch_patterns(patterns);
+}
+
 void test_pyddd_ipa_insert_breakpoint(void)
 {
 #define ft pyddd_ipa_insert_breakpoint
@@ -141,6 +242,1044 @@ void test_pyddd_ipa_insert_breakpoint(void)
 #undef ft
 }
 
+/* Append breakpoint record to the data buffer, return next record */
+static char *
+put_breakpoint_record(char *s, int rindex, int bpnum, int enabled,
+                      int lineno, const char *condition,
+                      const char *filename)
+{
+  struct pyddd_ipa_t_breakpoint_record *r;
+  r = (struct pyddd_ipa_t_breakpoint_record*)s;
+  memset(r, 0, sizeof(struct pyddd_ipa_t_breakpoint_record));
+  r->rindex = rindex;
+  r->bpnum = bpnum;
+  r->enabled = enabled;
+  r->lineno = lineno;
+  r->condition_size = condition ? strlen(condition) + 1 : 0;
+  r->filename_size = strlen(filename) + 1;
+  if (condition)
+    strcpy((char*)(r + 1), condition);
+  strcpy((char*)(r + 1) + r->condition_size, filename);
+  return s + PYDDD_IPA_RECORD_SIZE(r);
+}
+
+void test_pyddd_ipa_load_breakpoints(void)
+{
+  struct pyddd_ipa_t_breakpoint_record *r, *r2;
+  struct pyddd_ipa_t_breakpoint *p, *p2;
+  char *condition;
+  char *s;
+  int i, j;
+
+  assert (sizeof(struct pyddd_ipa_t_breakpoint_record) == 56);
+  clear_breakpoint_table();
+
+  /* Insert two breakpoints */
+  s = put_breakpoint_record(pyddd_ipa_data_buffer, -1, 1, 1, 3,
+                            NULL, "foo.py");
+  put_breakpoint_record(s, -1, 2, 0, 5, "i==2", "bar.py");
+  r = (struct pyddd_ipa_t_breakpoint_record*)pyddd_ipa_data_buffer;
+  r2 = (struct pyddd_ipa_t_breakpoint_record*)s;
+  assert (pyddd_ipa_load_breakpoints(2) == 2);
+  assert (r->rindex >= 0 && r2->rindex >= 0 && r->rindex != r2->rindex);
+  i = r->rindex;
+  j = r2->rindex;
+
+  p = pyddd_ipa_breakpoint_table + r->rindex;
+  p2 = pyddd_ipa_breakpoint_table + r2->rindex;
+  assert (p->bpnum == 1 && p->lineno == 3);
+  assert (pyddd_ipa_breakpoint_stats.stats[r->rindex].enabled == 1);
+  assert (!p->condition && !strcmp(p->filename, "foo.py"));
+  assert (p2->bpnum == 2 && p2->lineno == 5);
+  assert (!pyddd_ipa_breakpoint_stats.stats[r2->rindex].enabled);
+  assert (!strcmp(p2->condition, "i==2"));
+  assert (!strcmp(p2->filename, "bar.py"));
+
+  /* Strings are copied, the same one is reused when updated, the
+     replaced one is retired */
+  assert (p->filename < pyddd_ipa_data_buffer
+          || p->filename >= pyddd_ipa_data_buffer
+          + PYDDD_IPA_DATA_BUFFER_SIZE);
+  assert (p->strings_owned && p2->strings_owned);
+  s = p2->filename;
+  condition = p2->condition;
+  put_breakpoint_record(pyddd_ipa_data_buffer, r2->rindex, 2, 1, 6,
+                        NULL, "bar.py");
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  assert (p2->filename == s && !p2->condition);
+  assert (p2->lineno == 6);
+  assert (pyddd_ipa_breakpoint_stats.stats[r2->rindex].enabled == 1);
+  assert (retired_breakpoint_strings_count == 1);
+  assert (retired_breakpoint_strings[0] == condition);
+
+  /* Invalid record, the retired strings are freed */
+  put_breakpoint_record(pyddd_ipa_data_buffer, -1, 0, 1, 6,
+                        NULL, "bar.py");
+  assert (pyddd_ipa_load_breakpoints(1) == 0);
+  assert (!retired_breakpoint_strings_count);
+
+  /* Strings of removed breakpoint are retired */
+  pyddd_ipa_remove_breakpoint(j);
+  assert (retired_breakpoint_strings_count == 1);
+  assert (retired_breakpoint_strings[0] == s);
+
+  /* Strings passed by caller aren't owned, never retired */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 0, 1, 3, "foo.py");
+  assert (!p->strings_owned);
+  put_breakpoint_record(pyddd_ipa_data_buffer, i, 1, 1, 4,
+                        NULL, "foo.py");
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  assert (!retired_breakpoint_strings_count);
+  assert (p->strings_owned && p->lineno == 4);
+
+  clear_breakpoint_table();
+}
+
+void test_pyddd_ipa_filename_binding(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  int i, j;
+  unsigned int generation;
+  PyFrameObject *frame, *frame2;
+  struct pyddd_ipa_t_breakpoint *p, *p2;
+
+  /* Different code objects have different filename objects */
+  frame = make_test_frame("j=2", "foo.py");
+  frame2 = make_test_frame("k=2", "foo.py");
+  assert (frame && frame2);
+  assert (frame->f_code->co_filename != frame2->f_code->co_filename);
+
+  clear_breakpoint_table();
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, 1, 1, "foo.py");
+  j = pyddd_ipa_insert_breakpoint(2, 0, 0, NULL, 0, 1, 2, "foo.py");
+  p = pyddd_ipa_breakpoint_table + i;
+  p2 = pyddd_ipa_breakpoint_table + j;
+  assert (!p->co_filename && !p2->co_filename);
+
+  /* Bind all the breakpoints in foo.py when first matched */
+  pyddd_ipa_hit_flag = 0;
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+  assert (p->co_filename == frame->f_code->co_filename);
+  assert (p2->co_filename == frame->f_code->co_filename);
+
+  /* The other code object in the same file */
+  ft(NULL, frame2, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 2);
+  assert (p->co_filename == frame->f_code->co_filename);
+
+  /* Any change of breakpoint will invalidate code cache */
+  generation = pyddd_ipa_breakpoint_generation;
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 0, 1, 1, "bar.py");
+  assert (!p->co_filename);
+  assert (generation != pyddd_ipa_breakpoint_generation);
+  ft(NULL, frame2, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 2);
+  assert (!p->co_filename);
+
+  /* Reload code, it's still bound to the first filename object */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 0, 1, 1, "foo.py");
+  Py_DECREF((PyObject*)frame);
+  frame = make_test_frame("j=3", "foo.py");
+  assert (frame);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 3);
+  assert (p->co_filename == p2->co_filename);
+  assert (p->co_filename != frame->f_code->co_filename);
+
+  pyddd_ipa_remove_breakpoint(i);
+  pyddd_ipa_remove_breakpoint(j);
+  assert (!p->co_filename && !p2->co_filename);
+
+  Py_DECREF((PyObject*)frame);
+  Py_DECREF((PyObject*)frame2);
+#undef ft
+}
+
+/* Return the entry of code in the code cache, NULL if not cached */
+static struct pyddd_ipa_t_code_entry *
+find_code_entry(PyCodeObject *code)
+{
+  struct pyddd_ipa_t_code_entry *entry;
+  int i;
+
+  entry = pyddd_ipa_code_cache
+    + PYDDD_IPA_CODE_CACHE_HASH(code) * PYDDD_IPA_CODE_CACHE_WAYS;
+  for (i = 0; i < PYDDD_IPA_CODE_CACHE_WAYS; i++, entry++)
+    if (entry->code == code)
+      return entry;
+  return NULL;
+}
+
+extern struct pyddd_ipa_t_code_entry *
+pyddd_ipa_lookup_code(PyCodeObject *code);
+
+void test_pyddd_ipa_code_filter(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  const int n = PYDDD_IPA_CODE_CACHE_SIZE + 1;
+  int i, j, k;
+  PyFrameObject *frame;
+  PyObject *codes;
+  PyCodeObject *co, *other, *set[PYDDD_IPA_CODE_CACHE_WAYS + 1];
+  struct pyddd_ipa_t_code_entry *entry;
+
+  frame = make_test_frame("j=2\nk=3\nj=4\n", "foo.py");
+  assert (frame);
+
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+  pyddd_ipa_hit_flag = 0;
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  entry = find_code_entry(frame->f_code);
+  assert (entry && entry->code == frame->f_code);
+  assert (entry->firstlineno == 1 && entry->lastlineno == 3);
+  assert (!entry->count && !entry->bound);
+
+  /* Breakpoint in the other file */
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, 1, 2, "bar.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (!entry->count && !entry->bound);
+
+  /* Breakpoint out of this code */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 0, 1, 5, "foo.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (!entry->count && entry->bound);
+
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 0, 1, 2, "foo.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (entry->count == 1 && entry->lines[0] == 2);
+  assert (!pyddd_ipa_hit_flag);
+
+  /* Disabled breakpoint */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 0, 0, 2, "foo.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (!entry->count);
+
+  /* Volatile breakpoint is always checked */
+  pyddd_ipa_step_command(1);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+  pyddd_ipa_remove_breakpoint(i);
+
+  /* Find WAYS + 1 code objects in the same set, the first WAYS ones
+     are all kept in the cache, then the oldest one is replaced */
+  codes = PyList_New(0);
+  for (i = 0; i < n; i++) {
+    co = (PyCodeObject*)Py_CompileStringFlags("pass\n", "foo.py",
+                                              Py_file_input, NULL);
+    assert (co);
+    PyList_Append(codes, (PyObject*)co);
+    Py_DECREF(co);
+  }
+  /* There are more than WAYS codes in some set, because n > SIZE */
+  for (i = 0, k = 0; i < n && k <= PYDDD_IPA_CODE_CACHE_WAYS; i++) {
+    co = (PyCodeObject*)PyList_GET_ITEM(codes, i);
+    for (j = 0, k = 0; j < n && k <= PYDDD_IPA_CODE_CACHE_WAYS; j++) {
+      other = (PyCodeObject*)PyList_GET_ITEM(codes, j);
+      if (PYDDD_IPA_CODE_CACHE_HASH(other) == PYDDD_IPA_CODE_CACHE_HASH(co))
+        set[k++] = other;
+    }
+  }
+  assert (k == PYDDD_IPA_CODE_CACHE_WAYS + 1);
+  for (i = 0; i < PYDDD_IPA_CODE_CACHE_WAYS; i++)
+    pyddd_ipa_lookup_code(set[i]);
+  for (i = 0; i < PYDDD_IPA_CODE_CACHE_WAYS; i++)
+    assert (find_code_entry(set[i]) == pyddd_ipa_lookup_code(set[i]));
+  pyddd_ipa_lookup_code(set[PYDDD_IPA_CODE_CACHE_WAYS]);
+  assert (find_code_entry(set[PYDDD_IPA_CODE_CACHE_WAYS]));
+  for (i = 0, k = 0; i < PYDDD_IPA_CODE_CACHE_WAYS; i++)
+    k += find_code_entry(set[i]) != NULL;
+  assert (k == PYDDD_IPA_CODE_CACHE_WAYS - 1);
+
+  Py_DECREF(codes);
+  Py_DECREF((PyObject*)frame);
+#undef ft
+}
+
+void test_pyddd_ipa_trace_counters(void)
+{
+  struct pyddd_ipa_t_trace_counters *c=&pyddd_ipa_trace_counters;
+  PyObject *globals, *result;
+
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+  pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, 1, 10, "bar.py");
+  pyddd_ipa_hit_flag = 0;
+  pyddd_ipa_reset_trace_counters();
+
+  /* No line and filename is looked up if nothing is hit */
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("def foo(n):\n"
+                        "    return n + 1\n"
+                        "for i in range(10):\n"
+                        "    foo(i)\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (c->events[PyTrace_CALL] == 11);
+  assert (c->events[PyTrace_LINE] > 20);
+  assert (!c->line_candidates);
+  assert (!c->lineno_lookups && !c->filename_lookups);
+  assert (c->code_lookups == c->events[PyTrace_LINE]);
+
+  /* f_lineno is used in line event, filename is only got for hit */
+  clear_breakpoint_table();
+  pyddd_ipa_insert_breakpoint(2, 0, 0, NULL, 0, 1, 2, "<string>");
+  pyddd_ipa_reset_trace_counters();
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("foo(1)\nfoo(2)\nfoo(3)\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  /* Line 2 is "foo(2)" and the body of foo */
+  assert (pyddd_ipa_hit_flag == 4);
+  assert (c->filename_lookups == 4 && !c->lineno_lookups);
+  assert (c->line_candidates == c->events[PyTrace_LINE]);
+
+  clear_breakpoint_table();
+  pyddd_ipa_hit_flag = 0;
+  Py_DECREF(globals);
+}
+
+static struct pyddd_ipa_t_profile_entry *
+find_profile_entry(const char *name)
+{
+  int i;
+  for (i = 0; i < pyddd_ipa_profile.count; i++)
+    if (!strcmp(pyddd_ipa_profile.entries[i].name, name))
+      return pyddd_ipa_profile.entries + i;
+  return NULL;
+}
+
+extern long long pyddd_ipa_profile_clock(void);
+
+void test_pyddd_ipa_profile(void)
+{
+  struct pyddd_ipa_t_profile_entry *pe;
+  PyObject *globals, *result;
+  PyFrameObject *frame;
+  long long now;
+
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  pyddd_ipa_profile_reset();
+
+  assert (!pyddd_ipa_profile_start());
+  assert (PyThreadState_Get()->c_profilefunc == pyddd_ipa_profile_trampoline);
+  result = PyRun_String("def foo(n):\n"
+                        "    return n + 1\n"
+                        "def fib(n):\n"
+                        "    return n if n < 2 else fib(n-1) + fib(n-2)\n"
+                        "for i in range(10):\n"
+                        "    foo(i)\n"
+                        "fib(10)\n",
+                        Py_file_input, globals, globals);
+  assert (!pyddd_ipa_profile_stop());
+  assert (!PyThreadState_Get()->c_profilefunc);
+  assert (result);
+  Py_DECREF(result);
+
+  assert (!pyddd_ipa_profile.dropped);
+  pe = find_profile_entry("foo");
+  assert (pe && pe->call_count == 10 && pe->firstlineno == 1);
+  assert (!strcmp(pe->filename, "<string>"));
+  assert (pe->total_time > 0 && pe->total_time == pe->self_time);
+  assert (!pe->recursion);
+
+  /* Recursive calls are counted, but the total time only once */
+  pe = find_profile_entry("fib");
+  assert (pe && pe->call_count == 177 && !pe->recursion);
+  assert (pe->total_time >= pe->self_time);
+
+  pe = find_profile_entry("<module>");
+  assert (pe && pe->call_count == 1);
+  assert (pe->total_time >= find_profile_entry("fib")->total_time);
+
+  /* Reset keeps the entries */
+  pyddd_ipa_profile_reset();
+  assert (find_profile_entry("foo")->call_count == 0);
+  assert (!find_profile_entry("fib")->total_time);
+
+  /* Stop and start in the middle of a call, active calls are cleared,
+     so the total time is still added */
+  frame = make_test_frame("j=2", "stop.py");
+  assert (frame);
+  assert (!pyddd_ipa_profile_start());
+  pyddd_ipa_profile_trampoline(NULL, frame, PyTrace_CALL, NULL);
+  pe = pyddd_ipa_profile.entries + pyddd_ipa_profile.count - 1;
+  assert (!strcmp(pe->filename, "stop.py") && pe->recursion == 1);
+  assert (!pyddd_ipa_profile_stop());
+  assert (!pyddd_ipa_profile_start());
+  assert (!pe->recursion);
+  pyddd_ipa_profile_trampoline(NULL, frame, PyTrace_CALL, NULL);
+  now = pyddd_ipa_profile_clock();
+  while (pyddd_ipa_profile_clock() == now)
+    ;
+  pyddd_ipa_profile_trampoline(NULL, frame, PyTrace_RETURN, NULL);
+  assert (!pe->recursion && pe->call_count == 2 && pe->total_time > 0);
+
+  /* Reset in the middle of a call, the return isn't counted */
+  pyddd_ipa_profile_trampoline(NULL, frame, PyTrace_CALL, NULL);
+  pyddd_ipa_profile_reset();
+  assert (!pe->recursion && !pe->call_count);
+  pyddd_ipa_profile_trampoline(NULL, frame, PyTrace_RETURN, NULL);
+  assert (!pe->recursion && !pe->total_time && !pe->self_time);
+  assert (!pyddd_ipa_profile_stop());
+
+  /* Profile function of the script is never replaced */
+  PyEval_SetProfile(pyddd_ipa_trace_trampoline, NULL);
+  assert (pyddd_ipa_profile_start() == -2);
+  assert (PyThreadState_Get()->c_profilefunc == pyddd_ipa_trace_trampoline);
+  assert (!pyddd_ipa_profile_stop());
+  assert (PyThreadState_Get()->c_profilefunc == pyddd_ipa_trace_trampoline);
+  PyEval_SetProfile(NULL, NULL);
+
+  Py_DECREF((PyObject*)frame);
+  Py_DECREF(globals);
+}
+
+void test_pyddd_ipa_sample(void)
+{
+  struct pyddd_ipa_t_sample_stack *ps;
+  struct pyddd_ipa_t_profile_entry *pe;
+  PyThreadState *tstate=PyThreadState_Get();
+  PyFrameObject *frame;
+  PyObject *globals, *result;
+  int i, found=0;
+
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  pyddd_ipa_sample_reset();
+
+  assert (pyddd_ipa_sample_start(0) == -1);
+  assert (!pyddd_ipa_sample_start(1000));
+  result = PyRun_String("import time\n"
+                        "def busy(n):\n"
+                        "    t = time.time() + n\n"
+                        "    while time.time() < t:\n"
+                        "        pass\n"
+                        "busy(0.3)\n",
+                        Py_file_input, globals, globals);
+  assert (!pyddd_ipa_sample_stop());
+  assert (result);
+  Py_DECREF(result);
+
+  assert (pyddd_ipa_sample.signals > 0);
+  assert (pyddd_ipa_sample.samples > 0);
+  assert (pyddd_ipa_sample.samples <= pyddd_ipa_sample.signals);
+  assert (!pyddd_ipa_sample.dropped);
+  for (i = 0; i < pyddd_ipa_sample.count; i++) {
+    ps = pyddd_ipa_sample.stacks + i;
+    pe = pyddd_ipa_profile.entries + ps->frames[ps->depth - 1];
+    if (ps->depth == 2 && !strcmp(pe->name, "busy")) {
+      pe = pyddd_ipa_profile.entries + ps->frames[0];
+      assert (!strcmp(pe->name, "<module>"));
+      found = ps->count;
+    }
+  }
+  /* Most of the time is spent in busy */
+  assert (found > pyddd_ipa_sample.samples / 2);
+
+  /* Nothing is sampled after stop */
+  i = pyddd_ipa_sample.signals;
+  result = PyRun_String("busy(0.05)\n", Py_file_input, globals, globals);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_sample.signals == i);
+
+  /* Interval of 1 second is valid */
+  assert (!pyddd_ipa_sample_start(1));
+  assert (!pyddd_ipa_sample_stop());
+
+  /* Sample taken by GDB, the frame is in the thread state */
+  pyddd_ipa_sample_reset();
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  tstate->frame = frame;
+  assert (!pyddd_ipa_sample_take());
+  tstate->frame = NULL;
+  assert (pyddd_ipa_sample.samples == 1 && pyddd_ipa_sample.count == 1);
+  ps = pyddd_ipa_sample.stacks;
+  pe = pyddd_ipa_profile.entries + ps->frames[ps->depth - 1];
+  assert (ps->count == 1 && !strcmp(pe->filename, "foo.py"));
+  Py_DECREF((PyObject*)frame);
+
+  pyddd_ipa_sample_reset();
+  assert (!pyddd_ipa_sample.count && !pyddd_ipa_sample.samples);
+  Py_DECREF(globals);
+}
+
+static void *
+hit_breakpoint_thread(void *frame)
+{
+  int i;
+  for (i = 0; i < 100000; i++)
+    pyddd_ipa_trace_trampoline(NULL,
+                               (PyFrameObject*)frame,
+                               PyTrace_LINE,
+                               NULL);
+  return NULL;
+}
+
+void test_pyddd_ipa_hit_count(void)
+{
+  int i, n;
+  pthread_t threads[4];
+  PyFrameObject *frame;
+
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+
+  /* Stop every 3 hits */
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 3, 1, 1, "foo.py");
+  pyddd_ipa_hit_flag = 0;
+  for (n = 0; n < 7; n++)
+    pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 2);
+  assert (pyddd_ipa_breakpoint_stats.stats[i].hit_count == 7);
+
+  /* Enable 2 times */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 0, -2, 1, "foo.py");
+  pyddd_ipa_hit_flag = 0;
+  for (n = 0; n < 3; n++)
+    pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 2);
+  assert (!pyddd_ipa_breakpoint_stats.stats[i].enabled);
+
+  /* No hit is lost in multi-threads, the code entry has been filled
+     in the above calls, so no python api is called in threads. */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, NULL, 1000000, 1, 1, "foo.py");
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  for (n = 0; n < 4; n++)
+    assert (!pthread_create(threads + n, NULL, hit_breakpoint_thread, frame));
+  for (n = 0; n < 4; n++)
+    pthread_join(threads[n], NULL);
+  assert (pyddd_ipa_breakpoint_stats.stats[i].hit_count == 400001);
+
+  pyddd_ipa_remove_breakpoint(i);
+  Py_DECREF((PyObject*)frame);
+}
+
+void test_pyddd_ipa_tracepoint(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  struct pyddd_ipa_t_breakpoint_record *r, *r2;
+  struct pyddd_ipa_t_breakpoint_stat *st, *st2;
+  PyFrameObject *frame;
+  char *s;
+  time_t t;
+  int i;
+
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+  pyddd_ipa_hit_flag = 0;
+
+  /* Tracepoint never stops, only hits passed condition are counted */
+  r = (struct pyddd_ipa_t_breakpoint_record*)pyddd_ipa_data_buffer;
+  s = put_breakpoint_record(pyddd_ipa_data_buffer, -1, 1, 1, 1,
+                            NULL, "foo.py");
+  r2 = (struct pyddd_ipa_t_breakpoint_record*)s;
+  put_breakpoint_record(s, -1, 2, 1, 1, "i==3", "foo.py");
+  r->tracepoint = PYDDD_IPA_TRACEPOINT_TIME;
+  r2->tracepoint = PYDDD_IPA_TRACEPOINT_COUNT;
+  assert (pyddd_ipa_load_breakpoints(2) == 2);
+  st = pyddd_ipa_breakpoint_stats.stats + r->rindex;
+  st2 = pyddd_ipa_breakpoint_stats.stats + r2->rindex;
+  t = time(NULL);
+  for (i = 0; i < 5; i++)
+    ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (!pyddd_ipa_hit_flag);
+  assert (st->hit_count == 5 && st->trace_count == 5);
+  assert (st->first_time > 0 && st->last_time >= st->first_time);
+  /* Timestamp is realtime in nanoseconds */
+  assert (st->first_time / 1000000000LL >= t);
+  assert (st->last_time / 1000000000LL <= time(NULL));
+  assert (st2->hit_count == 5 && !st2->trace_count);
+  assert (!st2->first_time && !st2->last_time);
+
+  /* Become normal breakpoint, counters are cleared */
+  r = (struct pyddd_ipa_t_breakpoint_record*)pyddd_ipa_data_buffer;
+  put_breakpoint_record(pyddd_ipa_data_buffer, r2->rindex, 2, 1, 1,
+                        "i==2", "foo.py");
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  assert (!st2->hit_count && !st2->trace_count);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+  assert (st->trace_count == 6 && st2->hit_count == 1);
+
+  clear_breakpoint_table();
+  Py_DECREF((PyObject*)frame);
+#undef ft
+}
+
+/* Read the next log record at pos, return its message */
+static const char *
+read_log_record(unsigned long long pos, struct pyddd_ipa_t_log_record *r)
+{
+  static char buf[sizeof(struct pyddd_ipa_t_log_record)
+                  + PYDDD_IPA_LOG_MESSAGE_SIZE];
+  int i;
+  for (i = 0; i < sizeof(buf); i++)
+    buf[i] = pyddd_ipa_log.data[(pos + i) & (PYDDD_IPA_LOG_SIZE - 1)];
+  memcpy(r, buf, sizeof(*r));
+  return buf + sizeof(*r);
+}
+
+void test_pyddd_ipa_logpoint(void)
+{
+  struct pyddd_ipa_t_breakpoint_record *r;
+  struct pyddd_ipa_t_log_record lr;
+  PyObject *globals, *result;
+  unsigned long long pos;
+  const char *s;
+  char *p;
+  int n;
+
+  assert (sizeof(struct pyddd_ipa_t_log_record) == 24);
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+  pyddd_ipa_hit_flag = 0;
+
+  /* Message follows condition and filename */
+  r = (struct pyddd_ipa_t_breakpoint_record*)pyddd_ipa_data_buffer;
+  memset(r, 0, sizeof(*r));
+  r->rindex = -1;
+  r->bpnum = 1;
+  r->enabled = 1;
+  r->lineno = 3;
+  r->tracepoint = PYDDD_IPA_TRACEPOINT_LOG;
+  r->condition_size = 5;
+  r->filename_size = 9;
+  p = (char*)(r + 1);
+  strcpy(p, "n>96");
+  strcpy(p + 5, "<string>");
+  strcpy(p + 14, "'n=%s m=%s' % (n, m)");
+  r->message_size = strlen(p + 14) + 1;
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  assert (!strcmp(pyddd_ipa_breakpoint_table[r->rindex].message,
+                  "'n=%s m=%s' % (n, m)"));
+
+  /* Locals of function are logged, never stop */
+  pos = pyddd_ipa_log.head = pyddd_ipa_log.tail = 0;
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("def foo(m):\n"
+                        "    for n in range(m):\n"
+                        "        n = n + 1\n"
+                        "foo(100)\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (!pyddd_ipa_hit_flag);
+  for (n = 97; n < 100; n++) {
+    s = read_log_record(pos, &lr);
+    assert (lr.bpnum == 1 && lr.time > 0 && lr.size % 8 == 0);
+    assert (!strcmp(s, n == 97 ? "n=97 m=100" : n == 98 ? "n=98 m=100"
+                    : "n=99 m=100"));
+    pos += lr.size;
+  }
+  assert (pos == pyddd_ipa_log.head);
+
+  /* Drop messages when full, the records wrap around */
+  pyddd_ipa_log.tail = pyddd_ipa_log.head = PYDDD_IPA_LOG_SIZE - 8;
+  pyddd_ipa_log.dropped = 0;
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("for i in range(2000):\n"
+                        "    foo(100)\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_log.dropped > 0);
+  assert (pyddd_ipa_log.head - pyddd_ipa_log.tail <= PYDDD_IPA_LOG_SIZE);
+  s = read_log_record(pyddd_ipa_log.tail, &lr);
+  assert (lr.bpnum == 1 && !strcmp(s, "n=97 m=100"));
+
+  /* Name of exception is logged if evaluation fails */
+  pos = pyddd_ipa_log.head = pyddd_ipa_log.tail = 0;
+  strcpy(p, "n>98");
+  strcpy(p + 14, "n + k");
+  r->message_size = strlen(p + 14) + 1;
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("foo(100)\n", Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  s = read_log_record(pos, &lr);
+  assert (!strcmp(s, "<error: NameError>"));
+  assert (pos + lr.size == pyddd_ipa_log.head);
+
+  /* Invalid message is compiled only once */
+  pos = pyddd_ipa_log.head = pyddd_ipa_log.tail = 0;
+  strcpy(p, "n>97");
+  strcpy(p + 14, "n +");
+  r->message_size = strlen(p + 14) + 1;
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  assert (!pyddd_ipa_breakpoint_table[r->rindex].message_error);
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("foo(100)\n", Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_breakpoint_table[r->rindex].message_error);
+  assert (!pyddd_ipa_breakpoint_table[r->rindex].co_message);
+  for (n = 0; n < 2; n++) {
+    s = read_log_record(pos, &lr);
+    assert (!strcmp(s, "<error: invalid message>"));
+    pos += lr.size;
+  }
+  assert (pos == pyddd_ipa_log.head);
+
+  clear_breakpoint_table();
+  pyddd_ipa_log.tail = pyddd_ipa_log.head;
+  Py_DECREF(globals);
+}
+
+void test_pyddd_ipa_update_tracing(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  PyThreadState *tstate=PyThreadState_Get();
+  PyThreadState *tstate2, *tstate3;
+  PyFrameObject *frame;
+  int i;
+
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+  pyddd_ipa_load_catch_functions("");
+  pyddd_ipa_load_catch_exceptions("");
+  pyddd_ipa_module_autoload = 0;
+  tstate2 = PyThreadState_New(tstate->interp);
+  pyddd_ipa_auto_trace = 1;
+
+  /* Nothing is armed */
+  assert (pyddd_ipa_update_tracing() == 0);
+  assert (!tstate->c_tracefunc && !tstate2->c_tracefunc);
+  assert (!tstate->use_tracing && !tstate2->use_tracing);
+
+  /* Installed in all the threads by breakpoint */
+  put_breakpoint_record(pyddd_ipa_data_buffer, -1, 1, 1, 1, NULL, "foo.py");
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  i = ((struct pyddd_ipa_t_breakpoint_record*)pyddd_ipa_data_buffer)->rindex;
+  assert (pyddd_ipa_tracing == 1);
+  assert (tstate->c_tracefunc == pyddd_ipa_trace_trampoline);
+  assert (tstate2->c_tracefunc == pyddd_ipa_trace_trampoline);
+  assert (tstate->use_tracing && tstate2->use_tracing);
+
+  /* Disabled breakpoint isn't armed */
+  put_breakpoint_record(pyddd_ipa_data_buffer, i, 1, 0, 1, NULL, "foo.py");
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  assert (!pyddd_ipa_tracing && !tstate2->c_tracefunc);
+
+  /* Enabled once, removed after it stops */
+  put_breakpoint_record(pyddd_ipa_data_buffer, i, 1, -1, 1, NULL, "foo.py");
+  assert (pyddd_ipa_load_breakpoints(1) == 1);
+  assert (pyddd_ipa_tracing && tstate2->c_tracefunc);
+  pyddd_ipa_hit_flag = 0;
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+  assert (!pyddd_ipa_tracing && !tstate2->c_tracefunc);
+  pyddd_ipa_remove_breakpoint(i);
+
+  /* Volatile breakpoint, removed after it stops */
+  pyddd_ipa_step_command(1);
+  assert (pyddd_ipa_tracing && tstate->c_tracefunc);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 2);
+  assert (!pyddd_ipa_tracing && !tstate->c_tracefunc);
+
+  /* Catchpoints */
+  pyddd_ipa_load_catch_functions("foo");
+  assert (pyddd_ipa_tracing && tstate2->c_tracefunc);
+  pyddd_ipa_load_catch_functions("");
+  assert (!pyddd_ipa_tracing && !tstate2->c_tracefunc);
+
+  /* Module autoload only needs the profile function */
+  pyddd_ipa_module_autoload = 1;
+  assert (pyddd_ipa_update_tracing() == 0);
+  assert (!tstate->c_tracefunc && !tstate2->c_tracefunc);
+  assert (tstate->c_profilefunc == pyddd_ipa_module_trampoline);
+  assert (tstate2->c_profilefunc == pyddd_ipa_module_trampoline);
+  assert (tstate->use_tracing && tstate2->use_tracing);
+  pyddd_ipa_profile_start();
+  assert (tstate2->c_profilefunc == pyddd_ipa_profile_trampoline);
+  pyddd_ipa_profile_stop();
+  assert (tstate2->c_profilefunc == pyddd_ipa_module_trampoline);
+  pyddd_ipa_module_autoload = 0;
+  assert (pyddd_ipa_update_tracing() == 0);
+  assert (!tstate->c_profilefunc && !tstate2->c_profilefunc);
+  assert (!tstate->use_tracing && !tstate2->use_tracing);
+
+  /* Installed in the thread created after it's armed */
+  pyddd_ipa_load_catch_functions("foo");
+  tstate3 = PyThreadState_New(tstate->interp);
+  assert (!tstate3->c_tracefunc);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (tstate3->c_tracefunc == pyddd_ipa_trace_trampoline);
+  assert (tstate3->use_tracing);
+  pyddd_ipa_load_catch_functions("");
+  assert (!tstate3->c_tracefunc);
+  PyThreadState_Clear(tstate3);
+  PyThreadState_Delete(tstate3);
+
+  /* The other trace function and profile function are kept */
+  tstate2->c_tracefunc = pyddd_ipa_profile_trampoline;
+  tstate->c_profilefunc = pyddd_ipa_profile_trampoline;
+  pyddd_ipa_load_catch_exceptions("*");
+  assert (tstate2->c_tracefunc == pyddd_ipa_profile_trampoline);
+  pyddd_ipa_load_catch_exceptions("");
+  assert (tstate2->c_tracefunc == pyddd_ipa_profile_trampoline);
+  assert (!tstate->c_tracefunc && tstate->use_tracing);
+  tstate->c_profilefunc = NULL;
+  tstate->use_tracing = 0;
+
+  pyddd_ipa_auto_trace = 0;
+  tstate2->c_tracefunc = NULL;
+  PyThreadState_Clear(tstate2);
+  PyThreadState_Delete(tstate2);
+  Py_DECREF((PyObject*)frame);
+#undef ft
+}
+
+static int
+find_attach_module(const char *filename)
+{
+  register char *s = pyddd_ipa_data_buffer;
+  char *end = pyddd_ipa_data_buffer + pyddd_ipa_attach_size;
+
+  for (; s < end; s += strlen(s) + 1)
+    if (!strcmp(s, filename))
+      return 1;
+  return 0;
+}
+
+void test_pyddd_ipa_attach(void)
+{
+  PyThreadState *tstate=PyThreadState_Get();
+  PyObject *module;
+
+  module = PyImport_AddModule("pyddd_attach_foo");
+  PyModule_AddStringConstant(module, "__file__", "/tmp/pyddd_attach_foo.pyc");
+  module = PyImport_AddModule("pyddd_attach_bar");
+  PyModule_AddStringConstant(module, "__file__", "/tmp/pyddd_attach_bar.so");
+  pyddd_ipa_load_module_filters("");
+  assert (!tstate->c_tracefunc);
+
+  /* Nothing is done until python runs the pending call */
+  pyddd_ipa_attach_size = 0;
+  assert (pyddd_ipa_attach() == 0);
+  assert (pyddd_ipa_attach_pending == 1);
+  assert (pyddd_ipa_attach() == 0);
+  assert (!tstate->c_tracefunc && !pyddd_ipa_attach_size);
+  PyRun_SimpleString("for i in range(10):\n"
+                     "    pass\n");
+  assert (!pyddd_ipa_attach_pending);
+  assert (tstate->c_tracefunc == pyddd_ipa_trace_trampoline);
+  assert (tstate->use_tracing);
+  assert (find_attach_module("/tmp/pyddd_attach_foo.py"));
+  assert (!find_attach_module("/tmp/pyddd_attach_bar.so"));
+  assert (pyddd_ipa_data_buffer[pyddd_ipa_attach_size - 1] == '\0');
+
+  /* Installed by pyddd_ipa_update_tracing before, and filters */
+  pyddd_ipa_load_module_filters("-/tmp/pyddd_attach_*");
+  assert (pyddd_ipa_attach() == 0);
+  PyRun_SimpleString("for i in range(10):\n"
+                     "    pass\n");
+  assert (!pyddd_ipa_attach_pending);
+  assert (tstate->c_tracefunc == pyddd_ipa_trace_trampoline);
+  assert (!find_attach_module("/tmp/pyddd_attach_foo.py"));
+
+  PyEval_SetTrace(NULL, NULL);
+  pyddd_ipa_load_module_filters("");
+}
+
+void test_pyddd_ipa_breakpoint_stats(void)
+{
+  struct pyddd_ipa_t_breakpoint_stats *stats=&pyddd_ipa_breakpoint_stats;
+  unsigned int generation;
+  PyFrameObject *frame;
+  int i;
+
+  assert (stats->magic == PYDDD_IPA_STATS_MAGIC);
+  assert (stats->version == PYDDD_IPA_STATS_VERSION);
+  assert (sizeof(struct pyddd_ipa_t_breakpoint_stat) == 32);
+  assert ((char*)stats->stats - (char*)stats == 16);
+
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+
+  generation = stats->generation;
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, -1, 1, "foo.py");
+  assert (stats->generation != generation);
+  assert (stats->count == pyddd_ipa_breakpoint_counter);
+  assert (stats->stats[i].enabled == -1 && !stats->stats[i].hit_count);
+
+  /* Not changed if there is no hit */
+  generation = stats->generation;
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_CALL, NULL);
+  assert (stats->generation == generation);
+
+  pyddd_ipa_hit_flag = 0;
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+  assert (stats->generation != generation);
+  assert (!stats->stats[i].enabled && stats->stats[i].hit_count == 1);
+
+  generation = stats->generation;
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (stats->generation == generation);
+
+  pyddd_ipa_remove_breakpoint(i);
+  assert (stats->generation != generation);
+  Py_DECREF((PyObject*)frame);
+}
+
+extern struct pyddd_ipa_t_volatile_breakpoint *
+pyddd_ipa_find_volatile_breakpoint(const long thread_id);
+extern int pyddd_ipa_set_volatile_breakpoint(const int enabled,
+                                             const long thread_id,
+                                             PyFrameObject *f_frame,
+                                             PyObject* co_filename,
+                                             const int lineno);
+void test_pyddd_ipa_volatile_breakpoint(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  PyThreadState *tstate, *tstate2;
+  PyFrameObject *frame, *frame2;
+  long thread, thread2;
+
+  tstate = PyThreadState_Get();
+  tstate2 = PyThreadState_New(tstate->interp);
+  thread = tstate->thread_id;
+  thread2 = thread + 1;
+  tstate2->thread_id = thread2;
+
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  frame2 = PyFrame_New(tstate2, frame->f_code, frame->f_globals, NULL);
+  assert (frame2);
+
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+
+  /* Step in the other thread doesn't affect this thread */
+  assert (!pyddd_ipa_set_volatile_breakpoint(2, thread2, NULL, NULL, 0));
+  pyddd_ipa_hit_flag = 0;
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (!pyddd_ipa_hit_flag);
+  assert (pyddd_ipa_volatile_breakpoint_armed == 1);
+
+  /* Both of threads are stepping */
+  assert (!pyddd_ipa_step_command(1));
+  assert (pyddd_ipa_volatile_breakpoint_armed == 2);
+  ft(NULL, frame2, PyTrace_LINE, NULL);
+  assert (!pyddd_ipa_hit_flag);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+  ft(NULL, frame2, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 2);
+  assert (!pyddd_ipa_volatile_breakpoint_armed);
+
+  /* Entry of thread is reused */
+  assert (!pyddd_ipa_step_command(1));
+  assert (pyddd_ipa_find_volatile_breakpoint(thread)->enabled == 1);
+  assert (!pyddd_ipa_next_command(3));
+  assert (pyddd_ipa_find_volatile_breakpoint(thread)->enabled == 3);
+  assert (pyddd_ipa_volatile_breakpoint_armed == 1);
+
+  /* Breakpoint hit only clears volatile breakpoint of this thread */
+  assert (!pyddd_ipa_set_volatile_breakpoint(2, thread2, NULL, NULL, 0));
+  pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, 1, 1, "foo.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 4);
+  assert (!pyddd_ipa_find_volatile_breakpoint(thread)->enabled);
+  assert (pyddd_ipa_find_volatile_breakpoint(thread2)->enabled == 2);
+  assert (pyddd_ipa_volatile_breakpoint_armed == 1);
+
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+  Py_DECREF((PyObject*)frame2);
+  Py_DECREF((PyObject*)frame);
+  PyThreadState_Clear(tstate2);
+  PyThreadState_Delete(tstate2);
+#undef ft
+}
+
+extern unsigned int pyddd_ipa_hash_filename(const char *filename);
+
+void test_pyddd_ipa_breakpoint_index(void)
+{
+  int i, j, k, n;
+  PyFrameObject *frame;
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+
+  clear_breakpoint_table();
+  for (i = 0; i < PYDDD_IPA_BREAKPOINT_HASH_SIZE; i++)
+    assert (!pyddd_ipa_breakpoint_index[i]);
+
+  /* Same line in the other file is in another bucket */
+  n = PYDDD_IPA_BREAKPOINT_HASH(pyddd_ipa_hash_filename("foo.py"), 1);
+  k = pyddd_ipa_insert_breakpoint(3, 0, 0, NULL, 0, 1, 1, "bar.py");
+  assert (n != PYDDD_IPA_BREAKPOINT_HASH(pyddd_ipa_hash_filename("bar.py"),
+                                         1));
+  assert (!pyddd_ipa_breakpoint_index[n]);
+
+  /* Lines of one file are in the same bucket if lineno has same hash */
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, 1, 1, "foo.py");
+  j = pyddd_ipa_insert_breakpoint(2, 0, 0, NULL, 0, 1,
+                                  1 + PYDDD_IPA_BREAKPOINT_HASH_SIZE,
+                                  "foo.py");
+  assert (pyddd_ipa_breakpoint_index[n] == j + 1);
+  assert (pyddd_ipa_breakpoint_table[j].next == i + 1);
+
+  pyddd_ipa_hit_flag = 0;
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+
+  /* Remove the tail of the chain */
+  pyddd_ipa_remove_breakpoint(i);
+  pyddd_ipa_hit_flag = 0;
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (!pyddd_ipa_hit_flag);
+
+  /* Move breakpoint to current line */
+  pyddd_ipa_update_breakpoint(j, 2, 0, 0, NULL, 0, 1, 1, "foo.py");
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+
+  /* Move it to another line, but still in the same bucket */
+  pyddd_ipa_update_breakpoint(j, 2, 0, 0, NULL, 0, 1,
+                              1 + PYDDD_IPA_BREAKPOINT_HASH_SIZE * 2,
+                              "foo.py");
+  pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+
+  pyddd_ipa_remove_breakpoint(k);
+  pyddd_ipa_remove_breakpoint(j);
+  for (i = 0; i < PYDDD_IPA_BREAKPOINT_HASH_SIZE; i++)
+    assert (!pyddd_ipa_breakpoint_index[i]);
+
+  Py_DECREF((PyObject*)frame);
+}
+
 void test_pyddd_ipa_frame_variable(void)
 {
 #define ft pyddd_ipa_frame_variable
@@ -196,6 +1335,120 @@ void test_pyddd_ipa_frame_locals(void)
 #undef ft
 }
 
+/* Return repr of kind name in the snapshot, NULL if not found */
+static const char *
+find_snapshot_variable(int size, char kind, const char *name)
+{
+  const char *s=pyddd_ipa_data_buffer;
+  const char *end=pyddd_ipa_data_buffer + size;
+  while (s < end) {
+    if (*s == kind && !strcmp(s + 1, name))
+      return s + strlen(s) + 1;
+    s += strlen(s) + 1;
+    s += strlen(s) + 1;
+  }
+  assert (s == end);
+  return NULL;
+}
+
+void test_pyddd_ipa_frame_snapshot(void)
+{
+#define ft pyddd_ipa_frame_snapshot
+  PyFrameObject *frame;
+  PyObject *globals, *result;
+  int n;
+
+  /* Locals in dict */
+  frame = make_test_frame("i+=2", "foo.py");
+  assert (frame);
+  n = ft(frame, 0, 0);
+  assert (n > 0 && n < PYDDD_IPA_DATA_BUFFER_SIZE);
+  assert (!strcmp(find_snapshot_variable(n, 'l', "i"), "2"));
+  assert (!strcmp(find_snapshot_variable(n, 'l', "name"), "'jondy'"));
+  assert (!strcmp(find_snapshot_variable(n, 'l', "rlist"), "(3, 5)"));
+  assert (!find_snapshot_variable(n, 'g', "i"));
+
+  n = ft(frame, 1, 0);
+  assert (!strcmp(find_snapshot_variable(n, 'g', "i"), "4"));
+  assert (!find_snapshot_variable(n, 'l', "i"));
+
+  /* Truncate repr */
+  n = ft(frame, 0, 3);
+  assert (!strcmp(find_snapshot_variable(n, 'l', "name"), "'jo"));
+  Py_DECREF((PyObject*)frame);
+
+  /* Fast locals and cells of function frame */
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  result = PyRun_String("import sys\n"
+                        "def foo(a, b=2):\n"
+                        "    c = 'x' * 100\n"
+                        "    def bar():\n"
+                        "        return c\n"
+                        "    d = bar\n"
+                        "    return sys._getframe()\n"
+                        "frame = foo(1)\n",
+                        Py_file_input, globals, globals);
+  assert (result);
+  Py_DECREF(result);
+  frame = (PyFrameObject*)PyDict_GetItemString(globals, "frame");
+  assert (frame);
+
+  n = ft(frame, 0, 10);
+  assert (!strcmp(find_snapshot_variable(n, 'a', "a"), "1"));
+  assert (!strcmp(find_snapshot_variable(n, 'a', "b"), "2"));
+  assert (!strcmp(find_snapshot_variable(n, 'c', "c"), "'xxxxxxxxx"));
+  assert (!strncmp(find_snapshot_variable(n, 'l', "bar"), "<function", 9));
+  assert (find_snapshot_variable(n, 'l', "d"));
+  assert (!find_snapshot_variable(n, 'l', "a"));
+
+  Py_DECREF(globals);
+#undef ft
+}
+
+void test_pyddd_ipa_frame_backtrace(void)
+{
+#define ft pyddd_ipa_frame_backtrace
+  struct pyddd_ipa_t_frame_record *r, *r2;
+  PyFrameObject *frame;
+  PyObject *globals, *result;
+  int n;
+
+  assert (sizeof(struct pyddd_ipa_t_frame_record) == 24);
+
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  result = PyRun_String("import sys\n"
+                        "def foo(a, b):\n"
+                        "    return sys._getframe()\n"
+                        "frame = foo(1, 2)\n",
+                        Py_file_input, globals, globals);
+  assert (result);
+  Py_DECREF(result);
+  frame = (PyFrameObject*)PyDict_GetItemString(globals, "frame");
+  assert (frame && frame->f_back && !frame->f_back->f_back);
+
+  n = ft(frame, -1);
+  r = (struct pyddd_ipa_t_frame_record*)pyddd_ipa_data_buffer;
+  r2 = (struct pyddd_ipa_t_frame_record*)
+    (pyddd_ipa_data_buffer + PYDDD_IPA_FRAME_RECORD_SIZE(r));
+  assert (n == PYDDD_IPA_FRAME_RECORD_SIZE(r)
+          + PYDDD_IPA_FRAME_RECORD_SIZE(r2));
+  assert (r->frame == (long)frame && r->lineno == 3 && r->argcount == 2);
+  assert (!strcmp((char*)(r + 1), "<string>"));
+  assert (!strcmp((char*)(r + 1) + r->filename_size, "foo"));
+  assert (r2->frame == (long)frame->f_back && r2->lineno == 4);
+  assert (!r2->argcount);
+  assert (!strcmp((char*)(r2 + 1) + r2->filename_size, "<module>"));
+
+  /* Only one frame */
+  assert (ft(frame, 1) == PYDDD_IPA_FRAME_RECORD_SIZE(r));
+  assert (!ft(frame, 0));
+
+  Py_DECREF(globals);
+#undef ft
+}
+
 void test_pyddd_ipa_frame_globals(void)
 {
 #define ft pyddd_ipa_frame_globals
@@ -258,7 +1511,7 @@ void test_pyddd_ipa_trace_trampoline(void)
   ft(NULL, frame, PyTrace_LINE, NULL);
   assert (pyddd_ipa_hit_flag == 2);
 
-  pyddd_ipa_volatile_breakpoint.enabled = 0;
+  clear_volatile_breakpoints();
   pyddd_ipa_hit_flag = 0;
   pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, 1, 10, "foo.py");
   pyddd_ipa_insert_breakpoint(1, 0, 0, NULL, 0, 0, 1, "foo.py");
@@ -290,33 +1543,640 @@ void test_pyddd_ipa_trace_trampoline(void)
   ft(NULL, frame, PyTrace_LINE, NULL);
   assert (pyddd_ipa_hit_flag == 1);
 
-  
   Py_DECREF((PyObject*)frame);
 
 #undef ft
 }
 
+extern struct pyddd_ipa_t_code_entry*
+pyddd_ipa_lookup_code(PyCodeObject *code);
+void test_pyddd_ipa_catch_call(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  PyFrameObject *frame, *frame2;
+  struct pyddd_ipa_t_code_entry *entry;
+  unsigned int generation;
+
+  frame = make_test_frame("j=2", "foo.py");
+  frame2 = make_test_frame("k=2", "bar.py");
+  assert (frame && frame2);
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+
+  pyddd_ipa_hit_flag = 0;
+  assert (!pyddd_ipa_load_catch_functions("foo <mod*"));
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+
+  /* Result is cached in the code entry */
+  entry = pyddd_ipa_lookup_code(frame->f_code);
+  assert (entry->catch_call);
+  assert (entry->catch_generation == pyddd_ipa_catch_generation);
+  entry->catch_call = 0;
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+
+  /* Load patterns again */
+  generation = pyddd_ipa_catch_generation;
+  assert (!pyddd_ipa_load_catch_functions("foo bar"));
+  assert (pyddd_ipa_catch_generation != generation);
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  ft(NULL, frame2, PyTrace_CALL, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+
+  assert (!pyddd_ipa_load_catch_functions("*"));
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  ft(NULL, frame2, PyTrace_CALL, NULL);
+  assert (pyddd_ipa_hit_flag == 3);
+
+  /* Empty namelist removes all the patterns */
+  assert (!pyddd_ipa_load_catch_functions(""));
+  assert (!pyddd_ipa_catch_functions);
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (pyddd_ipa_hit_flag == 3);
+
+  Py_DECREF((PyObject*)frame);
+  Py_DECREF((PyObject*)frame2);
+
+#undef ft
+}
+
+/* Return lineno of name in the symbols of module, 0 if not found */
+static int
+find_module_symbol(struct pyddd_ipa_t_module *module, const char *name)
+{
+  const char *s=module->symbols;
+  const char *end=module->symbols + module->size;
+  while (s < end) {
+    if (!strcmp(s, name))
+      return atoi(s + strlen(s) + 1);
+    s += strlen(s) + 1;
+    s += strlen(s) + 1;
+  }
+  assert (s == end);
+  return 0;
+}
+
+void test_pyddd_ipa_module_symbols(void)
+{
+#define ft pyddd_ipa_module_trampoline
+  PyCodeObject *co;
+  PyObject *globals;
+  PyFrameObject *frame;
+  struct pyddd_ipa_t_module *module;
+
+  co = (PyCodeObject*)Py_CompileStringFlags("def foo():\n"
+                                            "    def bar():\n"
+                                            "        pass\n"
+                                            "class Foo:\n"
+                                            "    def hello(self):\n"
+                                            "        f = lambda x: x\n"
+                                            "        class Bar:\n"
+                                            "            def run(self):\n"
+                                            "                pass\n",
+                                            "/tmp/foo_module.py",
+                                            Py_file_input,
+                                            NULL);
+  assert (co);
+  globals = PyDict_New();
+  frame = PyFrame_New(PyThreadState_Get(), co, globals, NULL);
+  assert (frame && frame->f_locals == frame->f_globals);
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+
+  /* Nothing is collected if autoload is disabled */
+  pyddd_ipa_module_autoload = 0;
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (!pyddd_ipa_find_module("/tmp/foo_module.py"));
+
+  pyddd_ipa_module_autoload = 1;
+  pyddd_ipa_load_pending_files(NULL);
+  pyddd_ipa_hit_flag = 0;
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (!pyddd_ipa_hit_flag);
+  module = pyddd_ipa_find_module("/tmp/foo_module.py");
+  assert (module && module == pyddd_ipa_current_module);
+  assert (find_module_symbol(module, "foo") == 1);
+  assert (find_module_symbol(module, "foo.<locals>.bar") == 2);
+  assert (find_module_symbol(module, "Foo") == 4);
+  assert (find_module_symbol(module, "Foo.hello") == 5);
+  assert (find_module_symbol(module, "Foo.hello.<locals>.Bar") == 7);
+  assert (find_module_symbol(module, "Foo.hello.<locals>.Bar.run") == 8);
+  assert (!find_module_symbol(module, "bar"));
+  assert (!find_module_symbol(module, "Foo.hello.<locals>.<lambda>"));
+
+  /* Stop only if there is any pending breakpoint in this module */
+  pyddd_ipa_load_pending_files("/tmp/bar_module.py\n");
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (!pyddd_ipa_hit_flag);
+  pyddd_ipa_load_pending_files("/tmp/bar_module.py\n/tmp/foo_module.py");
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (pyddd_ipa_hit_flag == 1);
+  assert (pyddd_ipa_find_module("/tmp/foo_module.py") == module);
+
+  /* Function frame isn't module */
+  pyddd_ipa_current_module = NULL;
+  Py_DECREF(frame->f_locals);
+  frame->f_locals = PyDict_New();
+  ft(NULL, frame, PyTrace_CALL, NULL);
+  assert (pyddd_ipa_hit_flag == 1 && !pyddd_ipa_current_module);
+
+  pyddd_ipa_module_autoload = 0;
+  pyddd_ipa_load_pending_files(NULL);
+  Py_DECREF((PyObject*)frame);
+  Py_DECREF(globals);
+  Py_DECREF(co);
+#undef ft
+}
+
+extern int pyddd_ipa_fnmatch(const char *pattern, const char *s);
+extern int pyddd_ipa_check_module(PyCodeObject *code);
+
+void test_pyddd_ipa_module_filters(void)
+{
+  PyCodeObject *co;
+
+  assert (pyddd_ipa_fnmatch("*", ""));
+  assert (pyddd_ipa_fnmatch("*", "/a/b.py"));
+  assert (pyddd_ipa_fnmatch("/a/*.py", "/a/b/c.py"));
+  assert (!pyddd_ipa_fnmatch("/a/*.py", "/a/b/c.pyc"));
+  assert (pyddd_ipa_fnmatch("*/site-packages/*", "/usr/lib/site-packages/a.py"));
+  assert (!pyddd_ipa_fnmatch("*/site-packages/*", "/usr/lib/site-packages"));
+  assert (pyddd_ipa_fnmatch("*a*a*a", "aaaa"));
+  assert (!pyddd_ipa_fnmatch("*a*a*a", "aab"));
+  assert (pyddd_ipa_fnmatch("?.py", "a.py"));
+  assert (!pyddd_ipa_fnmatch("?.py", ".py"));
+  assert (pyddd_ipa_fnmatch("[abc].py", "b.py"));
+  assert (!pyddd_ipa_fnmatch("[abc].py", "d.py"));
+  assert (pyddd_ipa_fnmatch("[!abc].py", "d.py"));
+  assert (pyddd_ipa_fnmatch("[a-z]*", "foo"));
+  assert (!pyddd_ipa_fnmatch("[a-z]*", "Foo"));
+  assert (pyddd_ipa_fnmatch("[]]", "]"));
+  assert (pyddd_ipa_fnmatch("[a-]", "-"));
+  /* No closing ']', '[' is a normal char */
+  assert (pyddd_ipa_fnmatch("[ab", "[ab"));
+  assert (!pyddd_ipa_fnmatch("[ab", "a"));
+
+  co = (PyCodeObject*)Py_CompileStringFlags("pass\n",
+                                            "/usr/lib/site-packages/foo.py",
+                                            Py_file_input,
+                                            NULL);
+  assert (co);
+  assert (pyddd_ipa_check_module(co) == 1);
+
+  assert (!pyddd_ipa_load_module_filters("-*/site-packages/*"));
+  assert (pyddd_ipa_check_module(co) == 0);
+  assert (!pyddd_ipa_load_module_filters("+/tmp/*\n"));
+  assert (pyddd_ipa_check_module(co) == 0);
+  assert (!pyddd_ipa_load_module_filters("+/tmp/*\n+/usr/*\n"));
+  assert (pyddd_ipa_check_module(co) == 1);
+  assert (!pyddd_ipa_load_module_filters("+/usr/*\n-*/foo.py"));
+  assert (pyddd_ipa_check_module(co) == 0);
+
+  /* Pending breakpoints ignore filters */
+  assert (!pyddd_ipa_load_pending_files("/usr/lib/site-packages/foo.py"));
+  assert (pyddd_ipa_check_module(co) == 2);
+  assert (!pyddd_ipa_load_pending_files(""));
+  assert (!pyddd_ipa_pending_files);
+
+  assert (!pyddd_ipa_load_module_filters(NULL));
+  assert (!pyddd_ipa_module_filters);
+  assert (pyddd_ipa_check_module(co) == 1);
+
+  Py_DECREF(co);
+
+  /* Not a script */
+  co = (PyCodeObject*)Py_CompileStringFlags("pass\n",
+                                            "<string>",
+                                            Py_file_input,
+                                            NULL);
+  assert (co);
+  assert (pyddd_ipa_check_module(co) == 0);
+  Py_DECREF(co);
+}
+
+void test_pyddd_ipa_breakpoint_condition(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  int i;
+  PyObject *co;
+  PyFrameObject *frame;
+  struct pyddd_ipa_t_breakpoint *p;
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+
+  /* Condition is compiled only once */
+  pyddd_ipa_simple_condition = 0;
+  clear_breakpoint_table();
+  pyddd_ipa_hit_flag = 0;
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, "i==2", 0, 1, 1, "foo.py");
+  p = pyddd_ipa_breakpoint_table + i;
+  assert (!p->co_condition);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  co = p->co_condition;
+  assert (co);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (co == p->co_condition);
+  assert (pyddd_ipa_hit_flag == 2);
+
+  /* Compiled condition is dropped when breakpoint is updated, and
+     released in the next trace event */
+  Py_INCREF(co);
+  assert (co->ob_refcnt == 2);
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "i==1", 0, 1, 1, "foo.py");
+  assert (!p->co_condition);
+  assert (co->ob_refcnt == 2);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (co->ob_refcnt == 1);
+  Py_DECREF(co);
+  assert (p->co_condition && co != p->co_condition);
+  assert (pyddd_ipa_hit_flag == 2);
+
+  /* Bad condition is never compiled again */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "i==", 0, 1, 1, "foo.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (!p->co_condition && p->condition_error);
+  assert (pyddd_ipa_hit_flag == 2);
+
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "i==2", 0, 1, 1, "foo.py");
+  assert (!p->condition_error);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 3);
+
+  pyddd_ipa_remove_breakpoint(i);
+  assert (!p->co_condition);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_release_head == pyddd_ipa_release_tail);
+
+  pyddd_ipa_simple_condition = 1;
+  Py_DECREF((PyObject*)frame);
+
+#undef ft
+}
+
+extern int pyddd_ipa_parse_condition(const char *s, char *name, long *value);
+void test_pyddd_ipa_simple_condition(void)
+{
+#define ft pyddd_ipa_trace_trampoline
+  char name[PYDDD_IPA_COND_NAME_SIZE];
+  long value;
+  int i;
+  PyFrameObject *frame;
+  PyObject *globals, *result;
+  struct pyddd_ipa_t_breakpoint *p;
+
+  assert (pyddd_ipa_parse_condition("i==2", name, &value)
+          == PYDDD_IPA_COND_EQ);
+  assert (!strcmp(name, "i") && value == 2);
+  assert (pyddd_ipa_parse_condition(" user_id != -42 ", name, &value)
+          == PYDDD_IPA_COND_NE);
+  assert (!strcmp(name, "user_id") && value == -42);
+  assert (pyddd_ipa_parse_condition("1000 < i", name, &value)
+          == PYDDD_IPA_COND_GT);
+  assert (pyddd_ipa_parse_condition("i>=0", name, &value)
+          == PYDDD_IPA_COND_GE);
+  assert (!pyddd_ipa_parse_condition("i == j", name, &value));
+  assert (!pyddd_ipa_parse_condition("1 == 2", name, &value));
+  assert (!pyddd_ipa_parse_condition("i == 010", name, &value));
+  assert (!pyddd_ipa_parse_condition("i == 1.5", name, &value));
+  assert (!pyddd_ipa_parse_condition("i == 0x10", name, &value));
+  assert (!pyddd_ipa_parse_condition("i == 1 or j", name, &value));
+  assert (!pyddd_ipa_parse_condition("0 < i < 3", name, &value));
+  assert (!pyddd_ipa_parse_condition("a.b == 1", name, &value));
+  assert (!pyddd_ipa_parse_condition("i = 1", name, &value));
+  assert (!pyddd_ipa_parse_condition("\xe4 == 1", name, &value));
+  assert (!pyddd_ipa_parse_condition("i == 1\xe4", name, &value));
+
+  /* Simple condition is never compiled */
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  clear_breakpoint_table();
+  pyddd_ipa_hit_flag = 0;
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, "i==2", 0, 1, 1, "foo.py");
+  p = pyddd_ipa_breakpoint_table + i;
+  assert (p->cond_op == PYDDD_IPA_COND_EQ);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1 && !p->co_condition);
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "i > 2", 0, 1, 1, "foo.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1 && !p->co_condition);
+
+  /* Not integer or not found, evaluated by python */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "name == 2", 0, 1, 1, "foo.py");
+  assert (p->cond_op);
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1 && p->co_condition);
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "k == 2", 0, 1, 1, "foo.py");
+  ft(NULL, frame, PyTrace_LINE, NULL);
+  assert (pyddd_ipa_hit_flag == 1 && p->co_condition);
+  Py_DECREF((PyObject*)frame);
+
+  /* Fast locals in function */
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "n >= 95", 0, 1, 3, "<string>");
+  pyddd_ipa_hit_flag = 0;
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("def foo(m):\n"
+                        "    for n in range(m):\n"
+                        "        n = n + 1\n"
+                        "foo(100)\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_hit_flag == 5);
+  assert (p->cond_index == 1);
+
+  /* Locals in module, the same hits as python */
+  pyddd_ipa_update_breakpoint(i, 1, 0, 0, "n % 7 == 3", 0, 1, 2, "<string>");
+  i = pyddd_ipa_insert_breakpoint(2, 0, 0, "95 <= n", 0, 1, 2, "<string>");
+  assert (!p->cond_op && pyddd_ipa_breakpoint_table[i].cond_op);
+  pyddd_ipa_hit_flag = 0;
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("for n in range(100):\n"
+                        "    n = n + 1\n",
+                        Py_file_input, globals, globals);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_hit_flag == 19);
+
+  pyddd_ipa_simple_condition = 0;
+  result = PyRun_String("for n in range(100):\n"
+                        "    n = n + 1\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  pyddd_ipa_simple_condition = 1;
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_hit_flag == 38);
+
+  /* Python sees fast locals too, the same hits as simple condition */
+  clear_breakpoint_table();
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, "n + 0 >= 95", 0, 1, 3,
+                                  "<string>");
+  pyddd_ipa_hit_flag = 0;
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("def foo(m):\n"
+                        "    for n in range(m):\n"
+                        "        n = n + 1\n"
+                        "foo(100)\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_hit_flag == 5);
+
+  /* Cell and free variables aren't read from globals */
+  clear_breakpoint_table();
+  i = pyddd_ipa_insert_breakpoint(1, 0, 0, "x == 5", 0, 1, 5, "<string>");
+  pyddd_ipa_insert_breakpoint(2, 0, 0, "x == 5", 0, 1, 6, "<string>");
+  p = pyddd_ipa_breakpoint_table + i;
+  pyddd_ipa_hit_flag = 0;
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  result = PyRun_String("x = 1\n"
+                        "def outer():\n"
+                        "    x = 5\n"
+                        "    def inner():\n"
+                        "        return x\n"
+                        "    return inner()\n"
+                        "outer()\n",
+                        Py_file_input, globals, globals);
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_hit_flag == 2);
+  assert (p->cond_index == -1 && p->co_condition);
+
+  clear_breakpoint_table();
+  Py_DECREF(globals);
+#undef ft
+}
+
+/*
+ * Microbenchmark: cost of one line event without any breakpoint in
+ * this line, no matter how many breakpoints are set in the same file.
+ */
+void bench_pyddd_ipa_breakpoint_index(void)
+{
+  const int counts[] = {0, 10, 1000, PYDDD_IPA_MAX_BREAKPOINT};
+  const int events = 1000000;
+  PyFrameObject *frame;
+  clock_t start;
+  int i, j;
+
+  frame = make_test_frame("j=2", "foo.py");
+  assert (frame);
+  clear_volatile_breakpoints();
+
+  for (i = 0; i < sizeof(counts) / sizeof(counts[0]); i++) {
+    clear_breakpoint_table();
+    for (j = 0; j < counts[i]; j++)
+      assert (pyddd_ipa_insert_breakpoint(j + 1, 0, 0, NULL, 0, 1,
+                                          j + 2, "foo.py") >= 0);
+    pyddd_ipa_hit_flag = 0;
+    start = clock();
+    for (j = 0; j < events; j++)
+      pyddd_ipa_trace_trampoline(NULL, frame, PyTrace_LINE, NULL);
+    printf ("%4d breakpoints: %6.1f ns per line event\n",
+            counts[i],
+            (double)(clock() - start) * 1e9 / CLOCKS_PER_SEC / events
+            );
+    assert (!pyddd_ipa_hit_flag);
+  }
+  clear_breakpoint_table();
+
+  Py_DECREF((PyObject*)frame);
+}
+
+/*
+ * Benchmark: pystone-style throughput when tracing a script without
+ * any breakpoint in it.
+ */
+static const char *bench_script =
+  "def proc1(n):\n"
+  "    s = 0\n"
+  "    for i in range(n):\n"
+  "        s = s + i * 2 % 7\n"
+  "    return s\n"
+  "def proc2(a, b):\n"
+  "    return a * b - a\n"
+  "def main(loops):\n"
+  "    for j in range(loops):\n"
+  "        proc1(20)\n"
+  "        proc2(j, 3)\n";
+
+static double
+bench_run_script(PyObject *globals, int loops, int trace)
+{
+  char buf[64];
+  PyObject *result;
+  clock_t start;
+
+  snprintf(buf, sizeof(buf), "main(%d)", loops);
+  if (trace)
+    PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  start = clock();
+  result = PyRun_String(buf, Py_file_input, globals, globals);
+  start = clock() - start;
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  return loops / ((double)start / CLOCKS_PER_SEC);
+}
+
+/*
+ * Same script with breakpoints in the other files, each line of the
+ * script has a breakpoint in 1 file and in 64 files. In the latter
+ * case, each line event walks a chain of 64 breakpoints in
+ * the same line, unless the code filter returns first.
+ */
+void bench_pyddd_ipa_code_filter(void)
+{
+  const int loops = 200000;
+  const int nfiles[] = {1, 64};
+  static char filenames[64][32];
+  PyObject *globals, *result;
+  int i, j, k, n;
+
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  result = PyRun_String(bench_script, Py_file_input, globals, globals);
+  assert (result);
+  Py_DECREF(result);
+
+  clear_volatile_breakpoints();
+  printf ("no trace:           %8.0f loops per second\n",
+          bench_run_script(globals, loops, 0));
+  for (i = 0; i < sizeof(nfiles) / sizeof(nfiles[0]); i++) {
+    clear_breakpoint_table();
+    for (j = 0, n = 0; j < nfiles[i]; j++) {
+      snprintf(filenames[j], sizeof(filenames[j]), "bar%d.py", j);
+      for (k = 1; k <= 11; k++)
+        assert (pyddd_ipa_insert_breakpoint(++n, 0, 0, NULL, 0, 1, k,
+                                            filenames[j]) >= 0);
+    }
+    printf ("%d breakpoints in %d other file(s):\n", n, nfiles[i]);
+    pyddd_ipa_code_filter = 0;
+    printf ("  trace:              %8.0f loops per second\n",
+            bench_run_script(globals, loops, 1));
+    pyddd_ipa_code_filter = 1;
+    pyddd_ipa_reset_trace_counters();
+    printf ("  trace, code filter: %8.0f loops per second\n",
+            bench_run_script(globals, loops, 1));
+    printf ("  %lu line events, %lu code lookups, %lu candidates\n",
+            pyddd_ipa_trace_counters.events[PyTrace_LINE],
+            pyddd_ipa_trace_counters.code_lookups,
+            pyddd_ipa_trace_counters.line_candidates);
+  }
+
+  clear_breakpoint_table();
+  Py_DECREF(globals);
+}
+
+/*
+ * Benchmark: a loop of 10M iterations with conditional breakpoint
+ * "i == 1000" in the loop, evaluated natively and by python.
+ */
+static double
+bench_run_condition(PyObject *globals, int loops)
+{
+  char buf[128];
+  PyObject *result;
+  clock_t start;
+
+  snprintf(buf, sizeof(buf),
+#if PY_MAJOR_VERSION < 3
+           "for i in xrange(%d):\n"
+#else
+           "for i in range(%d):\n"
+#endif
+           "    j = i\n", loops);
+  pyddd_ipa_hit_flag = 0;
+  PyEval_SetTrace(pyddd_ipa_trace_trampoline, NULL);
+  start = clock();
+  result = PyRun_String(buf, Py_file_input, globals, globals);
+  start = clock() - start;
+  PyEval_SetTrace(NULL, NULL);
+  assert (result);
+  Py_DECREF(result);
+  assert (pyddd_ipa_hit_flag == 1);
+  return loops / ((double)start / CLOCKS_PER_SEC);
+}
+
+void bench_pyddd_ipa_simple_condition(void)
+{
+  const int loops = 10000000;
+  PyObject *globals;
+
+  globals = PyDict_New();
+  PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins());
+  clear_breakpoint_table();
+  clear_volatile_breakpoints();
+  pyddd_ipa_insert_breakpoint(1, 0, 0, "i == 1000", 0, 1, 2, "<string>");
+
+  pyddd_ipa_simple_condition = 0;
+  printf ("condition, python:  %8.0f loops per second\n",
+          bench_run_condition(globals, loops));
+  pyddd_ipa_simple_condition = 1;
+  printf ("condition, native:  %8.0f loops per second\n",
+          bench_run_condition(globals, loops));
+
+  clear_breakpoint_table();
+  Py_DECREF(globals);
+}
+
 int
 main(int argc, char **argv)
 {
   init_func();
+  /* Most of tests install the trace function themselves */
+  pyddd_ipa_auto_trace = 0;
   test_find_name_in_list();
+  test_pyddd_ipa_catch_patterns();
   test_pyddd_ipa_insert_breakpoint();
+  test_pyddd_ipa_load_breakpoints();
 
   Py_SetProgramName(argv[0]);
   Py_Initialize();
   PySys_SetArgvEx(argc, argv, 0);
 
   test_pyddd_ipa_trace_trampoline();
+  test_pyddd_ipa_catch_call();
+  test_pyddd_ipa_module_symbols();
+  test_pyddd_ipa_module_filters();
+  test_pyddd_ipa_breakpoint_condition();
+  test_pyddd_ipa_simple_condition();
+  test_pyddd_ipa_breakpoint_index();
+  test_pyddd_ipa_filename_binding();
+  test_pyddd_ipa_code_filter();
+  test_pyddd_ipa_trace_counters();
+  test_pyddd_ipa_profile();
+  test_pyddd_ipa_sample();
+  test_pyddd_ipa_hit_count();
+  test_pyddd_ipa_breakpoint_stats();
+  test_pyddd_ipa_tracepoint();
+  test_pyddd_ipa_logpoint();
+  test_pyddd_ipa_update_tracing();
+  test_pyddd_ipa_attach();
+  test_pyddd_ipa_volatile_breakpoint();
   test_pyddd_ipa_frame_variable();
 
   test_pyddd_ipa_alter_variable();
   test_pyddd_ipa_eval();
   test_pyddd_ipa_frame_locals();
   test_pyddd_ipa_frame_globals();
+  test_pyddd_ipa_frame_snapshot();
+  test_pyddd_ipa_frame_backtrace();
 
   test_pyddd_ipa_format_object();
 
+  if (argc > 1 && !strcmp(argv[1], "bench")) {
+    bench_pyddd_ipa_breakpoint_index();
+    bench_pyddd_ipa_code_filter();
+    bench_pyddd_ipa_simple_condition();
+  }
+
   Py_Exit(0);
   return 0;
 }